@@ -0,0 +1,46 @@
+import numpy as np
+import perfplot
+
+from cpprb import ReplayBuffer
+
+
+# Configulation
+buffer_size = 2**12
+n_step = 1000
+shape = 4
+
+
+# Helper Function
+def setup(n_keys):
+    rb = ReplayBuffer(buffer_size,
+                      {f"key{i}": {"shape": shape} for i in range(n_keys)})
+    same = {f"key{i}": np.ones(shape,dtype=np.single) for i in range(n_keys)}
+    other = {f"key{i}": np.ones(shape,dtype=np.double) for i in range(n_keys)}
+    lists = {f"key{i}": [1.0] * shape for i in range(n_keys)}
+    return rb, same, other, lists
+
+def add(i):
+    """ Add single step `n_step` times
+    """
+    def f(args):
+        rb = args[0]
+        e = args[i]
+        for _ in range(n_step):
+            rb.add(**e)
+    return f
+
+
+# ReplayBuffer.add
+perfplot.save(filename="ReplayBuffer_add_keys.png",
+              setup = setup,
+              time_unit="ms",
+              kernels = [add(1),add(2),add(3)],
+              labels = ["numpy.ndarray (same dtype)",
+                        "numpy.ndarray (different dtype)",
+                        "list"],
+              n_range = [1,2,4,8,16],
+              xlabel = "Number of keys",
+              title = f"Replay Buffer Add Speed ({n_step} single steps)",
+              logx = False,
+              logy = False,
+              equality_check = None)
@@ -0,0 +1,59 @@
+import numpy as np
+import perfplot
+
+from cpprb import ReplayBuffer, PrioritizedReplayBuffer
+
+
+# Configulation
+buffer_size = 2**20
+batch_size = 256
+n_sample = 100
+
+
+# Helper Function
+def env(obs_shape):
+    return {"obs": {"shape": obs_shape},
+            "act": {"shape": 1},
+            "rew": {},
+            "next_obs": {"shape": obs_shape},
+            "done": {}}
+
+def setup(obs_shape):
+    buffers = []
+    for cls in [ReplayBuffer,PrioritizedReplayBuffer]:
+        for layout in ["column","record"]:
+            rb = cls(buffer_size,env(obs_shape),layout=layout)
+            rb.add_batch({"obs": np.ones((buffer_size,obs_shape),dtype=np.single),
+                          "act": np.ones((buffer_size,1),dtype=np.single),
+                          "rew": np.ones((buffer_size,1),dtype=np.single),
+                          "next_obs": np.ones((buffer_size,obs_shape),
+                                              dtype=np.single),
+                          "done": np.zeros((buffer_size,1),dtype=np.single)})
+            buffers.append(rb)
+    return buffers
+
+def sample(i):
+    """ Sample `batch_size` transitions `n_sample` times
+    """
+    def f(buffers):
+        rb = buffers[i]
+        for _ in range(n_sample):
+            rb.sample(batch_size)
+    return f
+
+
+# Uniform and prioritized sampling
+perfplot.save(filename="ReplayBuffer_layout.png",
+              setup = setup,
+              time_unit="ms",
+              kernels = [sample(0),sample(1),sample(2),sample(3)],
+              labels = ["ReplayBuffer (column)",
+                        "ReplayBuffer (record)",
+                        "PrioritizedReplayBuffer (column)",
+                        "PrioritizedReplayBuffer (record)"],
+              n_range = [1,4,16,64],
+              xlabel = "Observation size",
+              title = f"Sample Speed of Memory Layout (buffer size: {buffer_size})",
+              logx = True,
+              logy = False,
+              equality_check = None)
@@ -0,0 +1,69 @@
+import multiprocessing as mp
+
+import numpy as np
+import perfplot
+
+from cpprb import ReplayBuffer, MPReplayBuffer
+
+
+# Configulation
+buffer_size = 2**16
+n_step = 2000
+obs_shape = (84,84)
+env_dict = {"obs": {"shape": obs_shape,"dtype": np.ubyte},
+            "act": {},
+            "rew": {},
+            "done": {}}
+
+
+# Helper Function
+def transition():
+    return {"obs": np.ones(obs_shape,dtype=np.ubyte),
+            "act": 1.0,
+            "rew": 0.5,
+            "done": 0.0}
+
+def queue_explorer(q):
+    for _ in range(n_step):
+        q.put(transition())
+
+def mp_explorer(rb):
+    for _ in range(n_step):
+        rb.add(**transition())
+
+def queue(n_explorers):
+    """ Explorers send transitions to learner through `multiprocessing.Queue`
+    """
+    rb = ReplayBuffer(buffer_size,env_dict)
+    q = mp.Queue()
+    ps = [mp.Process(target=queue_explorer,args=(q,)) for _ in range(n_explorers)]
+    for p in ps:
+        p.start()
+    for _ in range(n_explorers * n_step):
+        rb.add(**q.get())
+    for p in ps:
+        p.join()
+
+def shared(n_explorers):
+    """ Explorers add transitions into shared memory directly
+    """
+    rb = MPReplayBuffer(buffer_size,env_dict)
+    ps = [mp.Process(target=mp_explorer,args=(rb,)) for _ in range(n_explorers)]
+    for p in ps:
+        p.start()
+    for p in ps:
+        p.join()
+
+
+# Throughput of multiple explorers
+perfplot.save(filename="MPReplayBuffer_add.png",
+              setup = lambda n: n,
+              time_unit="s",
+              kernels = [queue,shared],
+              labels = ["ReplayBuffer + multiprocessing.Queue","MPReplayBuffer"],
+              n_range = [1,2,4,8],
+              xlabel = "Number of explorer processes",
+              title = f"Add Speed of Multiple Explorers ({n_step} steps each)",
+              logx = False,
+              logy = False,
+              equality_check = None)
@@ -0,0 +1,95 @@
+import tracemalloc
+
+import numpy as np
+import perfplot
+
+from cpprb import ReplayBuffer
+
+
+# Configulation
+buffer_size = 2**16
+obs_shape = (84,84)
+Nstep = {"size": 3,"rew": "rew","gamma": 0.99,"next": "next_obs"}
+n_step = 1000
+
+
+# Helper Function
+def env(next_of):
+    env_dict = {"obs": {"shape": obs_shape,"dtype": np.ubyte},
+                "act": {},
+                "rew": {},
+                "done": {}}
+    if not next_of:
+        env_dict["next_obs"] = {"shape": obs_shape,"dtype": np.ubyte}
+    return env_dict
+
+def create(next_of):
+    return ReplayBuffer(buffer_size,env(next_of),Nstep=dict(Nstep),
+                        next_of="obs" if next_of else None)
+
+def setup(n):
+    obs = np.random.randint(0,256,size=(n_step+1,*obs_shape)).astype(np.ubyte)
+    buffers = [create(False),create(True)]
+    for rb in buffers:
+        for i in range(buffer_size // n_step):
+            add(rb,obs)
+    return buffers, obs, n
+
+def add(rb,obs):
+    for i in range(n_step):
+        rb.add(obs=obs[i],act=1.0,rew=0.5,next_obs=obs[i+1],done=0.0)
+    rb.on_episode_end()
+
+def sample(i):
+    """ Sample `batch_size` transitions 100 times
+    """
+    def f(args):
+        buffers, _, batch_size = args
+        for _ in range(100):
+            buffers[i].sample(batch_size)
+    return f
+
+def add_episode(i):
+    """ Add an episode of `n_step` steps
+    """
+    def f(args):
+        buffers, obs, _ = args
+        add(buffers[i],obs)
+    return f
+
+
+# Memory
+for next_of in [False,True]:
+    tracemalloc.start()
+    rb = create(next_of)
+    nbytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"next_of={next_of}: {nbytes / 2**20:.1f} MiB")
+    del rb
+
+
+labels = ["Nstep + next_obs","Nstep + next_of"]
+
+perfplot.save(filename="ReplayBuffer_Nstep_next_of_sample.png",
+              setup = setup,
+              time_unit="ms",
+              kernels = [sample(0),sample(1)],
+              labels = labels,
+              n_range = [2**i for i in range(5,10)],
+              xlabel = "Batch size",
+              title = "Sample Speed of Nstep Buffer (100 times)",
+              logx = True,
+              logy = False,
+              equality_check = None)
+
+perfplot.save(filename="ReplayBuffer_Nstep_next_of_add.png",
+              setup = setup,
+              time_unit="ms",
+              kernels = [add_episode(0),add_episode(1)],
+              labels = labels,
+              n_range = [1],
+              xlabel = "",
+              title = f"Add Speed of Nstep Buffer ({n_step} steps)",
+              logx = False,
+              logy = False,
+              equality_check = None)
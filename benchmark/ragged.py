@@ -0,0 +1,73 @@
+import tracemalloc
+
+import numpy as np
+import perfplot
+
+from cpprb import ReplayBuffer
+
+
+# Configulation
+buffer_size = 2**16
+max_length = 256
+mean_length = 32
+n_sample = 100
+
+
+# Helper Function
+def lengths(n):
+    return np.random.geometric(1/mean_length,size=n).clip(1,max_length)
+
+def env(ragged):
+    if ragged:
+        return {"tok": {"ragged": True,"dtype": np.int32},"rew": {}}
+    return {"tok": {"shape": max_length,"dtype": np.int32},"rew": {}}
+
+def create(ragged):
+    rb = ReplayBuffer(buffer_size,env(ragged))
+    for _ in range(buffer_size // 256):
+        tok = [np.ones(L,dtype=np.int32) for L in lengths(256)]
+        if not ragged:
+            # Pad to the maximum
+            padded = np.zeros((256,max_length),dtype=np.int32)
+            for i, t in enumerate(tok):
+                padded[i,:t.shape[0]] = t
+            tok = padded
+        rb.add(tok=tok,rew=np.zeros(256))
+    return rb
+
+def setup(batch_size):
+    return [create(False),create(True)], batch_size
+
+def sample(i):
+    """ Sample `batch_size` transitions `n_sample` times
+    """
+    def f(args):
+        buffers, batch_size = args
+        rb = buffers[i]
+        for _ in range(n_sample):
+            rb.sample(batch_size)
+    return f
+
+
+# Memory savings
+for ragged in [False,True]:
+    tracemalloc.start()
+    rb = create(ragged)
+    nbytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{'ragged' if ragged else 'padded'}: {nbytes / 2**20:.1f} MiB")
+    del rb
+
+
+# Sample throughput
+perfplot.save(filename="ReplayBuffer_ragged.png",
+              setup = setup,
+              time_unit="ms",
+              kernels = [sample(0),sample(1)],
+              labels = ["padded to max length","ragged"],
+              n_range = [2**i for i in range(5,12)],
+              xlabel = "Batch size",
+              title = f"Sample Speed of Variable Length Values ({n_sample} times)",
+              logx = True,
+              logy = False,
+              equality_check = None)
@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+import perfplot
+
+from cpprb import PrioritizedReplayBuffer
+
+
+# Configulation
+buffer_size = 2**20
+n_sample = 10
+threads = sorted({1, 2, 4, os.cpu_count() or 1})
+
+
+# Helper Function
+def create(sample_threads):
+    rb = PrioritizedReplayBuffer(buffer_size,{"done": {}},
+                                 sample_threads=sample_threads)
+    rb.add_batch({"done": np.zeros((buffer_size,1),dtype=np.single)},
+                 priorities=np.random.uniform(0,1,buffer_size))
+    return rb
+
+buffers = [create(n) for n in threads]
+
+def sample(i):
+    """ Sample `batch_size` transitions `n_sample` times
+    """
+    def f(batch_size):
+        rb = buffers[i]
+        for _ in range(n_sample):
+            rb.sample(batch_size)
+    return f
+
+
+perfplot.save(filename="PrioritizedReplayBuffer_sample_threads.png",
+              setup = lambda n: n,
+              time_unit="ms",
+              kernels = [sample(i) for i in range(len(threads))],
+              labels = [f"sample_threads={n}" for n in threads],
+              n_range = [2**i for i in range(10,16)],
+              xlabel = "Batch size",
+              title = f"Sample Speed of Sampling Threads ({n_sample} times)",
+              logx = True,
+              logy = False,
+              equality_check = None)
@@ -0,0 +1,73 @@
+import tracemalloc
+
+import numpy as np
+import perfplot
+
+from cpprb import ReplayBuffer
+
+
+# Configulation
+buffer_size = 2**18
+obs_shape = 64
+n_sample = 100
+
+
+# Helper Function
+def env(storage):
+    obs = {"shape": obs_shape}
+    act = {"shape": 4}
+    if storage == "float16":
+        obs["storage"] = np.half
+        act["storage"] = np.half
+    elif storage == "quantize":
+        obs["quantize"] = (0.05,128)
+        act["quantize"] = (0.01,128)
+    return {"obs": obs,"act": act,"rew": {},"next_obs": dict(obs),"done": {}}
+
+storages = ["float32","float16","quantize"]
+
+def create(storage):
+    rb = ReplayBuffer(buffer_size,env(storage))
+    rb.add_batch({"obs": np.random.randn(buffer_size,obs_shape).astype(np.single),
+                  "act": np.random.uniform(-1,1,(buffer_size,4)).astype(np.single),
+                  "rew": np.ones((buffer_size,1),dtype=np.single),
+                  "next_obs": np.random.randn(buffer_size,obs_shape).astype(np.single),
+                  "done": np.zeros((buffer_size,1),dtype=np.single)})
+    return rb
+
+def setup(batch_size):
+    return [create(storage) for storage in storages], batch_size
+
+def sample(i):
+    """ Sample `batch_size` transitions `n_sample` times
+    """
+    def f(args):
+        buffers, batch_size = args
+        rb = buffers[i]
+        for _ in range(n_sample):
+            rb.sample(batch_size)
+    return f
+
+
+# Memory savings
+for storage in storages:
+    tracemalloc.start()
+    rb = ReplayBuffer(buffer_size,env(storage))
+    nbytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{storage}: {nbytes / 2**20:.1f} MiB")
+    del rb
+
+
+# Sample throughput
+perfplot.save(filename="ReplayBuffer_storage.png",
+              setup = setup,
+              time_unit="ms",
+              kernels = [sample(i) for i in range(len(storages))],
+              labels = [f"obs and act: {storage}" for storage in storages],
+              n_range = [2**i for i in range(5,13)],
+              xlabel = "Batch size",
+              title = f"Sample Speed of Storage Dtype ({n_sample} times)",
+              logx = True,
+              logy = False,
+              equality_check = None)
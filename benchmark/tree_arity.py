@@ -0,0 +1,45 @@
+import numpy as np
+import perfplot
+
+from cpprb import PrioritizedReplayBuffer
+
+
+# Configulation
+batch_size = 256
+n_sample = 100
+arities = [2, 4, 8]
+
+
+# Helper Function
+def setup(buffer_size):
+    priorities = np.random.uniform(0,1,buffer_size).astype(np.single)
+    buffers = []
+    for arity in arities:
+        rb = PrioritizedReplayBuffer(buffer_size,{"done": {}},tree_arity=arity)
+        rb.add_batch({"done": np.zeros((buffer_size,1),dtype=np.single)},
+                     priorities=priorities)
+        buffers.append(rb)
+    return buffers
+
+def sample(i):
+    """ Sample `batch_size` transitions and update their priorities `n_sample` times
+    """
+    def f(buffers):
+        rb = buffers[i]
+        for _ in range(n_sample):
+            s = rb.sample(batch_size)
+            rb.update_priorities(s["indexes"],np.random.uniform(0,1,batch_size))
+    return f
+
+
+perfplot.save(filename="PrioritizedReplayBuffer_tree_arity.png",
+              setup = setup,
+              time_unit="ms",
+              kernels = [sample(i) for i in range(len(arities))],
+              labels = [f"tree_arity={arity}" for arity in arities],
+              n_range = [2**i for i in range(16,25,2)],
+              xlabel = "Buffer size",
+              title = f"Sample and Update Speed of Sum Tree Arity ({n_sample} times)",
+              logx = True,
+              logy = False,
+              equality_check = None)
@@ -1,19 +1,35 @@
 # distutils: language = c++
 # cython: linetrace=True
 
+import contextlib
 import ctypes
+import functools
+import mmap
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 cimport numpy as np
 import numpy as np
 import cython
 from cython.operator cimport dereference
+from libc.stdint cimport uint64_t
+from libc.string cimport memcpy
+from libcpp.vector cimport vector
 
 from cpprb.ReplayBuffer cimport *
 
+from .codec import EncodedBuffer
+from .frame import FrameStore
+from .ragged import RaggedBuffer
 from .VectorWrapper cimport *
 from .VectorWrapper import (VectorWrapper,
                             VectorInt,VectorSize_t,
                             VectorDouble,PointerDouble,VectorFloat)
 
+np.import_array()
+
 cdef double [::1] Cdouble(array):
     return np.ravel(np.array(array,copy=False,dtype=np.double,ndmin=1,order='C'))
 
@@ -384,7 +400,86 @@ cdef class SelectiveReplayBuffer(SelectiveEnvironment):
         cdef idx = np.random.randint(0,self.get_stored_size(),batch_size)
         return self._encode_sample(idx)
 
-def dict2buffer(buffer_size,env_dict,*,stack_compress = None,default_dtype = None):
+cdef allocate(shape,dtype,filename = None):
+    """Allocate zero initialized array
+
+    Parameters
+    ----------
+    shape : array like of int
+        array shape
+    dtype : numpy.dtype
+        array dtype
+    filename : str, optional
+        If specified, the array is mapped to the file (.npy format). When the
+        file already exists, its contents are reused.
+
+    Returns
+    -------
+    array : numpy.ndarray
+        allocated array
+    """
+    shape = tuple(int(s) for s in shape)
+    dtype = np.dtype(dtype)
+    if filename is None:
+        return np.zeros(shape,dtype=dtype)
+
+    if os.path.exists(filename):
+        memory = np.lib.format.open_memmap(filename,mode="r+")
+        if memory.shape != shape or memory.dtype != dtype:
+            raise ValueError(f"{filename} has shape {memory.shape} and "
+                             f"dtype {memory.dtype}, which are different from "
+                             f"shape {shape} and dtype {dtype}")
+    else:
+        memory = np.lib.format.open_memmap(filename,mode="w+",
+                                           shape=shape,dtype=dtype)
+
+    # Rows are read at random indices (sampling), so that read-ahead is
+    # wasteful. (Writing at add is sequential regardless of the hint.)
+    if hasattr(mmap,"MADV_RANDOM") and memory.size:
+        memory.base.madvise(mmap.MADV_RANDOM)
+
+    return memory.view(np.ndarray)
+
+cdef void flush_array(array):
+    """Flush file mapped memory of array (if any)"""
+    while array is not None:
+        if isinstance(array,mmap.mmap):
+            array.flush()
+            return
+        array = getattr(array,"base",None)
+
+cdef storage_dtype(defs,default_dtype):
+    # dtype of stored values, which can be different from sampled values
+    if "quantize" in defs:
+        if "storage" in defs:
+            raise ValueError("'quantize' and 'storage' cannot be used together")
+        return np.dtype(np.uint8)
+    return np.dtype(defs.get("storage",defs.get("dtype",default_dtype)))
+
+cdef encode_values(v,dtype,quantize):
+    # Convert values into stored dtype at add
+    if quantize is None:
+        return np.asarray(v,dtype=dtype)
+
+    scale, zero = quantize
+    q = np.divide(np.array(v,copy=False,ndmin=1),scale,dtype=np.single)
+    np.rint(q,out=q)
+    q += zero
+    info = np.iinfo(dtype)
+    return np.clip(q,info.min,info.max,out=q).astype(dtype)
+
+cdef void decode_values(stored,out,quantize) except *:
+    # Convert stored values into sampled dtype
+    np.copyto(out,stored,casting="unsafe")
+    if quantize is None:
+        return
+
+    scale, zero = quantize
+    out -= zero
+    out *= scale
+
+def dict2buffer(buffer_size,env_dict,*,stack_compress = None,default_dtype = None,
+                num_envs = 1,layout = "column",path = None,convert = True):
     """Create buffer from env_dict
 
     Parameters
@@ -397,37 +492,204 @@ def dict2buffer(buffer_size,env_dict,*,stack_compress = None,default_dtype = Non
         compress memory of specified stacked values.
     default_dtype : numpy.dtype, optional
         fallback dtype for not specified in `env_dict`. default is numpy.single
+    num_envs : int, optional
+        number of interleaved streams. Stacked values are shared with the
+        same stream, i.e. every `num_envs` rows. default is 1
+    layout : {"column", "record"}, optional
+        memory layout. "column" allocates an independent array for each value.
+        "record" stores all the values of a transition contiguously in a
+        single structured array, and each value is its field view. (Values
+        of `stack_compress` are still allocated independently.)
+        default is "column"
+    path : str, optional
+        If specified, memory is mapped to files in the directory. Each value is
+        stored at "{name}.npy", and the structured array of "record" layout is
+        stored at "_record.npy". Existing files are reused.
+    convert : bool, optional
+        If `True` (default), values with "storage" or "quantize" in `env_dict`
+        are allocated with the stored dtype (`numpy.uint8` for "quantize").
+        Otherwise, all values are allocated with "dtype".
 
     Returns
     -------
     buffer : dict of numpy.ndarray
         buffer for environment specified by env_dict.
     """
+    if layout not in ("column", "record"):
+        raise ValueError(f"Unknown layout: {layout}")
+
     cdef buffer = {}
+    cdef records = []
     cdef bool compress_any = stack_compress
     default_dtype = default_dtype or np.single
+    filename = lambda name: None if path is None else os.path.join(path,f"{name}.npy")
     for name, defs in env_dict.items():
         shape = np.insert(np.asarray(defs.get("shape",1)),0,buffer_size)
+        dtype = (storage_dtype(defs,default_dtype) if convert
+                 else defs.get("dtype",default_dtype))
 
         if compress_any and np.isin(name,
                                     stack_compress,
                                     assume_unique=True).any():
             buffer_shape = np.insert(np.delete(shape,-1),1,shape[-1])
-            buffer_shape[0] += buffer_shape[1] - 1
+            buffer_shape[0] += (buffer_shape[1] - 1) * num_envs
             buffer_shape[1] = 1
-            memory = np.zeros(buffer_shape,
-                              dtype=defs.get("dtype",default_dtype))
-            strides = np.append(np.delete(memory.strides,1),memory.strides[1])
+            memory = allocate(buffer_shape,dtype,filename(name))
+            strides = np.append(np.delete(memory.strides,1),
+                                memory.strides[1] * num_envs)
             buffer[name] = np.lib.stride_tricks.as_strided(memory,
                                                            shape=shape,
                                                            strides=strides)
+        elif layout == "record":
+            records.append((name,dtype,tuple(shape[1:])))
+            buffer[name] = None
         else:
-            buffer[name] = np.zeros(shape,dtype=defs.get("dtype",default_dtype))
+            buffer[name] = allocate(shape,dtype,filename(name))
 
         shape[0] = -1
         defs["add_shape"] = shape
+
+    if records:
+        # Aligned fields, so that each row of a field can be copied efficiently.
+        memory = allocate((buffer_size,),np.dtype(records,align=True),
+                          filename("_record"))
+        for name, _, _ in records:
+            buffer[name] = memory[name]
+    return buffer
+
+cdef packed_offsets(layout,size_t alignment = 64):
+    # Byte offsets of aligned arrays packed in a single memory, and total size
+    cdef size_t offset = 0
+    cdef size_t nbytes
+    cdef offsets = {}
+    for name, (shape, dtype) in layout.items():
+        offsets[name] = offset
+        nbytes = np.prod(shape,dtype=np.int64) * np.dtype(dtype).itemsize
+        offset += ((nbytes + alignment - 1) // alignment) * alignment
+    return offsets, offset
+
+def packed_buffer(layout,*,alignment = 64):
+    """Create dict of numpy.ndarray sharing a single packed allocation
+
+    Parameters
+    ----------
+    layout : dict of tuple
+        `(shape, dtype)` pair for each name.
+    alignment : int, optional
+        byte alignment of each array head. default is 64 (cache line)
+
+    Returns
+    -------
+    buffer : dict of numpy.ndarray
+        arrays which are views of one packed memory.
+    """
+    offsets, nbytes = packed_offsets(layout,alignment)
+
+    cdef memory = np.empty(nbytes + alignment,dtype=np.uint8)
+    cdef size_t head = (- memory.ctypes.data) % alignment
+
+    cdef buffer = {}
+    for name, (shape, dtype) in layout.items():
+        nbytes = np.prod(shape,dtype=np.int64) * np.dtype(dtype).itemsize
+        begin = head + offsets[name]
+        buffer[name] = memory[begin:begin+nbytes].view(dtype).reshape(shape)
     return buffer
 
+cdef inline squeezed_shape(size_t batch_size,shape):
+    # Same shape as `np.squeeze` of (batch_size, *shape) array
+    return tuple(s for s in (batch_size,*shape) if s != 1)
+
+cdef inline batch_view(array,shape):
+    # Reshape `out` array without copy, so that gather can write into it.
+    cdef view = np.reshape(array,shape)
+    if not np.may_share_memory(view,array):
+        raise ValueError("`out` array must be reshapable without copy")
+    return view
+
+cdef bool has_contiguous_rows(array):
+    # Whether each row (array[i]) is C-contiguous. (Rows might be overlapped.)
+    cdef Py_ssize_t expected = array.itemsize
+    cdef size_t k
+    for k in range(array.ndim - 1, 0, -1):
+        if array.shape[k] != 1 and array.strides[k] != expected:
+            return False
+        expected *= array.shape[k]
+    return True
+
+cdef bool add_gather_field(vector[GatherField]& fields,src,dst,size_t* index,
+                           alt_src = None,Py_ssize_t* alt_index = NULL) except *:
+    """Register field for native `gather`
+
+    Returns
+    -------
+    : bool
+        `False` if the field cannot be gathered natively.
+    """
+    if not (dst.dtype == src.dtype
+            and dst.flags.c_contiguous
+            and has_contiguous_rows(src)
+            and (alt_src is None
+                 or (alt_src.dtype == src.dtype and has_contiguous_rows(alt_src)))):
+        return False
+
+    cdef np.ndarray _src = src
+    cdef np.ndarray _dst = dst
+    cdef np.ndarray _alt_src
+    cdef GatherField f
+    f.src = <const char*>np.PyArray_DATA(_src)
+    f.src_stride = _src.strides[0]
+    f.dst = <char*>np.PyArray_DATA(_dst)
+    f.row_bytes = _dst.nbytes // _dst.shape[0]
+    f.index = index
+    f.alt_src = NULL
+    f.alt_stride = 0
+    f.alt_index = NULL
+    if alt_src is not None:
+        _alt_src = alt_src
+        f.alt_src = <const char*>np.PyArray_DATA(_alt_src)
+        f.alt_stride = _alt_src.strides[0]
+        f.alt_index = alt_index
+    fields.push_back(f)
+    return True
+
+cdef bool copy_rows(np.ndarray dst,size_t dst_row,value,size_t value_rows,
+                    size_t first,size_t count,size_t row_bytes) except *:
+    """Copy `count` rows of `value` from `first` into `dst` from `dst_row`
+
+    `dst` must have C-contiguous rows of `row_bytes`.
+
+    Returns
+    -------
+    : bool
+        `False` if `value` is not array of `value_rows` C-contiguous rows with
+        the same dtype.
+    """
+    if type(value) is not np.ndarray:
+        return False
+
+    cdef np.ndarray src = value
+    if not ((<size_t>np.PyArray_NBYTES(src) == value_rows * row_bytes) and
+            np.PyArray_EquivTypes(src.descr,dst.descr)):
+        return False
+
+    # Rows of a field of structured array are strided.
+    cdef Py_ssize_t src_stride = row_bytes
+    if not np.PyArray_IS_C_CONTIGUOUS(src):
+        if not (src.ndim > 0 and <size_t>src.shape[0] == value_rows
+                and has_contiguous_rows(src)):
+            return False
+        src_stride = src.strides[0]
+
+    cdef const char* src_ptr = <const char*>np.PyArray_DATA(src) + first * src_stride
+    cdef char* dst_ptr = <char*>np.PyArray_DATA(dst) + dst_row * dst.strides[0]
+    cdef size_t i
+    if (<size_t>dst.strides[0] == row_bytes) and (<size_t>src_stride == row_bytes):
+        memcpy(dst_ptr,src_ptr,count * row_bytes)
+    else:
+        for i in range(count):
+            memcpy(dst_ptr + i * dst.strides[0],src_ptr + i * src_stride,row_bytes)
+    return True
+
 def find_array(dict,key):
     """Find 'key' and ensure numpy.ndarray with the minimum dimension of 1.
 
@@ -452,6 +714,7 @@ cdef class StepChecker:
     """
     cdef check_str
     cdef check_shape
+    cdef size_t check_size
 
     def __cinit__(self,env_dict,special_keys = None):
         special_keys = special_keys or []
@@ -460,6 +723,7 @@ cdef class StepChecker:
                 continue
             self.check_str = name
             self.check_shape = defs["add_shape"]
+            self.check_size = np.prod(defs["add_shape"][1:])
 
     def __init__(self,env_dict,special_keys = None):
         """Initialize StepChecker class.
@@ -479,7 +743,14 @@ cdef class StepChecker:
         kwargs: dict
             Added values.
         """
-        return np.reshape(kwargs[self.check_str],self.check_shape,order='A').shape[0]
+        cdef value = kwargs[self.check_str]
+        if type(value) is np.ndarray:
+            if value.size % self.check_size == 0:
+                return value.size // self.check_size
+        elif self.check_size == 1 and isinstance(value,(int,float,np.generic)):
+            return 1
+
+        return np.reshape(value,self.check_shape,order='A').shape[0]
 
 @cython.embedsignature(True)
 cdef class NstepBuffer:
@@ -507,20 +778,27 @@ cdef class NstepBuffer:
         self.stack_compress = None # stack_compress is not support yet.
         self.default_dtype = default_dtype or np.single
 
-        if next_of is not None: # next_of is not support yet.
-            for name in np.array(next_of,copy=False,ndmin=1):
-                self.env_dict[f"next_{name}"] = self.env_dict[name]
-            del self.env_dict["next_of"]
-
         self.Nstep_size = Nstep["size"]
         self.Nstep_gamma = Nstep.get("gamma",0.99)
         self.Nstep_rew = find_array(Nstep,"rew")
         self.Nstep_next = find_array(Nstep,"next")
 
+        if next_of is not None:
+            # Next values are moved as well as `Nstep["next"]`
+            next_names = [f"next_{name}"
+                          for name in np.array(next_of,copy=False,ndmin=1)]
+            for name, next_name in zip(np.array(next_of,copy=False,ndmin=1),
+                                       next_names):
+                self.env_dict[next_name] = self.env_dict[name]
+            if self.Nstep_next is not None:
+                next_names.extend(self.Nstep_next)
+            self.Nstep_next = np.unique(next_names)
+
         self.buffer_size = self.Nstep_size - 1
         self.buffer = dict2buffer(self.buffer_size,self.env_dict,
                                   stack_compress = self.stack_compress,
-                                  default_dtype = self.default_dtype)
+                                  default_dtype = self.default_dtype,
+                                  convert = False)
         self.size_check = StepChecker(self.env_dict)
 
     def __init__(self,env_dict=None,Nstep=None,*,
@@ -542,13 +820,12 @@ cdef class NstepBuffer:
         default_dtype : numpy.dtype, optional
             fallback dtype for not specified in `env_dict`. default is numpy.single
         next_of : str or array like of str, optional
-            next item of specified environemt variables (eg. next_obs for next) are
-            also sampled without duplicated values
+            next item of specified environemt variables (eg. next_obs for next)
+            are moved as well as `Nstep["next"]`.
 
         Notes
         -----
-        Currently, memory compression features (`stack_compress` and `next_of`) are
-        not supported yet. (Fall back to usual storing)
+        Values of `stack_compress` are not compressed in this local buffer.
         """
         pass
 
@@ -706,12 +983,19 @@ cdef class NstepBuffer:
 
     cpdef on_episode_end(self):
         """Terminate episode.
+
+        Returns
+        -------
+        env : dict
+            Stored values with Nstep reward calculated. Only values added at
+            this episode are returned.
         """
-        kwargs = self.buffer.copy()
+        kwargs = {name: b[:self.stored_size].copy()
+                  for name, b in self.buffer.items()}
         done = kwargs["done"]
         kwargs["discounts"] = np.where(done,1,self.Nstep_gamma)
 
-        for i in range(1,self.buffer_size):
+        for i in range(1,self.stored_size):
             done[:-i] += kwargs["done"][i:]
             kwargs["discounts"][done == 0] *= self.Nstep_gamma
 
@@ -728,6 +1012,107 @@ cdef class NstepBuffer:
         """
         return self.Nstep_size
 
+@cython.embedsignature(True)
+cdef class StreamNstepBuffer:
+    """Local buffer class for Nstep reward of multiple interleaved streams.
+
+    Each stream has its own `NstepBuffer`. Added values are rows of
+    [step, stream] order, and returned values are in the same order.
+    Returned values of each stream are queued, so that the same number of
+    values are returned from every stream even when some streams are flushed
+    at their episode ends.
+    """
+    cdef size_t num_envs
+    cdef streams
+    cdef pending
+
+    def __cinit__(self,num_envs,env_dict=None,Nstep=None,**kwargs):
+        self.num_envs = num_envs
+        self.streams = [NstepBuffer(env_dict,Nstep,**kwargs)
+                        for _ in range(num_envs)]
+        self.pending = [None for _ in range(num_envs)]
+
+    def __init__(self,num_envs,env_dict=None,Nstep=None,**kwargs):
+        """Initialize StreamNstepBuffer class.
+
+        Parameters
+        ----------
+        num_envs : int
+            number of streams
+        env_dict : dict
+            Specify environment values to be stored.
+        Nstep : dict
+            Nstep parameters passed to `NstepBuffer`
+        **kwargs
+            other parameters passed to `NstepBuffer`
+        """
+        pass
+
+    def add(self,*,**kwargs):
+        """Add envronment into local buffers.
+
+        Paremeters
+        ----------
+        **kwargs : keyword arguments
+            Values to be added, whose first axis is [step * num_envs].
+
+        Returns
+        -------
+        env : dict or None
+            Values with Nstep reward calculated. When the local buffers do not
+            store enough cache items, returns 'None'.
+        """
+        kwargs = {name: np.array(v,copy=False,ndmin=1) for name, v in kwargs.items()}
+        for i, stream in enumerate(self.streams):
+            self._push(i,stream.add(**{name: v[i::self.num_envs].copy()
+                                       for name, v in kwargs.items()}))
+
+        # Streams are returned in lockstep.
+        cdef size_t n = min(0 if p is None else p["done"].shape[0]
+                            for p in self.pending)
+        if n == 0:
+            return None
+
+        cdef outs = []
+        for i, p in enumerate(self.pending):
+            outs.append({name: v[:n] for name, v in p.items()})
+            self.pending[i] = ({name: v[n:] for name, v in p.items()}
+                               if p["done"].shape[0] > n else None)
+
+        return {name: np.stack([o[name] for o in outs],
+                               axis=1).reshape(-1,*outs[0][name].shape[1:])
+                for name in outs[0].keys()}
+
+    cdef void _push(self,size_t env,values) except *:
+        if values is None:
+            return
+
+        cdef p = self.pending[env]
+        self.pending[env] = (values if p is None else
+                             {name: np.concatenate((v,values[name]))
+                              for name, v in p.items()})
+
+    def on_episode_end(self,envs):
+        """Terminate episodes of streams.
+
+        Values stored in local buffers of the streams are flushed with Nstep
+        reward calculated, and are returned at the following `add`.
+
+        Parameters
+        ----------
+        envs : array like of int
+            streams whose episodes end
+        """
+        for i in envs:
+            self._push(i,self.streams[i].on_episode_end())
+
+    cpdef void clear(self):
+        """Clear the bufers.
+        """
+        for stream in self.streams:
+            stream.clear()
+        self.pending = [None for _ in range(self.num_envs)]
+
 @cython.embedsignature(True)
 cdef class ReplayBuffer:
     """Replay Buffer class to store environments and to sample them randomly.
@@ -740,23 +1125,50 @@ cdef class ReplayBuffer:
     """
     cdef buffer
     cdef size_t buffer_size
+    cdef size_t max_size
     cdef env_dict
     cdef size_t index
     cdef size_t stored_size
     cdef next_of
     cdef bool has_next_of
     cdef next_
+    cdef size_t next_shift
+    cdef size_t next_head
     cdef bool compress_any
     cdef stack_compress
-    cdef cache
+    cdef bool has_cache
+    cdef cache_values
+    cdef cache_row
+    cdef next_row
+    cdef free_rows
+    cdef size_t n_cached
     cdef default_dtype
     cdef StepChecker size_check
-    cdef NstepBuffer nstep
+    cdef nstep
     cdef bool use_nstep
+    cdef layout
+    cdef path
+    cdef encoded
+    cdef decode_pool
+    cdef frames
+    cdef ragged
+    cdef converts
+    cdef size_t num_envs
+    cdef add_fields
+    cdef add_next_fields
+    cdef batches
+    cdef size_t gather_threads
+    cdef lock
+    cdef cond
+    cdef prefetcher
+    cdef slot_gen
+    cdef size_t write_gen
 
     def __cinit__(self,size,env_dict=None,*,
                   next_of=None,stack_compress=None,default_dtype=None,Nstep=None,
-                  **kwargs):
+                  gather_threads=1,num_envs=1,layout="column",
+                  storage="memory",path=None,
+                  frame_store=None,frame_axis=-1,initial_size=None,**kwargs):
         self.env_dict = env_dict or {}
         cdef special_keys = []
 
@@ -764,39 +1176,188 @@ cdef class ReplayBuffer:
         self.stored_size = 0
         self.index = 0
 
+        if storage == "memory":
+            self.path = None
+        elif storage == "mmap":
+            if path is None:
+                raise ValueError("`storage='mmap'` requires `path`")
+            self.path = os.fspath(path)
+            os.makedirs(self.path,exist_ok=True)
+        else:
+            raise ValueError(f"Unknown storage: {storage}")
+
+        self.layout = layout
+        self.num_envs = num_envs
+        if self.num_envs < 1 or self.buffer_size % self.num_envs:
+            raise ValueError(f"`size` ({size}) must be multiple of "
+                             f"`num_envs` ({num_envs})")
+
+        # Buffer grows lazily from `initial_size` up to `size`
+        self.max_size = self.buffer_size
+        if initial_size is not None:
+            if self.path is not None:
+                raise NotImplementedError("`initial_size` does not support "
+                                          "`storage='mmap'`")
+            if (initial_size < 1 or initial_size > size or
+                initial_size % self.num_envs):
+                raise ValueError(f"`initial_size` ({initial_size}) must be "
+                                 f"multiple of `num_envs` ({num_envs}) "
+                                 f"and not larger than `size` ({size})")
+            self.buffer_size = initial_size
+
         self.compress_any = stack_compress
         self.stack_compress = np.array(stack_compress,ndmin=1,copy=False)
 
         self.default_dtype = default_dtype or np.single
 
+        if self.num_envs > 1 and (next_of or stack_compress or frame_store):
+            if "done" not in self.env_dict:
+                raise ValueError("`num_envs` with `next_of`, `stack_compress` "
+                                 "or `frame_store` requires 'done' in `env_dict`")
+            if Nstep:
+                raise NotImplementedError("`num_envs` with `Nstep` does not "
+                                          "support `next_of` or `stack_compress`")
+
         self.use_nstep = Nstep
         if self.use_nstep:
-            self.nstep = NstepBuffer(self.env_dict,Nstep,
-                                     stack_compress = self.stack_compress,
-                                     next_of = self.next_of,
-                                     default_dtype = self.default_dtype)
+            if self.num_envs > 1:
+                self.nstep = StreamNstepBuffer(self.num_envs,self.env_dict,Nstep,
+                                               stack_compress = self.stack_compress,
+                                               next_of = next_of,
+                                               default_dtype = self.default_dtype)
+            else:
+                self.nstep = NstepBuffer(self.env_dict,Nstep,
+                                         stack_compress = self.stack_compress,
+                                         next_of = next_of,
+                                         default_dtype = self.default_dtype)
             self.env_dict["discounts"] = {"dtype": np.single}
             special_keys.append("discounts")
 
+        # Values with "codec" are encoded row by row out of `self.buffer`
+        self.encoded = {}
+        self.decode_pool = None
+        for name, defs in self.env_dict.items():
+            if "codec" not in defs:
+                continue
+            if (np.isin(name,np.array(next_of,ndmin=1,copy=False)).any() or
+                np.isin(name,self.stack_compress).any()):
+                raise ValueError(f"'{name}' with 'codec' cannot be compressed "
+                                 "by `next_of` or `stack_compress`")
+            if self.path is not None:
+                raise NotImplementedError("'codec' does not support "
+                                          "`storage='mmap'`")
+            shape = np.insert(np.asarray(defs.get("shape",1)),0,-1)
+            self.encoded[name] = EncodedBuffer(self.buffer_size,shape[1:],
+                                               defs.get("dtype",self.default_dtype),
+                                               defs["codec"])
+            defs["add_shape"] = shape
+
+        # Stacked frames are deduplicated out of `self.buffer`
+        self.frames = {}
+        if frame_store:
+            if Nstep:
+                raise NotImplementedError("`frame_store` does not support `Nstep`")
+            if self.path is not None:
+                raise NotImplementedError("`frame_store` does not support "
+                                          "`storage='mmap'`")
+
+            next_names = np.array(next_of,ndmin=1,copy=False)
+            for name in np.array(frame_store,ndmin=1,copy=False):
+                defs = self.env_dict[name]
+                if np.isin(name,self.stack_compress).any() or name in self.encoded:
+                    raise ValueError(f"'{name}' of `frame_store` cannot be "
+                                     "compressed by `stack_compress` or 'codec'")
+                shape = np.insert(np.asarray(defs.get("shape",1)),0,-1)
+                self.frames[name] = FrameStore(self.buffer_size,shape[1:],
+                                               defs.get("dtype",self.default_dtype),
+                                               axis = frame_axis,
+                                               num_envs = self.num_envs,
+                                               next = np.isin(name,next_names).any())
+                defs["add_shape"] = shape
+
+            next_of = [name for name in next_names
+                       if name is not None and name not in self.frames] or None
+
+        # Variable length values are packed out of `self.buffer`
+        self.ragged = {}
+        for name, defs in self.env_dict.items():
+            if not defs.get("ragged"):
+                continue
+            if (np.isin(name,np.array(next_of,ndmin=1,copy=False)).any() or
+                np.isin(name,self.stack_compress).any() or
+                name in self.encoded or name in self.frames):
+                raise ValueError(f"'{name}' with 'ragged' cannot be compressed "
+                                 "by `next_of`, `stack_compress`, `frame_store` "
+                                 "or 'codec'")
+            if Nstep:
+                raise NotImplementedError("'ragged' does not support `Nstep`")
+            if self.path is not None:
+                raise NotImplementedError("'ragged' does not support "
+                                          "`storage='mmap'`")
+            # "shape" is the shape of each element.
+            shape = np.array(defs["shape"],ndmin=1) if "shape" in defs else ()
+            self.ragged[name] = RaggedBuffer(self.buffer_size,shape,
+                                             defs.get("dtype",self.default_dtype),
+                                             format = ("padded" if defs["ragged"] is True
+                                                       else defs["ragged"]))
+            special_keys.append(name)
+
+        if self.ragged and len(special_keys) >= len(self.env_dict):
+            raise ValueError("`env_dict` requires at least one fixed shape value "
+                             "other than 'ragged' ones")
+
         # side effect: Add "add_shape" key into self.env_dict
-        self.buffer = dict2buffer(self.buffer_size,self.env_dict,
+        self.buffer = dict2buffer(self.buffer_size,
+                                  {name: defs for name, defs in self.env_dict.items()
+                                   if name not in self.encoded and
+                                   name not in self.frames and
+                                   name not in self.ragged},
                                   stack_compress = self.stack_compress,
-                                  default_dtype = self.default_dtype)
+                                  default_dtype = self.default_dtype,
+                                  num_envs = self.num_envs,
+                                  layout = self.layout,
+                                  path = self.path)
 
         self.size_check = StepChecker(self.env_dict,special_keys)
 
+        # Values stored with different dtype: {name: (sampled dtype, quantize)}
+        self.converts = {}
+        for name, b in self.buffer.items():
+            defs = self.env_dict[name]
+            dtype = np.dtype(defs.get("dtype",self.default_dtype))
+            if dtype != b.dtype:
+                self.converts[name] = (dtype,defs.get("quantize"))
+
         self.next_of = np.array(next_of,ndmin=1,copy=False)
         self.has_next_of = next_of
         self.next_ = {}
-        self.cache = {} if (self.has_next_of or self.compress_any) else None
 
-        if self.has_next_of:
-            for name in self.next_of:
-                self.next_[name] = self.buffer[name][0].copy()
+        # Next values of slot i are at slot (i + next_shift).
+        self.next_shift = self.num_envs
+        if self.use_nstep:
+            self.next_shift *= Nstep["size"]
+        self.next_head = 0
+        self.has_cache = (self.has_next_of or self.compress_any)
+        if self.has_cache:
+            self._init_cache()
+
+        self._init_add_fields()
+
+        self.batches = {}
+        self.gather_threads = gather_threads
+
+        self.lock = threading.RLock()
+        self.cond = threading.Condition(self.lock)
+        self.prefetcher = None
+
+        if self.path is not None:
+            self._load_state()
 
     def __init__(self,size,env_dict=None,*,
                  next_of=None,stack_compress=None,default_dtype=None,Nstep=None,
-                 **kwargs):
+                 gather_threads=1,num_envs=1,layout="column",
+                 storage="memory",path=None,
+                 frame_store=None,frame_axis=-1,initial_size=None,**kwargs):
         """Initialize ReplayBuffer
 
         Parameters
@@ -809,7 +1370,8 @@ cdef class ReplayBuffer:
             defines "shape" (default 1) and "dtypes" (fallback to `default_dtype`)
         next_of : str or array like of str, optional
             next item of specified environemt variables (eg. next_obs for next) are
-            also sampled without duplicated values
+            also sampled without duplicated values. With `Nstep`, the next item
+            is the item after Nstep size steps.
         stack_compress : str or array like of str, optional
             compress memory of specified stacked values.
         default_dtype : numpy.dtype, optional
@@ -820,6 +1382,67 @@ cdef class ReplayBuffer:
             Nstep reward to be summed. `Nstep["gamma"]` is float specifying
             discount factor, its default is 0.99. `Nstep["next"]` is `str` or
             list of `str` specifying next values to be moved.
+        gather_threads : int, optional
+            max number of threads to gather large batch at sampling, and to
+            decode values with "zlib" codec. default is 1.
+        num_envs : int, optional
+            number of environments (streams) added together in lockstep, e.g.
+            vectorized environments. Each `add` takes values whose first axis
+            is `num_envs`, and episode ends of each stream are detected from
+            'done'. Truncated episodes are notified by `on_episode_end(envs)`.
+            `size` must be multiple of `num_envs`. default is 1.
+        layout : {"column", "record"}, optional
+            memory layout of the buffer. "column" stores each value in its own
+            array. "record" stores each transition contiguously in a single
+            structured array, which reduces cache misses at random sampling of
+            large buffer. Sampled values are same in both layouts.
+            default is "column".
+        storage : {"memory", "mmap"}, optional
+            "mmap" maps the buffer to files under `path` (`numpy.memmap`), so
+            that the buffer can be larger than RAM. When the files already
+            exist, the buffer is restored from them at the last `flush()`.
+            default is "memory".
+        path : str or os.PathLike, optional
+            directory of files for `storage="mmap"`.
+        frame_store : str or array like of str, optional
+            stacked frames of specified values are stored deduplicated. Each
+            unique frame is stored once, and stacks are assembled at sampling.
+            Unlike `stack_compress`, any stack axis and `num_envs > 1` are
+            supported, and no cache is required at episode ends. Frames filled
+            with zeros are not stored. When it is also in `next_of`, the next
+            stacks are sampled, too.
+        frame_axis : int, optional
+            stack axis of `frame_store` values. default is -1.
+        initial_size : int, optional
+            If specified, the buffer is allocated with `initial_size` at first,
+            and grows geometrically (doubles) when it is filled, up to `size`.
+            Must be multiple of `num_envs`. default is `None` (allocate `size`).
+
+        Notes
+        -----
+        A value of `env_dict` with "codec" (e.g. `"codec": "zlib"`) is stored
+        row by row compressed, and decoded at sampling. Available codecs are
+        "zlib" and "rle" (run length encoding of differences for integer
+        dtypes). Any `cpprb.codec.Codec` instance can be also used. Only
+        "zlib", whose decompression releases GIL, is decoded over
+        `gather_threads` threads. The others are decoded serially.
+
+        A value with "storage" (e.g. `{"dtype": np.single, "storage": np.half}`)
+        is stored with the lower precision dtype, and a value with "quantize"
+        (`(scale, zero)` pair) is stored as `numpy.uint8` of
+        `round(x / scale) + zero`. Both are converted back into "dtype" at
+        sampling.
+
+        A value with "ragged" (e.g. `{"ragged": True, "dtype": np.int32}`) has
+        variable length, and "shape" specifies the shape of each element
+        (default scalar). Its elements are packed into a growing ring (arena).
+        `add` takes a sequence of values (or a single value for a single step)
+        whose shapes are (length, *shape). By default (`"ragged": True` or
+        `"padded"`), a zero padded batch with shape of
+        (batch size, max length, *shape) and "{name}_lengths" are sampled.
+        With `"ragged": "flat"`, concatenated values and "{name}_offsets"
+        (batch size + 1) are sampled. Ragged values are not preallocated by
+        `create_batch`.
         """
         pass
 
@@ -838,35 +1461,237 @@ cdef class ReplayBuffer:
             the stored first index. If all values store into NstepBuffer and
             no values store into main buffer, return None.
         """
-        if self.use_nstep:
-            kwargs = self.nstep.add(**kwargs)
-            if kwargs is None:
-                return
-
-        cdef size_t N = self.size_check.step_size(kwargs)
+        cdef size_t N
+        cdef index
+        with self.lock:
+            if self.use_nstep:
+                kwargs = self.nstep.add(**kwargs)
+                if kwargs is None:
+                    return
+
+            N = self.size_check.step_size(kwargs)
+            self._check_streams(N)
+            index = self._store(kwargs,N)
+            if self.num_envs > 1 and self.has_cache:
+                self._stream_episode_end(kwargs["done"])
+            return index
+
+    def add_batch(self,arrays,*,unchecked=True):
+        """Add already shaped and typed arrays into replay buffer.
+
+        Each field is copied into the ring by at most two memcpy, when it is
+        C-contiguous (or a field of structured array) with the buffer dtype.
 
-        cdef size_t index = self.index
-        cdef size_t end = index + N
-        cdef size_t remain = 0
-        cdef add_idx = np.arange(index,end)
+        Parameters
+        ----------
+        arrays : dict of numpy.ndarray or numpy.ndarray
+            values whose shapes are [N, *shape]. Structured array with
+            field names of environments (and `next_` ones) is also accepted.
+        unchecked : bool, optional
+            If `True` (default), shapes and dtypes are trusted. Otherwise they
+            are checked for debugging.
 
-        if end > self.buffer_size:
-            remain = end - self.buffer_size
-            add_idx[add_idx >= self.buffer_size] -= self.buffer_size
+        Returns
+        -------
+        : int or None
+            the stored first index. If all values store into NstepBuffer and
+            no values store into main buffer, return None.
 
-        for name, b in self.buffer.items():
-            b[add_idx] = np.reshape(np.array(kwargs[name],copy=False,ndmin=2),
-                                    self.env_dict[name]["add_shape"])
+        Raises
+        ------
+        ValueError
+            If `unchecked=False` and any shape or dtype is incompatible.
+        """
+        if self.use_nstep:
+            return self.add(**self._batch_kwargs(arrays))
+
+        cdef size_t N = arrays[self.size_check.check_str].shape[0]
+        if not unchecked:
+            self._check_batch(arrays,N)
+        self._check_streams(N)
+
+        cdef index
+        with self.lock:
+            index = self._store(arrays,N)
+            if self.num_envs > 1 and self.has_cache:
+                self._stream_episode_end(arrays["done"])
+            return index
+
+    cdef void _check_streams(self,size_t N) except *:
+        if self.num_envs == 1:
+            return
+
+        if N % self.num_envs:
+            raise ValueError(f"Step size ({N}) must be multiple of "
+                             f"`num_envs` ({self.num_envs})")
+        if self.has_cache and N != self.num_envs:
+            # Episode ends inside a single addition cannot be cached.
+            raise ValueError(f"`next_of` or `stack_compress` requires a single "
+                             f"step of `num_envs` ({self.num_envs}) values")
+
+    cdef void _stream_episode_end(self,done) except *:
+        cdef envs = np.flatnonzero(np.ravel(done))
+        if envs.shape[0]:
+            self.add_cache(envs)
+
+    cdef _episode_envs(self,envs):
+        if envs is None:
+            return np.arange(self.num_envs)
+
+        envs = np.unique(np.array(envs,copy=False,ndmin=1))
+        if envs.shape[0] and (envs[0] < 0 or envs[-1] >= self.num_envs):
+            raise ValueError(f"`envs` ({envs}) must be in [0, {self.num_envs})")
+        return envs
+
+    def _batch_kwargs(self,arrays):
+        cdef kwargs = {name: arrays[name]
+                       for name in (*self.buffer.keys(),*self.encoded.keys(),
+                                    *self.frames.keys(),*self.ragged.keys())
+                       if name != "discounts"}
+        for name, next_name, _, _ in self.add_next_fields:
+            kwargs[next_name] = arrays[next_name]
+        for name, f in self.frames.items():
+            if f.next:
+                kwargs[f"next_{name}"] = arrays[f"next_{name}"]
+        return kwargs
 
+    def _check_batch(self,arrays,size_t N):
+        cdef names = [(name,name,b) for name, b in self.buffer.items()]
+        names.extend((next_name,name,self.buffer[name])
+                     for name, next_name, _, _ in self.add_next_fields)
+        names.extend((name,name,np.empty((0,*e.shape),dtype=e.dtype))
+                     for name, e in self.encoded.items())
+        names = [(key,name,np.empty((0,*b.shape[1:]),dtype=self.converts[name][0])
+                  if name in self.converts else b) for key, name, b in names]
+        for name, f in self.frames.items():
+            b = np.empty((0,*f.shape),dtype=f.dtype)
+            names.append((name,name,b))
+            if f.next:
+                names.append((f"next_{name}",name,b))
+
+        for key, name, b in names:
+            v = arrays[key]
+            if v.shape != (N,*self.env_dict[name]["add_shape"][1:]):
+                raise ValueError(f"'{key}' shape {v.shape} is incompatible "
+                                 f"with {(N,*b.shape[1:])}")
+            if v.dtype != b.dtype:
+                raise ValueError(f"'{key}' dtype {v.dtype} is incompatible "
+                                 f"with {b.dtype}")
+
+        for name in self.ragged:
+            if len(arrays[name]) != N:
+                raise ValueError(f"'{name}' has {len(arrays[name])} values, "
+                                 f"which is incompatible with {N}")
+
+    cdef void _init_add_fields(self):
+        # Precomputed layouts for add:
+        # (name, buffer, whether rows are C-contiguous, row bytes, add shape,
+        #  conversion)
+        self.add_fields = [(name,b,has_contiguous_rows(b),b[0].nbytes,
+                            tuple(self.env_dict[name]["add_shape"]),
+                            self.converts.get(name))
+                           for name, b in self.buffer.items()]
+        self.add_next_fields = []
         if self.has_next_of:
-            for name in self.next_of:
-                self.next_[name][...]=np.reshape(np.array(kwargs[f"next_{name}"],
-                                                          copy=False,
-                                                          ndmin=2),
-                                                 self.env_dict[name]["add_shape"])[-1]
-
-        if (self.cache is not None) and (index in self.cache):
-            del self.cache[index]
+            self.add_next_fields = [(name,f"next_{name}",
+                                     tuple(self.env_dict[name]["add_shape"]),
+                                     self.converts.get(name))
+                                    for name in self.next_of]
+
+    cdef _store(self,values,size_t N):
+        cdef size_t index
+        cdef size_t end
+        cdef size_t remain = 0
+        cdef size_t first
+        cdef size_t row_bytes
+        cdef bool contiguous
+        cdef slots
+        cdef size_t new_size
+        cdef size_t max_size = self.max_size
+
+        if (self.buffer_size < max_size and
+            self.stored_size + N > self.buffer_size):
+            # Lazy growth (doubling) up to `max_size`
+            new_size = max(2 * self.buffer_size,self.stored_size + N)
+            new_size += (self.num_envs - new_size % self.num_envs) % self.num_envs
+            self.resize(min(new_size,max_size))
+            self.max_size = max_size
+
+        index = self.index
+        end = index + N
+        if end > self.buffer_size:
+            remain = end - self.buffer_size
+            slots = np.arange(index,end)
+            slots[slots >= self.buffer_size] -= self.buffer_size
+        else:
+            slots = slice(index,end)
+        first = N - remain
+
+        for name, b, contiguous, row_bytes, shape, convert in self.add_fields:
+            v = values[name]
+            if convert is not None:
+                v = encode_values(v,b.dtype,convert[1])
+            if contiguous and N <= self.buffer_size:
+                # Fast path: at most 2 memcpy without temporary array
+                if copy_rows(b,index,v,N,0,first,row_bytes):
+                    if remain:
+                        copy_rows(b,0,v,N,first,remain,row_bytes)
+                    continue
+
+            if type(v) is not np.ndarray:
+                if (N == 1 and row_bytes == b.itemsize and
+                    isinstance(v,(int,float,np.generic))):
+                    b[index] = v
+                    continue
+                v = np.array(v,copy=False,ndmin=2)
+
+            b[slots] = v.reshape(shape)
+
+        for name, e in self.encoded.items():
+            e.store(np.arange(index,end) % self.buffer_size,
+                    np.reshape(np.array(values[name],copy=False,ndmin=2),
+                               self.env_dict[name]["add_shape"]))
+
+        for name, f in self.frames.items():
+            shape = self.env_dict[name]["add_shape"]
+            f.store(np.arange(index,end) % self.buffer_size,
+                    np.reshape(np.array(values[name],copy=False,ndmin=2),shape),
+                    np.reshape(np.array(values[f"next_{name}"],copy=False,ndmin=2),
+                               shape) if f.next else None,
+                    values["done"] if self.num_envs > 1 else None)
+
+        for name, r in self.ragged.items():
+            r.store(np.arange(index,end) % self.buffer_size,r.rows(values[name],N))
+
+        # The latest next values of each stream
+        # The latest `next_shift` next values in a ring
+        cdef size_t S = self.next_shift
+        cdef size_t n_next = min(N,S)
+        cdef size_t next_row = (self.next_head + N - n_next) % S
+        cdef size_t n_first = min(n_next,S - next_row)
+        for name, next_name, shape, convert in self.add_next_fields:
+            v = values[next_name]
+            if convert is not None:
+                v = encode_values(v,self.buffer[name].dtype,convert[1])
+            next_ = self.next_[name]
+            row_bytes = next_.nbytes // S
+            if not (copy_rows(next_,next_row,v,N,N-n_next,n_first,row_bytes) and
+                    (n_first == n_next or
+                     copy_rows(next_,0,v,N,N-n_next+n_first,n_next-n_first,
+                               row_bytes))):
+                v = np.reshape(np.array(v,copy=False,ndmin=2),shape)[N-n_next:]
+                next_[next_row:next_row+n_first] = v[:n_first]
+                next_[:n_next-n_first] = v[n_first:]
+        self.next_head = (self.next_head + N) % S
+
+        if self.n_cached:
+            self._release_cache(slots)
+
+        if self.prefetcher is not None:
+            # Mark overwritten slots for batches drawn in advance
+            self.write_gen += 1
+            self.slot_gen[slots] = self.write_gen
+            self.cond.notify_all()
 
         self.stored_size = min(self.stored_size + N,self.buffer_size)
         self.index = end if end < self.buffer_size else remain
@@ -884,415 +1709,2206 @@ cdef class ReplayBuffer:
         transitions : dict of numpy.ndarray
             All transitions stored in this replay buffer.
         """
-        return self._encode_sample(np.arange(self.get_stored_size()))
+        with self.lock:
+            return self._encode_sample(np.arange(self.get_stored_size()))
 
-    def _encode_sample(self,idx):
-        cdef sample = {}
+    cdef _sample_dtype(self,name):
+        if name in self.converts:
+            return self.converts[name][0]
+        return self.buffer[name].dtype
+
+    def _batch_layout(self,size_t batch_size):
+        cdef layout = {}
+        for name, b in self.buffer.items():
+            layout[name] = (squeezed_shape(batch_size,b.shape[1:]),
+                            self._sample_dtype(name))
+
+        if self.has_next_of:
+            for name in self.next_of:
+                b = self.buffer[name]
+                layout[f"next_{name}"] = ((batch_size,*b.shape[1:]),
+                                          self._sample_dtype(name))
+
+        for name, e in self.encoded.items():
+            layout[name] = (squeezed_shape(batch_size,e.shape),e.dtype)
+
+        for name, f in self.frames.items():
+            layout[name] = (squeezed_shape(batch_size,f.shape),f.dtype)
+            if f.next:
+                layout[f"next_{name}"] = ((batch_size,*f.shape),f.dtype)
+
+        return layout
+
+    def create_batch(self,batch_size):
+        """Create reusable batch to be passed to `sample(..., out=batch)`
+
+        All the values are views of a single packed memory allocation, so that
+        sampled values are gathered into them without any new allocation.
+
+        Parameters
+        ----------
+        batch_size : int
+            batch size
+
+        Returns
+        -------
+        batch : dict of numpy.ndarray
+            preallocated batch whose shapes and dtypes are same as `sample()`
+        """
+        return packed_buffer(self._batch_layout(batch_size))
+
+    cdef _owned_batch(self,size_t batch_size):
+        if batch_size not in self.batches:
+            self.batches[batch_size] = self.create_batch(batch_size)
+        return self.batches[batch_size]
+
+    def _encode_sample(self,idx,out=None):
+        cdef sample = {} if out is None else out
+        cdef vector[GatherField] fields
+        cdef fallback = []
+        cdef keep = []
+        cdef decode = []
+        cdef size_t [::1] _idx
+        cdef size_t [::1] _next_idx
+        cdef Py_ssize_t [::1] _alt_idx
         cdef next_idx
-        cdef cache_idx
-        cdef bool use_cache
+        cdef alt_idx
+        cdef alt_src
 
         idx = np.array(idx,copy=False,ndmin=1)
+        cdef size_t batch_size = idx.shape[0]
+        cdef bool native = (batch_size > 0)
+        _idx = Csize(idx)
+
         for name, b in self.buffer.items():
-            sample[name] = np.squeeze(b[idx])
+            if out is None:
+                v = np.empty((batch_size,*b.shape[1:]),dtype=self._sample_dtype(name))
+                sample[name] = np.squeeze(v)
+            else:
+                v = batch_view(out[name],(batch_size,*b.shape[1:]))
+
+            if name in self.converts:
+                # Gathered as stored, then converted
+                decode.append((np.empty((batch_size,*b.shape[1:]),dtype=b.dtype),
+                               v,self.converts[name][1]))
+                v = decode[-1][0]
+
+            alt_idx = None
+            alt_src = None
+            if self.n_cached and name in self.cache_values:
+                alt_idx = self.cache_row[idx]
+                if (alt_idx >= 0).any():
+                    alt_src = self.cache_values[name]
+                    keep.append(alt_idx)
+                    _alt_idx = alt_idx
+                else:
+                    alt_idx = None
+
+            if not (native and
+                    add_gather_field(fields,b,v,&_idx[0],alt_src,
+                                     &_alt_idx[0] if alt_src is not None else NULL)):
+                fallback.append((b,v,idx,alt_src,alt_idx))
 
         if self.has_next_of:
-            next_idx = idx + 1
-            next_idx[next_idx == self.get_buffer_size()] = 0
-            cache_idx = (next_idx == self.get_next_index())
-            use_cache = cache_idx.any()
+            # The next item of the same stream
+            next_idx = idx + self.next_shift
+            next_idx[next_idx >= self.buffer_size] -= self.buffer_size
+            _next_idx = Csize(next_idx)
+            keep.append(next_idx)
+
+            # Substitution priority:
+            #   episode end cache > the latest next > stack_compress cache
+            next_alt = (next_idx + self.buffer_size - self.index) % self.buffer_size
+            next_alt = np.where(next_alt < self.next_shift,
+                                (next_alt + self.next_head) % self.next_shift,-1)
+            if self.n_cached:
+                next_alt = np.where(next_alt >= 0,next_alt,self.next_row[idx])
 
             for name in self.next_of:
-                sample[f"next_{name}"] = self.buffer[name][next_idx]
-                if use_cache:
-                    sample[f"next_{name}"][cache_idx] = self.next_[name]
-
-        cdef size_t i
-        if self.cache is not None:
-            for i in idx:
-                if i in self.cache:
-                    if self.has_next_of:
-                        for name in self.next_of:
-                            sample[f"next_{name}"][i] = self.cache[i][f"next_{name}"]
-                    if self.compress_any:
-                        for name in self.stack_compress:
-                            sample[name][i] = self.cache[i][name]
+                b = self.buffer[name]
+                if out is None:
+                    v = np.empty((batch_size,*b.shape[1:]),
+                                 dtype=self._sample_dtype(name))
+                    sample[f"next_{name}"] = v
+                else:
+                    v = batch_view(out[f"next_{name}"],(batch_size,*b.shape[1:]))
+
+                if name in self.converts:
+                    decode.append((np.empty((batch_size,*b.shape[1:]),dtype=b.dtype),
+                                   v,self.converts[name][1]))
+                    v = decode[-1][0]
+
+                alt_idx = next_alt
+                if self.n_cached and self.compress_any and np.isin(name,self.stack_compress):
+                    alt_idx = np.where(alt_idx >= 0,alt_idx,self.cache_row[next_idx])
+
+                alt_src = None
+                if (alt_idx >= 0).any():
+                    alt_idx = alt_idx.astype(np.intp,copy=False)
+                    alt_src = self.cache_values[name]
+                    keep.append(alt_idx)
+                    _alt_idx = alt_idx
+                else:
+                    alt_idx = None
 
+                if not (native and
+                        add_gather_field(fields,b,v,&_next_idx[0],alt_src,
+                                         &_alt_idx[0] if alt_src is not None else NULL)):
+                    fallback.append((b,v,next_idx,alt_src,alt_idx))
+
+        with nogil:
+            gather(fields,batch_size,self.gather_threads)
+
+        for b, v, fallback_idx, alt_src, alt_idx in fallback:
+            np.take(b,fallback_idx.astype(np.intp,copy=False),axis=0,out=v)
+            if alt_src is not None:
+                use_alt = (alt_idx >= 0)
+                v[use_alt] = alt_src[alt_idx[use_alt]]
+
+        for stored, v, quantize in decode:
+            decode_values(stored,v,quantize)
+
+        for name, e in self.encoded.items():
+            if out is None:
+                v = np.empty((batch_size,*e.shape),dtype=e.dtype)
+                sample[name] = np.squeeze(v)
+            else:
+                v = batch_view(out[name],(batch_size,*e.shape))
+            self._decode(e,idx,v)
+
+        for name, f in self.frames.items():
+            next_v = None
+            if out is None:
+                v = np.empty((batch_size,*f.shape),dtype=f.dtype)
+                sample[name] = np.squeeze(v)
+                if f.next:
+                    next_v = np.empty((batch_size,*f.shape),dtype=f.dtype)
+                    sample[f"next_{name}"] = next_v
+            else:
+                v = batch_view(out[name],(batch_size,*f.shape))
+                if f.next:
+                    next_v = batch_view(out[f"next_{name}"],(batch_size,*f.shape))
+            f.gather(idx,v,next_v)
+
+        self._gather_ragged(idx,sample)
         return sample
 
-    def sample(self,batch_size):
+    cdef void _gather_ragged(self,idx,sample) except *:
+        # Ragged values are allocated at every sampling.
+        for name, r in self.ragged.items():
+            v, extra = r.gather(idx)
+            sample[name] = v
+            if r.format == "padded":
+                sample[f"{name}_lengths"] = extra
+            else:
+                sample[f"{name}_offsets"] = extra
+
+    cdef void _split_ragged(self,sample,shape) except *:
+        # Padded ragged values of flattened batches into `shape`
+        for name, r in self.ragged.items():
+            if r.format == "padded":
+                v = sample[name]
+                sample[name] = v.reshape(*shape,*v.shape[1:])
+                sample[f"{name}_lengths"] = sample[f"{name}_lengths"].reshape(shape)
+
+    cdef void _decode(self,e,idx,v) except *:
+        if self.gather_threads > 1 and self.decode_pool is None:
+            self.decode_pool = ThreadPoolExecutor(self.gather_threads)
+        e.decode(idx,v,self.decode_pool,self.gather_threads)
+
+    def sample(self,batch_size,*,out=None):
         """Sample the stored environment randomly with speciped size
 
         Parameters
         ----------
         batch_size : int
             sampled batch size
+        out : dict of numpy.ndarray or bool, optional
+            If dict (e.g. created by `create_batch`), sampled values are written
+            into it. If `True`, a batch owned by this buffer is reused, which
+            is overwritten by the next `sample(..., out=True)` call.
 
         Returns
         -------
         sample : dict of ndarray
             batch size of samples, which might contains the same event multiple times.
         """
-        cdef idx = np.random.randint(0,self.get_stored_size(),batch_size)
-        return self._encode_sample(idx)
+        if (out is None or out is True) and self.prefetcher is not None:
+            if self.prefetcher.match(batch_size,{}):
+                return self.prefetcher.get()
 
-    cpdef void clear(self) except *:
-        """Clear replay buffer.
+        if out is True:
+            out = self._owned_batch(batch_size)
+        elif out is False:
+            out = None
 
-        Set `index` and `stored_size` to 0.
+        with self.lock:
+            return self._draw(batch_size,out)[0]
 
-        Example
-        -------
-        >>> rb = ReplayBuffer(5,{"done",{}})
-        >>> rb.add(1)
-        >>> rb.get_stored_size()
-        1
-        >>> rb.get_next_index()
-        1
-        >>> rb.clear()
-        >>> rb.get_stored_size()
-        0
-        >>> rb.get_next_index()
-        0
-        """
-        self.index = 0
-        self.stored_size = 0
+    def _draw(self,batch_size,out):
+        cdef idx = np.random.randint(0,self.get_stored_size(),batch_size)
+        return self._encode_sample(idx,out), idx
 
-        if self.use_nstep:
-            self.nstep.clear()
+    def _stacked_batch(self,size_t n_batches,size_t batch_size):
+        return packed_buffer({name: ((n_batches,*shape),dtype)
+                              for name, (shape,dtype)
+                              in self._batch_layout(batch_size).items()})
 
-    cpdef size_t get_stored_size(self):
-        """Get stored size
+    def sample_many(self,n_batches,batch_size):
+        """Sample multiple batches at once
 
-        Returns
-        -------
-        size_t
-            stored size
-        """
-        return self.stored_size
+        Indexes of all the batches are drawn at once and gathered in a single
+        pass.
 
-    cpdef size_t get_buffer_size(self):
-        """Get buffer size
+        Parameters
+        ----------
+        n_batches : int
+            number of batches
+        batch_size : int
+            batch size of each batch
 
         Returns
         -------
-        size_t
-            buffer size
+        sample : dict of ndarray
+            stacked batches whose shapes are [n_batches, *shape of `sample()`]
         """
-        return self.buffer_size
+        cdef samples = self._stacked_batch(n_batches,batch_size)
+        with self.lock:
+            self._draw(n_batches * batch_size,samples)
+        self._split_ragged(samples,(n_batches,batch_size))
+        return samples
 
-    cpdef size_t get_next_index(self):
-        """Get the next index to store
+    def iter_batches(self,batch_size,shuffle=True,drop_last=False):
+        """Iterate over all the stored transitions once per call (epoch)
 
-        Returns
-        -------
-        size_t
-            the next index to store
-        """
-        return self.index
+        Parameters
+        ----------
+        batch_size : int
+            batch size
+        shuffle : bool, optional
+            If `True` (default), transitions are visited in a fresh random
+            permutation. Otherwise, they are visited in insertion order, and
+            batches are views of the buffer as long as they are contiguous.
+        drop_last : bool, optional
+            If `True`, the last incomplete batch is dropped. default is `False`
+
+        Yields
+        ------
+        sample : dict of ndarray
+            batch with the same format as `sample()`
 
-    cdef void add_cache(self):
-        """Add last items into cache
+        Notes
+        -----
+        The number of transitions is fixed at the beginning of the iteration.
+        Transitions added during the iteration might be visited or dropped.
+        View batches are overwritten by the following `add()`.
         """
-        cdef size_t key = (self.index or self.buffer_size) -1
-        self.cache[key] = {}
-
-        if self.has_next_of:
-            for name, value in self.next_.items():
-                self.cache[key][f"next_{name}"] = value
+        cdef size_t stored = self.get_stored_size()
+        cdef size_t oldest = self._oldest_index()
+        cdef size_t n = stored - (stored % batch_size if drop_last else 0)
+        cdef order = np.random.permutation(stored) if shuffle else None
+
+        for begin in range(0,n,batch_size):
+            end = min(begin + batch_size,n)
+            with self.lock:
+                if shuffle:
+                    batch = self._encode_sample(order[begin:end])
+                else:
+                    batch = self._slice_sample((oldest + begin) % self.buffer_size,
+                                               end - begin)
+            yield batch
 
-        if self.compress_any:
-            for name in self.stack_compress:
-                self.cache[key][name] = self.buffer[name][key].copy()
+    def _slice_sample(self,size_t start,size_t n):
+        cdef size_t end = start + n
+        cdef size_t E = self.next_shift
+        cdef bool view = (end <= self.buffer_size)
 
-    cpdef void on_episode_end(self):
-        """Call on episode end
+        if view and self.n_cached:
+            view = not (self.cache_row[start:end] >= 0).any()
 
-        Notes
-        -----
-        This is necessary for stack compression (stack_compress) mode or next
-        compression (next_of) mode.
-        """
-        if self.use_nstep:
-            self.use_nstep = False
-            self.add(**self.nstep.on_episode_end())
-            self.use_nstep = True
+        if view and self.has_next_of:
+            # Next values are substituted at the next indices or episode end
+            view = ((end + E <= self.buffer_size) and
+                    not (start < self.index < end + E) and
+                    not (self.n_cached and
+                         ((self.next_row[start:end] >= 0).any() or
+                          (self.cache_row[start+E:end+E] >= 0).any())))
 
-        if self.cache is not None:
-            self.add_cache()
+        if not view:
+            return self._encode_sample(np.arange(start,end) % self.buffer_size)
 
-@cython.embedsignature(True)
-cdef class PrioritizedReplayBuffer(ReplayBuffer):
-    """Prioritized replay buffer class to store environments with priorities.
+        cdef sample = {}
+        for name, b in self.buffer.items():
+            sample[name] = np.squeeze(self._decoded(name,b[start:end]))
 
-    In this class, these environments are sampled with corresponding priorities.
-    """
-    cdef VectorFloat weights
-    cdef VectorSize_t indexes
-    cdef float alpha
-    cdef CppPrioritizedSampler[float]* per
-    cdef NstepBuffer priorities_nstep
-    cdef bool check_for_update
-    cdef bool [:] unchange_since_sample
+        if self.has_next_of:
+            for name in self.next_of:
+                sample[f"next_{name}"] = self._decoded(name,
+                                                       self.buffer[name][start+E:end+E])
+
+        for name, e in self.encoded.items():
+            v = np.empty((n,*e.shape),dtype=e.dtype)
+            self._decode(e,np.arange(start,end),v)
+            sample[name] = np.squeeze(v)
+
+        for name, f in self.frames.items():
+            v = np.empty((n,*f.shape),dtype=f.dtype)
+            next_v = np.empty((n,*f.shape),dtype=f.dtype) if f.next else None
+            f.gather(np.arange(start,end),v,next_v)
+            sample[name] = np.squeeze(v)
+            if f.next:
+                sample[f"next_{name}"] = next_v
+
+        self._gather_ragged(np.arange(start,end),sample)
+        return sample
 
-    def __cinit__(self,size,env_dict=None,*,alpha=0.6,Nstep=None,eps=1e-4,
-                  check_for_update=False,**kwrags):
-        self.alpha = alpha
-        self.per = new CppPrioritizedSampler[float](size,alpha)
-        self.per.set_eps(eps)
-        self.weights = VectorFloat()
-        self.indexes = VectorSize_t()
+    cdef _decoded(self,name,stored):
+        if name not in self.converts:
+            return stored
 
-        if self.use_nstep:
-            self.priorities_nstep = NstepBuffer({"priorities": {"dtype": np.single},
-                                                 "done": {}},
-                                                {"size": Nstep["size"]})
+        dtype, quantize = self.converts[name]
+        v = np.empty(stored.shape,dtype=dtype)
+        decode_values(stored,v,quantize)
+        return v
 
-        self.check_for_update = check_for_update
-        if self.check_for_update:
-            self.unchange_since_sample = np.ones(np.array(size,
-                                                          copy=False,
-                                                          dtype='int'),
-                                                 dtype='bool')
+    def start_prefetch(self,batch_size,n_batches=2,**kwargs):
+        """Start background thread sampling batches in advance
 
-    def __init__(self,size,env_dict=None,*,alpha=0.6,Nstep=None,eps=1e-4,
-                 check_for_update=False,**kwargs):
-        """Initialize PrioritizedReplayBuffer
+        While prefetching, `sample()` with the same `batch_size` and sampling
+        arguments returns a batch which has been drawn by the worker thread.
+        `add()`, `update_priorities()` and the other modifications are
+        serialized with the worker, and a prefetched batch containing slots
+        overwritten after it was drawn is sampled again at pick up.
 
         Parameters
         ----------
-        size : int
-            buffer size
+        batch_size : int
+            batch size to be prefetched
+        n_batches : int, optional
+            number of batches kept ready. default is 2.
+        **kwargs
+            sampling arguments other than `batch_size` (e.g. `beta`)
+
+        Notes
+        -----
+        Returned batch is one of preallocated batches, which is valid until the
+        next `sample()` call as if `out=True`.
+        """
+        self.stop_prefetch()
+        with self.lock:
+            self.slot_gen = np.zeros(self.buffer_size,dtype=np.uint64)
+            self.write_gen = 0
+            self.prefetcher = Prefetcher(self,batch_size,n_batches,kwargs)
+
+    def stop_prefetch(self):
+        """Stop background thread started by `start_prefetch()`
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+    def get_prefetch_stats(self):
+        """Get statistics of prefetching
+
+        Returns
+        -------
+        stats : dict
+            'batches' is the number of picked up batches, 'waits' is the number
+            of times `sample()` waited the worker, 'wait_time' is their total
+            seconds, and 'stale' is the number of batches sampled again because
+            of overwritten slots. If not prefetching, returns `None`.
+        """
+        if self.prefetcher is None:
+            return None
+        return self.prefetcher.stats()
+
+    cdef bool _overwritten(self,idx,size_t gen):
+        return (self.slot_gen[idx] > gen).any()
+
+    cdef size_t _oldest_index(self):
+        return self.index if self.stored_size == self.buffer_size else 0
+
+    cdef _stored_order(self):
+        # Stored slots from the oldest to the newest
+        return ((self._oldest_index() + np.arange(self.stored_size,dtype=np.intp))
+                % self.buffer_size)
+
+    def resize(self,new_size):
+        """Resize buffer
+
+        Stored transitions are moved into the new buffer from the oldest one,
+        so that they are sampled as before. When `new_size` is smaller than
+        the stored size, the oldest transitions are dropped.
+
+        Parameters
+        ----------
+        new_size : int
+            new buffer size, which must be multiple of `num_envs`.
+
+        Raises
+        ------
+        ValueError
+            If `new_size` is not multiple of `num_envs`
+        NotImplementedError
+            If `storage="mmap"`
+
+        Notes
+        -----
+        `resize` copies all the stored transitions, which takes O(n) time and
+        temporarily requires memory of both buffers. With `initial_size`, the
+        buffer is resized automatically, and `resize` stops the lazy growth.
+        """
+        with self.lock:
+            self._resize(new_size,self._stored_order())
+
+    cdef void _resize(self,size_t new_size,order) except *:
+        if self.path is not None:
+            raise NotImplementedError("`resize` does not support `storage='mmap'`")
+        if new_size < 1 or new_size % self.num_envs:
+            raise ValueError(f"`new_size` ({new_size}) must be multiple of "
+                             f"`num_envs` ({self.num_envs})")
+
+        cdef size_t n = min(order.shape[0],new_size)
+        cdef dropped = order[:order.shape[0]-n]
+        order = order[order.shape[0]-n:]
+
+        cdef buffer = dict2buffer(new_size,
+                                  {name: self.env_dict[name] for name in self.buffer},
+                                  stack_compress = self.stack_compress,
+                                  default_dtype = self.default_dtype,
+                                  num_envs = self.num_envs,
+                                  layout = self.layout)
+        for name, b in buffer.items():
+            v = self.buffer[name]
+            if self.compress_any and np.isin(name,self.stack_compress).any():
+                # Stacks share memory. The first items are written at last.
+                for k in reversed(range(b.shape[-1])):
+                    b[:n,...,k] = v[order,...,k]
+            else:
+                b[:n] = v[order]
+        self.buffer = buffer
+
+        if self.has_cache:
+            if self.n_cached:
+                self._release_cache(dropped)
+            cache_row = np.full(new_size,-1,dtype=np.intp)
+            cache_row[:n] = self.cache_row[order]
+            self.cache_row = cache_row
+            next_row = np.full(new_size,-1,dtype=np.intp)
+            next_row[:n] = self.next_row[order]
+            self.next_row = next_row
+
+        for e in self.encoded.values():
+            e.resize(order,new_size)
+
+        for f in self.frames.values():
+            f.resize(order,new_size)
+
+        for r in self.ragged.values():
+            r.resize(order,new_size)
+
+        # The newest transition is at (n - 1), so that the ring of the latest
+        # next values is still valid.
+        self.buffer_size = new_size
+        self.max_size = new_size
+        self.stored_size = n
+        self.index = n % new_size
+        self._init_add_fields()
+
+        if self.prefetcher is not None:
+            # Batches drawn in advance are stale. (Never shrink, since they
+            # might have larger indices.)
+            self.write_gen += 1
+            self.slot_gen = np.full(max(new_size,self.slot_gen.shape[0]),
+                                    self.write_gen,dtype=np.uint64)
+            self.cond.notify_all()
+
+    cdef size_t _n_sequence_starts(self,size_t length) except *:
+        # Sequence is every `num_envs` items (the same stream).
+        cdef size_t max_length = self.stored_size // self.num_envs
+        if length == 0 or length > max_length:
+            raise ValueError(f"`length` ({length}) must be "
+                             f"in [1, stored size per stream ({max_length})]")
+        return self.stored_size - (length - 1) * self.num_envs
+
+    def _encode_sequence(self,starts,size_t length,episode_mask):
+        cdef size_t batch_size = starts.shape[0]
+
+        # Unsigned (size_t) starts are promoted to float64 with signed arange
+        starts = np.asarray(starts,dtype=np.intp)
+        cdef idx = ((starts[:,np.newaxis] + np.arange(length) * self.num_envs)
+                    % self.buffer_size)
+
+        cdef layout = {}
+        for name, b in self.buffer.items():
+            layout[name] = ((batch_size,length,*b.shape[1:]),self._sample_dtype(name))
+
+        if self.has_next_of:
+            for name in self.next_of:
+                b = self.buffer[name]
+                layout[f"next_{name}"] = ((batch_size,length,*b.shape[1:]),
+                                          self._sample_dtype(name))
+
+        for name, e in self.encoded.items():
+            layout[name] = ((batch_size,length,*e.shape),e.dtype)
+
+        for name, f in self.frames.items():
+            layout[name] = ((batch_size,length,*f.shape),f.dtype)
+            if f.next:
+                layout[f"next_{name}"] = ((batch_size,length,*f.shape),f.dtype)
+
+        cdef sample = self._encode_sample(idx.ravel(),packed_buffer(layout))
+        self._split_ragged(sample,(batch_size,length))
+
+        if episode_mask:
+            if "done" not in self.buffer:
+                raise ValueError("`episode_mask` requires 'done' in `env_dict`")
+            done = sample["done"].reshape(batch_size,length,-1).any(axis=2)
+            mask = np.ones((batch_size,length),dtype=np.bool_)
+            mask[:,1:] = (np.cumsum(done[:,:-1],axis=1) == 0)
+            sample["mask"] = mask
+
+        return sample, idx
+
+    def sample_sequences(self,batch_size,length,*,episode_mask=False):
+        """Sample contiguous sequences of transitions for recurrent agents
+
+        Sequence starts are drawn uniformly from the stored transitions, so
+        that every sequence is consecutive transitions of the same stream and
+        never crosses the write position.
+
+        Parameters
+        ----------
+        batch_size : int
+            number of sequences
+        length : int
+            number of transitions in each sequence
+        episode_mask : bool, optional
+            If `True`, boolean 'mask' of [batch_size, length] is also returned,
+            which is `False` after the first 'done' in each sequence.
+
+        Returns
+        -------
+        sample : dict of ndarray
+            sequences whose shapes are [batch_size, length, *shape]. Values are
+            not squeezed unlike `sample()`.
+
+        Raises
+        ------
+        ValueError
+            If `length` is 0 or larger than stored size per stream.
+        """
+        cdef size_t n_starts
+        cdef starts
+        with self.lock:
+            n_starts = self._n_sequence_starts(length)
+            starts = ((self._oldest_index() +
+                       np.random.randint(0,n_starts,batch_size)) % self.buffer_size)
+            return self._encode_sequence(starts,length,episode_mask)[0]
+
+    cpdef void clear(self) except *:
+        """Clear replay buffer.
+
+        Set `index` and `stored_size` to 0.
+
+        Example
+        -------
+        >>> rb = ReplayBuffer(5,{"done",{}})
+        >>> rb.add(1)
+        >>> rb.get_stored_size()
+        1
+        >>> rb.get_next_index()
+        1
+        >>> rb.clear()
+        >>> rb.get_stored_size()
+        0
+        >>> rb.get_next_index()
+        0
+        """
+        with self.lock:
+            self.index = 0
+            self.stored_size = 0
+
+            if self.use_nstep:
+                self.nstep.clear()
+
+            if self.has_cache:
+                self._clear_cache()
+
+            for f in self.frames.values():
+                f.clear()
+
+            for r in self.ragged.values():
+                r.clear()
+
+            if self.prefetcher is not None:
+                self.write_gen += 1
+                self.slot_gen[:] = self.write_gen
+
+    def flush(self):
+        """Write buffer to files of `storage="mmap"`
+
+        Stored values are flushed to the files, and buffer state (e.g. index)
+        is written to "_state.npz". Reopening the same `path` restores the
+        buffer at this point. Values in `Nstep` local buffer are not saved.
+        (Nothing is done for `storage="memory"`.)
+        """
+        if self.path is None:
+            return
+
+        with self.lock:
+            for b in self.buffer.values():
+                flush_array(b)
+
+            state = {"index": self.index,"stored_size": self.stored_size,
+                     "next_head": self.next_head}
+            if self.has_cache:
+                for key, row_map in (("cache",self.cache_row),
+                                     ("next",self.next_row)):
+                    slots = np.flatnonzero(row_map >= 0)
+                    state[f"{key}_slots"] = slots
+                    state[f"{key}_rows"] = row_map[slots]
+                for name, v in self.cache_values.items():
+                    state[f"cache_values_{name}"] = v
+
+            filename = os.path.join(self.path,"_state.npz")
+            with open(filename + ".tmp","wb") as f:
+                np.savez(f,**state)
+            os.replace(filename + ".tmp",filename)
+
+    cdef void _load_state(self) except *:
+        filename = os.path.join(self.path,"_state.npz")
+        if not os.path.exists(filename):
+            return
+
+        with np.load(filename) as state:
+            self.index = state["index"]
+            self.stored_size = state["stored_size"]
+            if not self.has_cache:
+                return
+
+            for name in self.cache_values:
+                self.cache_values[name] = state[f"cache_values_{name}"]
+            self._clear_cache()
+            self.next_head = state["next_head"]
+
+            for key, row_map in (("cache",self.cache_row),
+                                 ("next",self.next_row)):
+                rows = state[f"{key}_rows"]
+                row_map[state[f"{key}_slots"]] = rows
+                used = set(rows.tolist())
+                self.free_rows = [r for r in self.free_rows if r not in used]
+                self.n_cached += rows.shape[0]
+
+    cpdef size_t get_stored_size(self):
+        """Get stored size
+
+        Returns
+        -------
+        size_t
+            stored size
+        """
+        return self.stored_size
+
+    cpdef size_t get_buffer_size(self):
+        """Get buffer size
+
+        Returns
+        -------
+        size_t
+            buffer size. (The current allocated size with `initial_size`.)
+        """
+        return self.buffer_size
+
+    cpdef size_t get_next_index(self):
+        """Get the next index to store
+
+        Returns
+        -------
+        size_t
+            the next index to store
+        """
+        return self.index
+
+    cdef void _init_cache(self):
+        """Initialize episode end cache
+
+        Cached values are stored at rows of `cache_values[name]`, and per slot
+        row indices are stored at `cache_row` (stack_compress values) and
+        `next_row` (next_of values). Negative row index means no cache.
+        The first `next_shift` rows are reserved for the ring of the latest
+        next_of values.
+        """
+        cdef size_t capacity = 16 * self.next_shift
+        cdef names = set()
+        if self.has_next_of:
+            names.update(self.next_of)
+        if self.compress_any:
+            names.update(self.stack_compress)
+
+        self.cache_values = {}
+        for name in names:
+            b = self.buffer[name]
+            self.cache_values[name] = np.zeros((capacity,*b.shape[1:]),
+                                               dtype=b.dtype)
+
+        self.cache_row = np.full(self.buffer_size,-1,dtype=np.intp)
+        self.next_row = np.full(self.buffer_size,-1,dtype=np.intp)
+        self._clear_cache()
+
+    cdef void _clear_cache(self):
+        cdef size_t capacity = next(iter(self.cache_values.values())).shape[0]
+        self.cache_row[:] = -1
+        self.next_row[:] = -1
+        self.free_rows = list(range(capacity-1,self.next_shift-1,-1))
+        self.n_cached = 0
+        self._update_next_views()
+
+    cdef void _update_next_views(self):
+        if self.has_next_of:
+            for name in self.next_of:
+                self.next_[name] = self.cache_values[name][:self.next_shift]
+
+    cdef size_t _alloc_cache_row(self) except *:
+        cdef size_t capacity
+        if not self.free_rows:
+            capacity = next(iter(self.cache_values.values())).shape[0]
+            for name, v in self.cache_values.items():
+                self.cache_values[name] = np.concatenate((v,np.zeros_like(v)))
+            self.free_rows = list(range(2*capacity-1,capacity-1,-1))
+            self._update_next_views()
+
+        self.n_cached += 1
+        return self.free_rows.pop()
+
+    cdef void _release_cache(self,slots) except *:
+        for row_map in (self.cache_row,self.next_row):
+            rows = row_map[slots]
+            rows = rows[rows >= 0]
+            if rows.shape[0]:
+                self.free_rows.extend(rows.tolist())
+                self.n_cached -= rows.shape[0]
+                row_map[slots] = -1
+
+    cdef void add_cache(self,envs=(0,)) except *:
+        """Add last items of streams into cache
+
+        The next_of values of the last item (the last Nstep size items with
+        `Nstep`) and the stack_compress values of the last (stack size - 1)
+        items of each stream in `envs`, which will be overwritten by the next
+        episode, are cached.
+        """
+        cdef size_t E = self.num_envs
+        cdef size_t last
+        cdef size_t key
+        cdef size_t row
+        cdef size_t k
+        cdef size_t n_stack = 1
+        cdef size_t age
+
+        if self.compress_any:
+            for name in self.stack_compress:
+                n_stack = max(n_stack,self.buffer[name].shape[-1])
+
+        for env in envs:
+            last = (self.index + self.buffer_size - E + env) % self.buffer_size
+
+            for k in range(self.next_shift // E if self.has_next_of else 0):
+                if k * E >= self.stored_size:
+                    break
+
+                key = (last + self.buffer_size - k * E) % self.buffer_size
+                if self.next_row[key] >= 0:
+                    continue
+
+                # Position of the item in the ring of the latest next values
+                age = k * E + E - 1 - env
+                row = self._alloc_cache_row()
+                for name in self.next_of:
+                    self.cache_values[name][row] = self.next_[name][
+                        (self.next_head + self.next_shift - 1 - age) % self.next_shift]
+                self.next_row[key] = row
+
+            for k in range(n_stack-1):
+                if k * E >= self.stored_size:
+                    break
+
+                key = (last + self.buffer_size - k * E) % self.buffer_size
+                if self.cache_row[key] >= 0:
+                    # Already cached at the previous episode end
+                    continue
+
+                row = self._alloc_cache_row()
+                for name in self.stack_compress:
+                    self.cache_values[name][row] = self.buffer[name][key]
+                self.cache_row[key] = row
+
+    cpdef void on_episode_end(self,envs=None) except *:
+        """Call on episode end
+
+        Parameters
+        ----------
+        envs : array like of int, optional
+            streams whose episodes end with `num_envs > 1`. default is `None`,
+            which means all the streams.
+
+        Raises
+        ------
+        ValueError
+            If `envs` are out of [0, `num_envs`)
+
+        Notes
+        -----
+        This is necessary for stack compression (stack_compress) mode, next
+        compression (next_of) mode, or Nstep reward. With `num_envs > 1`,
+        terminal episode ends are also detected from 'done' at `add`, however
+        truncated ones (e.g. by time limit) must be notified with `envs` after
+        their last steps are added. Since streams are stored in lockstep, Nstep
+        values flushed from streams are stored at the following `add`.
+        """
+        envs = self._episode_envs(envs)
+
+        with self.lock:
+            if self.use_nstep:
+                if self.num_envs > 1:
+                    self.nstep.on_episode_end(envs)
+                else:
+                    self.use_nstep = False
+                    kwargs = self.nstep.on_episode_end()
+                    if kwargs["done"].shape[0]:
+                        self.add(**kwargs)
+                    self.use_nstep = True
+
+            if self.has_cache:
+                self.add_cache(envs)
+
+            for f in self.frames.values():
+                f.episode_end(envs)
+
+@cython.embedsignature(True)
+cdef class Prefetcher:
+    """Worker thread drawing batches from replay buffer in advance
+
+    Batches are drawn into a ring of preallocated batches. Free batches are
+    passed to the worker through `free` queue, and drawn ones are passed back
+    through `ready` queue together with their indexes and the write generation
+    at drawing. One batch is held by the learner until the next pick up.
+    """
+    cdef ReplayBuffer buffer
+    cdef size_t batch_size
+    cdef kwargs
+    cdef batches
+    cdef free
+    cdef ready
+    cdef thread
+    cdef error
+    cdef bool stopping
+    cdef size_t holding
+    cdef size_t n_batches
+    cdef size_t n_waits
+    cdef double wait_time
+    cdef size_t n_stale
+
+    def __cinit__(self,ReplayBuffer buffer,size_t batch_size,size_t n_batches,kwargs):
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.kwargs = kwargs
+        self.batches = [buffer.create_batch(batch_size) for _ in range(n_batches+1)]
+
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for slot in range(n_batches):
+            self.free.put(slot)
+        self.holding = n_batches
+
+        self.thread = threading.Thread(target=self._run,daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        cdef ReplayBuffer rb = self.buffer
+        cdef size_t gen
+        while True:
+            slot = self.free.get()
+            if slot is None:
+                return
+
+            with rb.cond:
+                while rb.stored_size == 0 and not self.stopping:
+                    rb.cond.wait()
+                if self.stopping:
+                    return
+
+                try:
+                    _, idx = rb._draw(self.batch_size,self.batches[slot],**self.kwargs)
+                except Exception as e:
+                    self.ready.put((None,e,0))
+                    return
+                gen = rb.write_gen
+
+            self.ready.put((slot,idx,gen))
+
+    def match(self,batch_size,kwargs):
+        return ((self.batch_size == batch_size) and (self.kwargs == kwargs) and
+                (self.buffer.stored_size > 0))
+
+    def get(self):
+        cdef ReplayBuffer rb = self.buffer
+        cdef double t
+
+        if self.error is not None:
+            raise self.error
+
+        self.free.put(self.holding)
+        try:
+            slot, idx, gen = self.ready.get_nowait()
+        except queue.Empty:
+            self.n_waits += 1
+            t = time.perf_counter()
+            slot, idx, gen = self.ready.get()
+            self.wait_time += time.perf_counter() - t
+
+        if slot is None:
+            self.error = idx
+            raise self.error
+
+        self.holding = slot
+        batch = self.batches[slot]
+        with rb.lock:
+            if rb._overwritten(idx,gen):
+                self.n_stale += 1
+                rb._draw(self.batch_size,batch,**self.kwargs)
+
+        self.n_batches += 1
+        return batch
+
+    def stop(self):
+        cdef ReplayBuffer rb = self.buffer
+        with rb.cond:
+            self.stopping = True
+            rb.cond.notify_all()
+        self.free.put(None)
+        self.thread.join()
+
+    def stats(self):
+        return {"batches": self.n_batches,
+                "waits": self.n_waits,
+                "wait_time": self.wait_time,
+                "stale": self.n_stale}
+
+
+@cython.embedsignature(True)
+cdef class PrioritizedReplayBuffer(ReplayBuffer):
+    """Prioritized replay buffer class to store environments with priorities.
+
+    In this class, these environments are sampled with corresponding priorities.
+    """
+    cdef VectorFloat weights
+    cdef VectorSize_t indexes
+    cdef float alpha
+    cdef float eps
+    cdef size_t tree_arity
+    cdef size_t sample_threads
+    cdef seed
+    cdef CppPrioritizedSampler[float]* per
+    cdef CppThreadSafePrioritizedSampler[float]* ts_per
+    cdef bool thread_safe
+    cdef tree_lock
+    cdef priorities_nstep
+    cdef bool check_for_update
+    cdef bool [:] unchange_since_sample
+    cdef priorities_memory
+
+    def __cinit__(self,size,env_dict=None,*,alpha=0.6,Nstep=None,eps=1e-4,
+                  check_for_update=False,thread_safe=False,tree_arity=2,
+                  sample_threads=1,seed=None,**kwrags):
+        self.alpha = alpha
+        self.eps = eps
+        self.tree_arity = tree_arity
+        self.sample_threads = sample_threads
+        self.seed = seed
+
+        cdef size_t size_ = self.buffer_size
+        cdef size_t n
+        cdef bool initialize
+        cdef float [::1] memory
+        self.thread_safe = thread_safe
+        if tree_arity != 2 and (self.thread_safe or self.path is not None):
+            raise NotImplementedError("`tree_arity` other than 2 supports neither "
+                                      "`thread_safe` nor `storage='mmap'`")
+        if sample_threads > 1 and self.thread_safe:
+            raise NotImplementedError("`sample_threads` does not support "
+                                      "`thread_safe`")
+        if self.thread_safe:
+            if self.path is not None:
+                raise NotImplementedError("`thread_safe` does not support "
+                                          "`storage='mmap'`")
+            if self.buffer_size < self.max_size:
+                raise NotImplementedError("`thread_safe` does not support "
+                                          "`initial_size`")
+            self.ts_per = new CppThreadSafePrioritizedSampler[float](size_,alpha,
+                                                                     NULL,
+                                                                     NULL,NULL,NULL,
+                                                                     NULL,NULL,NULL,
+                                                                     True,eps)
+            self.tree_lock = threading.Lock()
+        elif self.path is None:
+            self.per = new CppPrioritizedSampler[float](size_,alpha,NULL,
+                                                        NULL,NULL,NULL,
+                                                        NULL,NULL,NULL,
+                                                        True,eps,tree_arity)
+        else:
+            # [max priority, sum tree, min tree] on a single file
+            n = 1
+            while n < size_:
+                n *= 2
+            filename = os.path.join(self.path,"_priorities.npy")
+            initialize = not os.path.exists(filename)
+            self.priorities_memory = allocate((1 + 2 * (2*n - 1),),np.single,
+                                              filename)
+            memory = self.priorities_memory
+            self.per = new CppPrioritizedSampler[float](size_,alpha,
+                                                        &memory[0],
+                                                        &memory[1],NULL,NULL,
+                                                        &memory[2*n],NULL,NULL,
+                                                        initialize,eps)
+        if not self.thread_safe:
+            self.per.set_eps(eps)
+            self.per.set_sample_threads(sample_threads)
+            if seed is not None:
+                self.per.seed(seed)
+        elif seed is not None:
+            self.ts_per.seed(seed)
+        self.weights = VectorFloat()
+        self.indexes = VectorSize_t()
+
+        if self.use_nstep:
+            if self.num_envs > 1:
+                self.priorities_nstep = StreamNstepBuffer(self.num_envs,
+                                                          {"priorities": {"dtype": np.single},
+                                                           "done": {}},
+                                                          {"size": Nstep["size"]})
+            else:
+                self.priorities_nstep = NstepBuffer({"priorities": {"dtype": np.single},
+                                                     "done": {}},
+                                                    {"size": Nstep["size"]})
+
+        self.check_for_update = check_for_update
+        if self.check_for_update:
+            self.unchange_since_sample = np.ones(np.array(size_,
+                                                          copy=False,
+                                                          dtype='int'),
+                                                 dtype='bool')
+
+    def __init__(self,size,env_dict=None,*,alpha=0.6,Nstep=None,eps=1e-4,
+                 check_for_update=False,thread_safe=False,tree_arity=2,
+                 sample_threads=1,seed=None,**kwargs):
+        """Initialize PrioritizedReplayBuffer
+
+        Parameters
+        ----------
+        size : int
+            buffer size
+        env_dict : dict of dict, optional
+            dictionary specifying environments. The keies of env_dict become
+            environment names. The values of env_dict, which are also dict,
+            defines "shape" (default 1) and "dtypes" (fallback to `default_dtype`)
+        alpha : float, optional
+            the exponent of the priorities in stored whose default value is 0.6
+        eps : float, optional
+            small positive constant to ensure error-less state will be sampled,
+            whose default value is 1e-4.
+        check_for_update : bool
+            Whether check update for `update_priorities`. The default value is `False`
+        thread_safe : bool, optional
+            If `True`, priorities are managed by thread safe trees, whose inner
+            nodes are lazily updated at sampling. Sampling from the trees and
+            updating priorities release GIL without blocking `add` of other
+            threads. The default value is `False`
+        tree_arity : {2, 4, 8}, optional
+            Number of children of each node of the sum tree. With 4 or 8,
+            children are packed into a cache line, and the tree is shallower,
+            which is effective for very large buffers. The default value is 2
+        sample_threads : int, optional
+            Number of threads sampling strata and computing weights of a large
+            batch. Strata are drawn by blocks of 1024, each of which has its own
+            random stream, so that sampled results are independent of
+            `sample_threads`. The default value is 1
+        seed : int, optional
+            Seed of random numbers for sampling. If `None` (default), randomly
+            seeded.
+
+        Raises
+        ------
+        ValueError
+            If `tree_arity` is neither 2, 4, nor 8
+        NotImplementedError
+            If `tree_arity` is not 2 with `thread_safe=True` or `storage="mmap"`,
+            or if `sample_threads` is more than 1 with `thread_safe=True`,
+            or if `initial_size` is smaller than `size` with `thread_safe=True`
+
+        Notes
+        -----
+        With `storage="mmap"`, priorities are also mapped to "_priorities.npy"
+        under `path`.
+        """
+        pass
+
+    def __dealloc__(self):
+        del self.per
+        del self.ts_per
+
+    def flush(self):
+        """Write buffer and priorities to files of `storage="mmap"`
+        """
+        with self.lock:
+            super().flush()
+            flush_array(self.priorities_memory)
+
+    def add(self,*,priorities = None,**kwargs):
+        """Add environment(s) into replay buffer.
+
+        Multiple step environments can be added.
+
+        Parameters
+        ----------
+        priorities : array like or float or int
+            priorities of each environment
+        **kwargs : array like or float or int optional
+            environment(s) to be stored
+
+        Returns
+        -------
+        : int or None
+            the stored first index. If all values store into NstepBuffer and
+            no values store into main buffer, return None.
+        """
+        cdef size_t N = self.size_check.step_size(kwargs)
+        if priorities is not None:
+            priorities = np.ravel(np.array(priorities,copy=False,
+                                           ndmin=1,dtype=np.single))
+            if N != priorities.shape[0]:
+                raise ValueError("`priorities` shape is imcompatible")
+
+        cdef maybe_index
+
+        with self.lock:
+            if self.use_nstep:
+                if priorities is None:
+                    priorities = np.full((N),self.get_max_priority(),dtype=np.single)
+
+                priorities = self.priorities_nstep.add(priorities=priorities,
+                                                       done=np.array(kwargs["done"],
+                                                                     copy=True))
+                if priorities is not None:
+                    priorities = np.ravel(priorities["priorities"])
+                    N = priorities.shape[0]
+
+            maybe_index = super().add(**kwargs)
+            if maybe_index is None:
+                return None
+
+            self._set_priorities(maybe_index,N,priorities)
+            return maybe_index
+
+    def add_batch(self,arrays,*,priorities = None,unchecked=True):
+        """Add already shaped and typed arrays into replay buffer.
+
+        Parameters
+        ----------
+        arrays : dict of numpy.ndarray or numpy.ndarray
+            values whose shapes are [N, *shape]. Structured array with
+            field names of environments (and `next_` ones) is also accepted.
+        priorities : array like or float or int, optional
+            priorities of each environment
+        unchecked : bool, optional
+            If `True` (default), shapes and dtypes are trusted. Otherwise they
+            are checked for debugging.
+
+        Returns
+        -------
+        : int or None
+            the stored first index. If all values store into NstepBuffer and
+            no values store into main buffer, return None.
+        """
+        if self.use_nstep:
+            return self.add(priorities=priorities,**self._batch_kwargs(arrays))
+
+        cdef size_t N = arrays[self.size_check.check_str].shape[0]
+        if priorities is not None:
+            priorities = np.ravel(np.array(priorities,copy=False,
+                                           ndmin=1,dtype=np.single))
+            if N != priorities.shape[0]:
+                raise ValueError("`priorities` shape is imcompatible")
+
+        cdef size_t index
+        with self.lock:
+            index = super().add_batch(arrays,unchecked=unchecked)
+            self._set_priorities(index,N,priorities)
+            return index
+
+    def resize(self,new_size):
+        """Resize buffer
+
+        Priorities are moved together with the transitions, and the sum and
+        min trees are rebuilt from them in O(n).
+
+        Parameters
+        ----------
+        new_size : int
+            new buffer size, which must be multiple of `num_envs`.
+
+        Raises
+        ------
+        ValueError
+            If `new_size` is not multiple of `num_envs`
+        NotImplementedError
+            If `storage="mmap"` or `thread_safe=True`
+        """
+        if self.thread_safe:
+            raise NotImplementedError("`resize` does not support `thread_safe=True`")
+
+        cdef size_t n
+        cdef size_t [::1] idx
+        cdef float [::1] leaves
+        cdef float max_priority
+        with self.lock:
+            order = self._stored_order()
+            n = min(order.shape[0],new_size)
+            kept = order[order.shape[0]-n:]
+            idx = Csize(kept)
+            leaves = np.empty(n,dtype=np.single)
+            if n:
+                self.per.get_leaves(&idx[0],n,&leaves[0])
+            max_priority = self.per.get_max_priority()
+
+            self._resize(new_size,order)
+
+            del self.per
+            self.per = new CppPrioritizedSampler[float](new_size,self.alpha,NULL,
+                                                        NULL,NULL,NULL,
+                                                        NULL,NULL,NULL,
+                                                        True,self.eps,
+                                                        self.tree_arity)
+            self.per.set_sample_threads(self.sample_threads)
+            if self.seed is not None:
+                self.per.seed(self.seed)
+            if n:
+                self.per.set_leaves(&leaves[0],n)
+            self.per.set_max_priority(max_priority)
+
+            if self.check_for_update:
+                unchange = np.ones(new_size,dtype='bool')
+                unchange[:n] = np.asarray(self.unchange_since_sample)[kept]
+                self.unchange_since_sample = unchange
+
+    cdef void _set_priorities(self,size_t index,size_t N,priorities) except *:
+        cdef float [:] ps
+        cdef size_t size = self.get_buffer_size()
+
+        if priorities is not None:
+            ps = np.ravel(np.array(priorities,copy=False,ndmin=1,dtype=np.single))
+            if self.thread_safe:
+                with nogil:
+                    self.ts_per.set_priorities(index,&ps[0],N,size)
+            else:
+                self.per.set_priorities(index,&ps[0],N,size)
+        elif self.thread_safe:
+            with nogil:
+                self.ts_per.set_priorities(index,N,size)
+        else:
+            self.per.set_priorities(index,N,size)
+
+        if self.check_for_update:
+            if index+N <= self.buffer_size:
+                self.unchange_since_sample[index:index+N] = False
+            else:
+                self.unchange_since_sample[index:] = False
+                self.unchange_since_sample[:index+N-self.buffer_size] = False
+
+    def start_prefetch(self,batch_size,n_batches=2,beta = 0.4):
+        """Start background thread sampling batches in advance
+
+        Parameters
+        ----------
+        batch_size : int
+            batch size to be prefetched
+        n_batches : int, optional
+            number of batches kept ready. default is 2.
+        beta : float, optional
+            the exponent for discount priority effect whose default value is 0.4
+
+        Notes
+        -----
+        Only `sample()` with the same `batch_size` and `beta` picks up prefetched
+        batches. Priorities updated after drawing are not reflected to them.
+        """
+        super().start_prefetch(batch_size,n_batches,beta=beta)
+
+    def _batch_layout(self,size_t batch_size):
+        cdef layout = super()._batch_layout(batch_size)
+        layout["weights"] = ((batch_size,),np.single)
+        layout["indexes"] = ((batch_size,),self.indexes.as_numpy().dtype)
+        return layout
+
+    def sample(self,batch_size,beta = 0.4,*,out=None):
+        """Sample the stored environment depending on correspoinding priorities
+        with speciped size
+
+        Parameters
+        ----------
+        batch_size : int
+            sampled batch size
+        beta : float, optional
+            the exponent for discount priority effect whose default value is 0.4
+        out : dict of numpy.ndarray or bool, optional
+            If dict (e.g. created by `create_batch`), sampled values including
+            'weights' and 'indexes' are written into it. If `True`, a batch owned
+            by this buffer is reused.
+
+        Returns
+        -------
+        sample : dict of ndarray
+            batch size of samples which also includes 'weights' and 'indexes'
+
+
+        Notes
+        -----
+        When 'beta' is 0, priorities are ignored.
+        The greater 'beta', the bigger effect of priories.
+
+        The sampling probabilities are propotional to :math:`priorities ^ {-'beta'}`
+        """
+        if (out is None or out is True) and self.prefetcher is not None:
+            if self.prefetcher.match(batch_size,{"beta": beta}):
+                return self.prefetcher.get()
+
+        if out is True:
+            out = self._owned_batch(batch_size)
+        elif out is False:
+            out = None
+
+        return self._draw(batch_size,out,beta)[0]
+
+    def sample_many(self,n_batches,batch_size,beta = 0.4):
+        """Sample multiple batches at once depending on correspoinding priorities
+
+        Indexes of all the batches are drawn by a single pass over the
+        priority tree, and gathered in a single pass.
+
+        Parameters
+        ----------
+        n_batches : int
+            number of batches
+        batch_size : int
+            batch size of each batch
+        beta : float, optional
+            the exponent for discount priority effect whose default value is 0.4
+
+        Returns
+        -------
+        sample : dict of ndarray
+            stacked batches whose shapes are [n_batches, *shape of `sample()`],
+            which also includes 'weights' and 'indexes'
+
+        Notes
+        -----
+        The k-th batch takes every `n_batches`-th stratum of the proportional
+        sampling, so that each batch spans all the priority range.
+        """
+        cdef samples = self._stacked_batch(n_batches,batch_size)
+        cdef size_t N = n_batches * batch_size
+        cdef idx
+        cdef weights
+        with self._sampling_lock():
+            idx, weights = self._sample_priorities(N,beta)
+            with self.lock:
+                # [batch_size, n_batches] -> [n_batches, batch_size]
+                idx = idx.reshape(batch_size,n_batches).T.ravel()
+                self._encode_sample(idx,samples)
+                samples['weights'][:] = weights.reshape(batch_size,n_batches).T
+                samples['indexes'][:] = idx.reshape(n_batches,batch_size)
+
+                if self.check_for_update:
+                    self.unchange_since_sample[:] = True
+
+        self._split_ragged(samples,(n_batches,batch_size))
+        return samples
+
+    cdef _sampling_lock(self):
+        # Thread safe trees are sampled without blocking `add`
+        return contextlib.nullcontext() if self.thread_safe else self.lock
+
+    cdef _sample_priorities(self,size_t N,float beta):
+        """Sample indexes and weights from priority trees
+
+        Returns
+        -------
+        indexes : numpy.ndarray
+            sampled indexes
+        weights : numpy.ndarray
+            importance sampling weights
+        """
+        cdef size_t stored = self.get_stored_size()
+        if not self.thread_safe:
+            with self.lock:
+                self.per.sample(N,beta,self.weights.vec,self.indexes.vec,stored)
+                return (self.indexes.as_numpy(copy=True),
+                        self.weights.as_numpy(copy=True))
+
+        # Inner nodes of thread safe trees are updated by a single reader.
+        with self.tree_lock:
+            with nogil:
+                self.ts_per.sample(N,beta,self.weights.vec,self.indexes.vec,stored)
+            return (self.indexes.as_numpy(copy=True),
+                    self.weights.as_numpy(copy=True))
+
+    def _draw(self,batch_size,out,beta = 0.4):
+        cdef idx
+        cdef weights
+        with self._sampling_lock():
+            idx, weights = self._sample_priorities(batch_size,beta)
+            with self.lock:
+                samples = self._encode_sample(idx,out)
+                if out is None:
+                    samples['weights'] = weights
+                    samples['indexes'] = idx
+                else:
+                    samples['weights'][:] = weights
+                    samples['indexes'][:] = idx
+
+                if self.check_for_update:
+                    self.unchange_since_sample[:] = True
+
+        return samples, samples['indexes']
+
+    def sample_sequences(self,batch_size,length,beta = 0.4,*,episode_mask=False):
+        """Sample contiguous sequences depending on correspoinding priorities
+
+        A transition is sampled proportionally to its priority, then a sequence
+        containing it at a random offset is taken. Importance sampling weights
+        are calculated from the sums of priorities over the sequences.
+
+        Parameters
+        ----------
+        batch_size : int
+            number of sequences
+        length : int
+            number of transitions in each sequence
+        beta : float, optional
+            the exponent for discount priority effect whose default value is 0.4
+        episode_mask : bool, optional
+            If `True`, boolean 'mask' of [batch_size, length] is also returned,
+            which is `False` after the first 'done' in each sequence.
+
+        Returns
+        -------
+        sample : dict of ndarray
+            sequences whose shapes are [batch_size, length, *shape], which also
+            includes 'weights' of [batch_size] and 'indexes' of
+            [batch_size, length].
+
+        Raises
+        ------
+        ValueError
+            If `length` is 0 or larger than stored size.
+
+        Notes
+        -----
+        Weights are normalized by the maximum weight in the batch. In order to
+        update priorities per sequence, pass
+        `np.repeat(priorities, length)` with `indexes.ravel()`.
+        """
+        with self.lock:
+            return self._draw_sequences(batch_size,length,beta,episode_mask)
+
+    def _draw_sequences(self,batch_size,length,beta,episode_mask):
+        cdef size_t n_starts = self._n_sequence_starts(length)
+        cdef size_t oldest = self._oldest_index()
+
+        cdef idx
+        idx, _ = self._sample_priorities(batch_size,beta)
+
+        # Position in insertion order, shifted by random offset in sequence
+        # within the stored range
+        cdef size_t E = self.num_envs
+        cdef pos = ((idx.astype(np.intp) - oldest) % self.buffer_size)
+        cdef offset_min = np.maximum(0,-((n_starts - 1 - pos) // E))
+        cdef offset_max = np.minimum(length - 1,pos // E)
+        pos -= np.random.randint(offset_min,offset_max+1) * E
+
+        cdef size_t [::1] starts = Csize((oldest + pos) % self.buffer_size)
+        cdef window = np.empty(batch_size,dtype=np.single)
+        cdef float [::1] _window = window
+        if batch_size > 0 and self.thread_safe:
+            with self.tree_lock:
+                self.ts_per.get_window_priorities(&starts[0],batch_size,length,E,
+                                                  self.buffer_size,&_window[0])
+        elif batch_size > 0:
+            self.per.get_window_priorities(&starts[0],batch_size,length,E,
+                                           self.buffer_size,&_window[0])
+
+        samples, seq_idx = self._encode_sequence(np.asarray(starts),length,
+                                                 episode_mask)
+        samples['weights'] = np.power(window.min(initial=np.inf) / window,
+                                      beta,dtype=np.single)
+        samples['indexes'] = seq_idx.astype(idx.dtype)
+
+        if self.check_for_update:
+            self.unchange_since_sample[:] = True
+
+        return samples
+
+    def update_priorities(self,indexes,priorities):
+        """Update priorities
+
+        Parameters
+        ----------
+        indexes : array_like
+            indexes to update priorities
+        priorities : array_like
+            priorities to update
+
+        Returns
+        -------
+        """
+        cdef size_t [:] idx = Csize(indexes)
+        cdef float [:] ps = Cfloat(priorities)
+
+        cdef size_t _idx = 0
+        if self.check_for_update:
+            for _i in range(idx.shape[0]):
+                if self.unchange_since_sample[idx[_i]]:
+                    idx[_idx] = idx[_i]
+                    ps[_idx] = ps[_i]
+                    _idx += 1
+            idx = idx[:_idx]
+            ps = ps[:_idx]
+
+
+        cdef size_t N = idx.shape[0]
+        if N > 0 and self.thread_safe:
+            # Only leaves are updated, so that this does not block sampling.
+            with nogil:
+                self.ts_per.update_priorities(&idx[0],&ps[0],N)
+        elif N > 0:
+            with self.lock:
+                self.per.update_priorities(&idx[0],&ps[0],N)
+
+    cpdef void clear(self) except *:
+        """Clear replay buffer
+        """
+        with self.lock:
+            super(PrioritizedReplayBuffer,self).clear()
+            if self.thread_safe:
+                with self.tree_lock:
+                    self.ts_per.clear()
+            else:
+                clear(self.per)
+            if self.use_nstep:
+                self.priorities_nstep.clear()
+
+    cpdef float get_max_priority(self):
+        """Get the max priority of stored priorities
+
+        Returns
+        -------
+        max_priority : float
+            the max priority of stored priorities
+        """
+        if self.thread_safe:
+            return self.ts_per.get_max_priority()
+        return self.per.get_max_priority()
+
+    cpdef void on_episode_end(self,envs=None) except *:
+        """Call on episode end
+
+        Parameters
+        ----------
+        envs : array like of int, optional
+            streams whose episodes end with `num_envs > 1`. default is `None`,
+            which means all the streams.
+
+        Raises
+        ------
+        ValueError
+            If `envs` are out of [0, `num_envs`)
+
+        Notes
+        -----
+        This is necessary for stack compression (stack_compress) mode, next
+        compression (next_of) mode, or Nstep reward. With `num_envs > 1`,
+        terminal episode ends are also detected from 'done' at `add`, however
+        truncated ones (e.g. by time limit) must be notified with `envs` after
+        their last steps are added. Since streams are stored in lockstep, Nstep
+        values flushed from streams are stored at the following `add`.
+        """
+        envs = self._episode_envs(envs)
+
+        with self.lock:
+            if self.use_nstep:
+                if self.num_envs > 1:
+                    self.nstep.on_episode_end(envs)
+                    self.priorities_nstep.on_episode_end(envs)
+                else:
+                    self.use_nstep = False
+                    kwargs = self.nstep.on_episode_end()
+                    priorities = self.priorities_nstep.on_episode_end()["priorities"]
+                    if kwargs["done"].shape[0]:
+                        self.add(**kwargs,priorities=priorities)
+                    self.use_nstep = True
+
+            if self.has_cache:
+                self.add_cache(envs)
+
+            for f in self.frames.values():
+                f.episode_end(envs)
+
+
+@cython.embedsignature(True)
+cdef class DQfDBuffer(PrioritizedReplayBuffer):
+    cdef int demo_border
+    cdef float demo_eps_difference
+    def __cinit__(self, size, env_dict=None,*, eps=1e-4, demo_eps=1.,**kwrags):
+        if kwrags.get("initial_size") is not None:
+            raise NotImplementedError("DQfDBuffer does not support `initial_size`")
+        self.demo_eps_difference = demo_eps - eps
+        self.demo_border = 0
+
+    def __init__(self,size, env_dict=None,*, demo_eps=1.,**kwrags):
+        pass
+
+    def add(self,*,priorities = None,**kwargs):
+        """Add environment(s) into replay buffer.
+
+        Multiple step environments can be added.
+
+        Parameters
+        ----------
+        priorities : array like or float or int
+            priorities of each environment
+        **kwargs : array like or float or int optional
+            environment(s) to be stored
+
+        Returns
+        -------
+        : int or None
+            the stored first index. If all values store into NstepBuffer and
+            no values store into main buffer, return None.
+        """
+        cdef size_t N = self.size_check.step_size(kwargs)
+        cdef size_t index
+        cdef size_t end
+
+        with self.lock:
+            index = self.index
+            end = index + N
+            if end > self.buffer_size:
+                border = self.buffer_size - index
+                first = {key: value[:border] for key, value in kwargs.items()}
+                first_priorities = priorities if priorities is None else priorities[:border]
+                super().add(priorities=first_priorities, **first)
+                self.index = self.demo_border
+                second = {key: value[border:] for key, value in kwargs.items()}
+                second_priorities = priorities if priorities is None else priorities[border:]
+                index = super().add(priorities=second_priorities, **second)
+            else:
+                index = super().add(priorities=priorities, **kwargs)
+            self.index = max(self.index, self.demo_border)
+            return index
+
+    def add_batch(self,arrays,*,priorities = None,unchecked=True):
+        """Add already shaped and typed arrays into replay buffer.
+
+        Values are added through `add()` in order to skip demonstrations.
+        """
+        return self.add(priorities=priorities,**self._batch_kwargs(arrays))
+
+    def add_demo(self, **kwargs):
+        cdef size_t index
+        with self.lock:
+            index = self.index
+            if index > self.demo_border:
+                self.index = 0
+            index = super().add(**kwargs)
+            self.demo_border = self.index
+            return index
+
+    def resize(self,new_size):
+        """Resize buffer (Not Implemented)
+
+        Raises
+        ------
+        NotImplementedError
+            Demonstrations at the head of the buffer cannot be moved.
+        """
+        raise NotImplementedError("DQfDBuffer does not support `resize`")
+
+    def update_priorities(self,indexes,priorities):
+        """Update priorities
+
+        Parameters
+        ----------
+        indexes : array_like
+            indexes to update priorities
+        priorities : array_like
+            priorities to update
+
+        Returns
+        -------
+        """
+        cdef int i
+        cdef int idx
+        for i, idx in enumerate(indexes):
+            if idx < self.demo_border:
+                priorities[i] += self.demo_eps_difference
+        super().update_priorities(indexes, priorities)
+
+
+cdef shared_buffer(layout,name = None):
+    """Create dict of numpy.ndarray on a single shared memory block
+
+    Parameters
+    ----------
+    layout : dict of tuple
+        `(shape, dtype)` pair for each name.
+    name : str, optional
+        name of existing shared memory block to be attached. If `None`
+        (default), a new zero initialized block is created.
+
+    Returns
+    -------
+    shm : multiprocessing.shared_memory.SharedMemory
+        shared memory block
+    buffer : dict of numpy.ndarray
+        arrays which are views of the shared memory block.
+    """
+    # multiprocessing.shared_memory is available from Python 3.8, so that it
+    # is imported here in order to keep the other buffers on older versions.
+    from multiprocessing.shared_memory import SharedMemory
+
+    offsets, nbytes = packed_offsets(layout)
+    if name is None:
+        shm = SharedMemory(create=True,size=max(nbytes,1))
+    else:
+        shm = SharedMemory(name=name)
+
+    cdef buffer = {name: np.ndarray(shape,dtype=dtype,
+                                    buffer=shm.buf,offset=offsets[name])
+                   for name, (shape, dtype) in layout.items()}
+    return shm, buffer
+
+@cython.embedsignature(True)
+cdef class MPReplayBuffer:
+    """Replay buffer class shared by multiple processes.
+
+    All the values are stored at shared memory, so that the buffer can be
+    passed to other processes (e.g. `multiprocessing.Process(args=(rb,))`)
+    without copying stored values. Multiple processes can `add` concurrently
+    without lock, while a single process (e.g. learner) samples.
+    """
+    cdef env_dict
+    cdef size_t buffer_size
+    cdef buffer
+    cdef shared
+    cdef shm
+    cdef bool owner
+    cdef config
+    cdef size_t* counter
+    cdef uint64_t* seq
+    cdef StepChecker size_check
+    cdef lock
+
+    def __cinit__(self,size,env_dict=None,*,default_dtype=None,_shm=None,**kwargs):
+        self.env_dict = env_dict or {}
+        self.buffer_size = size
+        self.config = {"default_dtype": default_dtype,**kwargs}
+        self.owner = _shm is None
+
+        default_dtype = default_dtype or np.single
+
+        # counter[0]: total number of added transitions
+        # seq: sequence of each slot. Odd value means the slot is being written.
+        cdef layout = {"_counter": ((1,),np.uint64),
+                       "_seq": ((size,),np.uint64)}
+        for name, defs in self.env_dict.items():
+            shape = np.insert(np.asarray(defs.get("shape",1)),0,size)
+            layout[name] = (shape,defs.get("dtype",default_dtype))
+            shape = shape.copy()
+            shape[0] = -1
+            defs["add_shape"] = shape
+
+        shm, self.shared = shared_buffer(layout,None if self.owner else _shm[0])
+        self.shm = [shm]
+        self.buffer = {name: self.shared[name] for name in self.env_dict}
+
+        cdef np.ndarray counter = self.shared["_counter"]
+        cdef np.ndarray seq = self.shared["_seq"]
+        self.counter = <size_t*> np.PyArray_DATA(counter)
+        self.seq = <uint64_t*> np.PyArray_DATA(seq)
+
+        self.size_check = StepChecker(self.env_dict)
+        self.lock = threading.Lock()
+
+    def __init__(self,size,env_dict=None,*,default_dtype=None,**kwargs):
+        """Initialize MPReplayBuffer
+
+        Parameters
+        ----------
+        size : int
+            buffer size
         env_dict : dict of dict, optional
             dictionary specifying environments. The keies of env_dict become
             environment names. The values of env_dict, which are also dict,
             defines "shape" (default 1) and "dtypes" (fallback to `default_dtype`)
-        alpha : float, optional
-            the exponent of the priorities in stored whose default value is 0.6
-        eps : float, optional
-            small positive constant to ensure error-less state will be sampled,
-            whose default value is 1e-4.
-        check_for_update : bool
-            Whether check update for `update_priorities`. The default value is `False`
+        default_dtype : numpy.dtype, optional
+            fallback dtype for not specified in `env_dict`. default is numpy.single
+
+        Notes
+        -----
+        Memory compression (`next_of` and `stack_compress`) and `Nstep` are not
+        supported. The shared memory is released when the buffer created at the
+        first place is deleted, so that the process must keep it until the
+        other processes finish.
         """
         pass
 
-    def add(self,*,priorities = None,**kwargs):
+    def __dealloc__(self):
+        # Views must be released before the shared memory is closed.
+        self.buffer = None
+        self.shared = None
+        if self.owner and self.shm:
+            for shm in self.shm:
+                shm.unlink()
+
+    def __reduce__(self):
+        # Attach the same shared memory at unpickle
+        return (functools.partial(self.__class__,
+                                  _shm=[shm.name for shm in self.shm],
+                                  **self.config),
+                (self.buffer_size,self.env_dict))
+
+    def add(self,*,**kwargs):
         """Add environment(s) into replay buffer.
 
-        Multiple step environments can be added.
+        Multiple step environments can be added. This method can be called
+        from multiple processes concurrently.
 
         Parameters
         ----------
-        priorities : array like or float or int
-            priorities of each environment
-        **kwargs : array like or float or int optional
-            environment(s) to be stored
+        **kwargs : array like or float or int
+            environments to be stored
 
         Returns
         -------
-        : int or None
-            the stored first index. If all values store into NstepBuffer and
-            no values store into main buffer, return None.
+        : int
+            the stored first index
         """
+        return self._add(kwargs,None)
+
+    cdef size_t _add(self,kwargs,priorities) except *:
         cdef size_t N = self.size_check.step_size(kwargs)
-        if priorities is not None:
-            priorities = np.ravel(np.array(priorities,copy=False,
-                                           ndmin=1,dtype=np.single))
-            if N != priorities.shape[0]:
-                raise ValueError("`priorities` shape is imcompatible")
 
-        if self.use_nstep:
-            if priorities is None:
-                priorities = np.full((N),self.get_max_priority(),dtype=np.single)
-
-            priorities = self.priorities_nstep.add(priorities=priorities,
-                                                   done=np.array(kwargs["done"],
-                                                                 copy=True))
-            if priorities is not None:
-                priorities = np.ravel(priorities["priorities"])
-                N = priorities.shape[0]
-
-        cdef maybe_index = super().add(**kwargs)
-        if maybe_index is None:
-            return None
+        # Convert before reservation, so that invalid values never leave
+        # slots locked.
+        cdef values = {name: np.reshape(np.array(kwargs[name],copy=False,
+                                                 dtype=b.dtype),
+                                        self.env_dict[name]["add_shape"])
+                       for name, b in self.buffer.items()}
 
-        cdef size_t index = maybe_index
-        cdef float [:] ps
+        cdef size_t start = fetch_add_counter(self.counter,N)
 
-        if priorities is not None:
-            ps = np.ravel(np.array(priorities,copy=False,ndmin=1,dtype=np.single))
-            self.per.set_priorities(index,&ps[0],N,self.get_buffer_size())
-        else:
-            self.per.set_priorities(index,N,self.get_buffer_size())
+        # Only the last `buffer_size` transitions remain.
+        cdef size_t skip = N - min(N,self.buffer_size)
+        cdef size_t n = N - skip
+        cdef size_t index = (start + skip) % self.buffer_size
+        cdef size_t end = index + n
 
-        if self.check_for_update:
-            if index+N <= self.buffer_size:
-                self.unchange_since_sample[index:index+N] = False
+        write_sequences(self.seq,index,n,self.buffer_size,True)
+        for name, b in self.buffer.items():
+            v = values[name][skip:]
+            if end <= self.buffer_size:
+                b[index:end] = v
             else:
-                self.unchange_since_sample[index:] = False
-                self.unchange_since_sample[:index+N-self.buffer_size] = False
+                b[index:] = v[:self.buffer_size - index]
+                b[:end - self.buffer_size] = v[self.buffer_size - index:]
+        self._set_priorities(index,n,priorities,skip)
+        write_sequences(self.seq,index,n,self.buffer_size,False)
 
         return index
 
-    def sample(self,batch_size,beta = 0.4):
-        """Sample the stored environment depending on correspoinding priorities
-        with speciped size
+    cdef void _set_priorities(self,size_t index,size_t N,priorities,
+                              size_t skip) except *:
+        pass
+
+    cdef _encode_sample(self,idx):
+        """Encode sample
+
+        Returns
+        -------
+        sample : dict of numpy.ndarray
+            sampled values
+        invalid : numpy.ndarray of bool
+            whether sampled row was being written
+        """
+        cdef size_t [::1] _idx = Csize(idx)
+        cdef size_t N = _idx.shape[0]
+        cdef uint64_t [::1] before = np.empty(N,dtype=np.uint64)
+        cdef uint64_t [::1] after = np.empty(N,dtype=np.uint64)
+
+        read_sequences(self.seq,&_idx[0],N,&before[0],True)
+        idx = np.asarray(idx).astype(np.intp,copy=False)
+        cdef sample = {name: np.take(b,idx,axis=0)
+                       for name, b in self.buffer.items()}
+        read_sequences(self.seq,&_idx[0],N,&after[0],False)
+
+        _before = np.asarray(before)
+        return sample, ((_before != np.asarray(after))
+                        | (_before % 2 == 1)
+                        | (_before == 0))
+
+    cdef _draw(self,size_t batch_size,beta):
+        return np.random.randint(0,self.get_stored_size(),batch_size), {}
+
+    cdef _sample(self,size_t batch_size,beta):
+        idx, extra = self._draw(batch_size,beta)
+        cdef sample
+        cdef invalid
+        sample, invalid = self._encode_sample(idx)
+
+        # Redraw rows which were overwritten during sampling.
+        while invalid.any():
+            redraw, redraw_extra = self._draw(np.count_nonzero(invalid),beta)
+            redraw_sample, redraw_invalid = self._encode_sample(redraw)
+            for name, v in redraw_sample.items():
+                sample[name][invalid] = v
+            for name, v in redraw_extra.items():
+                extra[name][invalid] = v
+            idx[invalid] = redraw
+            invalid[invalid] = redraw_invalid
+
+        sample = {name: np.squeeze(v) for name, v in sample.items()}
+        sample.update(extra)
+        return sample, idx
+
+    def sample(self,batch_size):
+        """Sample the stored environment randomly with speciped size
+
+        Rows being written by other processes are not sampled.
 
         Parameters
         ----------
         batch_size : int
             sampled batch size
-        beta : float, optional
-            the exponent for discount priority effect whose default value is 0.4
 
         Returns
         -------
         sample : dict of ndarray
-            batch size of samples which also includes 'weights' and 'indexes'
-
-
-        Notes
-        -----
-        When 'beta' is 0, priorities are ignored.
-        The greater 'beta', the bigger effect of priories.
-
-        The sampling probabilities are propotional to :math:`priorities ^ {-'beta'}`
+            batch size of samples.
         """
-        self.per.sample(batch_size,beta,
-                        self.weights.vec,self.indexes.vec,
-                        self.get_stored_size())
-        cdef idx = self.indexes.as_numpy()
-        samples = self._encode_sample(idx)
-        samples['weights'] = self.weights.as_numpy()
-        samples['indexes'] = idx
-
-        if self.check_for_update:
-            self.unchange_since_sample[:] = True
-
-        return samples
-
-    def update_priorities(self,indexes,priorities):
-        """Update priorities
+        with self.lock:
+            return self._sample(batch_size,None)[0]
 
-        Parameters
-        ----------
-        indexes : array_like
-            indexes to update priorities
-        priorities : array_like
-            priorities to update
+    def get_all_transitions(self):
+        """Get all transitions stored in replay buffer.
 
         Returns
         -------
+        transitions : dict of numpy.ndarray
+            All transitions stored in this replay buffer.
         """
-        cdef size_t [:] idx = Csize(indexes)
-        cdef float [:] ps = Cfloat(priorities)
+        cdef size_t stored = self.get_stored_size()
+        return {name: b[:stored].copy() for name, b in self.buffer.items()}
 
-        cdef size_t _idx = 0
-        if self.check_for_update:
-            for _i in range(idx.shape[0]):
-                if self.unchange_since_sample[idx[_i]]:
-                    idx[_idx] = idx[_i]
-                    ps[_idx] = ps[_i]
-                    _idx += 1
-            idx = idx[:_idx]
-            ps = ps[:_idx]
+    cpdef size_t get_stored_size(self):
+        """Get stored size
 
+        Returns
+        -------
+        : size_t
+            stored size
+        """
+        return min(load_counter(self.counter),self.buffer_size)
 
-        cdef N = idx.shape[0]
-        if N > 0:
-            self.per.update_priorities(&idx[0],&ps[0],N)
+    cpdef size_t get_next_index(self):
+        """Get the next index to store
 
-    cpdef void clear(self) except *:
-        """Clear replay buffer
+        Returns
+        -------
+        : size_t
+            the next index to store
         """
-        super(PrioritizedReplayBuffer,self).clear()
-        clear(self.per)
-        if self.use_nstep:
-            self.priorities_nstep.clear()
+        return load_counter(self.counter) % self.buffer_size
 
-    cpdef float get_max_priority(self):
-        """Get the max priority of stored priorities
+    cpdef size_t get_buffer_size(self):
+        """Get buffer size
 
         Returns
         -------
-        max_priority : float
-            the max priority of stored priorities
+        : size_t
+            buffer size
         """
-        return self.per.get_max_priority()
+        return self.buffer_size
+
+    cpdef void clear(self) except *:
+        """Clear replay buffer.
+
+        This method must not be called while other processes are adding.
+        """
+        store_counter(self.counter,0)
+        self.shared["_seq"][:] = 0
 
-    cpdef void on_episode_end(self):
+    def on_episode_end(self):
         """Call on episode end
 
         Notes
         -----
-        This is necessary for stack compression (stack_compress) mode or next
-        compression (next_of) mode.
+        Nothing is done, since memory compression is not supported.
         """
-        if self.use_nstep:
-            self.use_nstep = False
-            self.add(**self.nstep.on_episode_end(),
-                     **self.priorities_nstep.on_episode_end())
-            self.use_nstep = True
+        pass
+
+@cython.embedsignature(True)
+cdef class MPPrioritizedReplayBuffer(MPReplayBuffer):
+    """Prioritized replay buffer class shared by multiple processes.
+
+    Priorities (sum and min trees, their change flags, and the max priority)
+    are also stored at shared memory. Trees are lazily updated at sampling,
+    so that `add` from other processes only writes leaves.
+    """
+    cdef float alpha
+    cdef CppThreadSafePrioritizedSampler[float]* per
+    cdef VectorFloat weights
+    cdef VectorSize_t indexes
 
-        if self.cache is not None:
-            self.add_cache()
+    def __cinit__(self,size,env_dict=None,*,alpha=0.6,eps=1e-4,_shm=None,
+                  **kwargs):
+        self.alpha = alpha
+        self.config.update(alpha=alpha,eps=eps)
+
+        cdef size_t n = 1
+        while n < size:
+            n *= 2
+
+        cdef layout = {"max_priority": ((1,),np.single),
+                       "sum": ((2*n-1,),np.single),
+                       "sum_anychanged": ((1,),np.bool_),
+                       "sum_changed": ((n,),np.bool_),
+                       "min": ((2*n-1,),np.single),
+                       "min_anychanged": ((1,),np.bool_),
+                       "min_changed": ((n,),np.bool_)}
+        shm, priorities = shared_buffer(layout,None if self.owner else _shm[1])
+        self.shm.append(shm)
+        self.shared.update({f"_{name}": v for name, v in priorities.items()})
+
+        cdef np.ndarray max_p = priorities["max_priority"]
+        cdef np.ndarray sum_p = priorities["sum"]
+        cdef np.ndarray sum_any = priorities["sum_anychanged"]
+        cdef np.ndarray sum_changed = priorities["sum_changed"]
+        cdef np.ndarray min_p = priorities["min"]
+        cdef np.ndarray min_any = priorities["min_anychanged"]
+        cdef np.ndarray min_changed = priorities["min_changed"]
+        self.per = new CppThreadSafePrioritizedSampler[float](
+            size,alpha,
+            <float*> np.PyArray_DATA(max_p),
+            <float*> np.PyArray_DATA(sum_p),
+            <bool*> np.PyArray_DATA(sum_any),
+            <bool*> np.PyArray_DATA(sum_changed),
+            <float*> np.PyArray_DATA(min_p),
+            <bool*> np.PyArray_DATA(min_any),
+            <bool*> np.PyArray_DATA(min_changed),
+            self.owner,eps)
+        self.weights = VectorFloat()
+        self.indexes = VectorSize_t()
 
+    def __init__(self,size,env_dict=None,*,alpha=0.6,eps=1e-4,**kwargs):
+        """Initialize MPPrioritizedReplayBuffer
 
-@cython.embedsignature(True)
-cdef class DQfDBuffer(PrioritizedReplayBuffer):
-    cdef int demo_border
-    cdef float demo_eps_difference
-    def __cinit__(self, size, env_dict=None,*, eps=1e-4, demo_eps=1.,**kwrags):
-        self.demo_eps_difference = demo_eps - eps
-        self.demo_border = 0
+        Parameters
+        ----------
+        size : int
+            buffer size
+        env_dict : dict of dict, optional
+            dictionary specifying environments. The keies of env_dict become
+            environment names. The values of env_dict, which are also dict,
+            defines "shape" (default 1) and "dtypes" (fallback to `default_dtype`)
+        alpha : float, optional
+            the exponent of the priorities in stored whose default value is 0.6
+        eps : float, optional
+            small positive constant to ensure error-less state will be sampled,
+            whose default value is 1e-4.
 
-    def __init__(self,size, env_dict=None,*, demo_eps=1.,**kwrags):
+        Notes
+        -----
+        `sample` and `update_priorities` must be called from a single process.
+        """
         pass
 
+    def __dealloc__(self):
+        del self.per
+
     def add(self,*,priorities = None,**kwargs):
         """Add environment(s) into replay buffer.
 
-        Multiple step environments can be added.
+        Multiple step environments can be added. This method can be called
+        from multiple processes concurrently.
 
         Parameters
         ----------
-        priorities : array like or float or int
-            priorities of each environment
+        priorities : array like or float or int, optional
+            priorities of each environment. If `None` (default), the max
+            priority is used.
         **kwargs : array like or float or int optional
             environment(s) to be stored
 
         Returns
         -------
-        : int or None
-            the stored first index. If all values store into NstepBuffer and
-            no values store into main buffer, return None.
+        : int
+            the stored first index
         """
-        cdef size_t N = self.size_check.step_size(kwargs)
-        cdef size_t index = self.index
-        cdef size_t end = index + N
+        if priorities is not None:
+            priorities = np.ravel(np.array(priorities,copy=False,
+                                           ndmin=1,dtype=np.single))
+            if self.size_check.step_size(kwargs) != priorities.shape[0]:
+                raise ValueError("`priorities` shape is imcompatible")
+        return self._add(kwargs,priorities)
 
-        if end > self.buffer_size:
-            border = self.buffer_size - index
-            first = {key: value[:border] for key, value in kwargs.items()}
-            first_priorities = priorities if priorities is None else priorities[:border]
-            super().add(priorities=first_priorities, **first)
-            self.index = self.demo_border
-            second = {key: value[border:] for key, value in kwargs.items()}
-            second_priorities = priorities if priorities is None else priorities[border:]
-            index = super().add(priorities=second_priorities, **second)
+    cdef void _set_priorities(self,size_t index,size_t N,priorities,
+                              size_t skip) except *:
+        cdef float [:] ps
+        if priorities is not None:
+            ps = priorities[skip:]
+            self.per.set_priorities(index,&ps[0],N,self.buffer_size)
         else:
-            index = super().add(priorities=priorities, **kwargs)
-        self.index = max(self.index, self.demo_border)
-        return index
+            self.per.set_priorities(index,N,self.buffer_size)
 
-    def add_demo(self, **kwargs):
-        cdef size_t index = self.index
-        if index > self.demo_border:
-            self.index = 0
-        index = super().add(**kwargs)
-        self.demo_border = self.index
-        return index
+    cdef _draw(self,size_t batch_size,beta):
+        self.per.sample(batch_size,beta,
+                        self.weights.vec,self.indexes.vec,
+                        self.get_stored_size())
+        return (self.indexes.as_numpy(copy=True),
+                {"weights": self.weights.as_numpy(copy=True)})
+
+    def sample(self,batch_size,beta = 0.4):
+        """Sample the stored environment depending on correspoinding priorities
+        with speciped size
+
+        Rows being written by other processes are not sampled.
+
+        Parameters
+        ----------
+        batch_size : int
+            sampled batch size
+        beta : float, optional
+            the exponent for discount priority effect whose default value is 0.4
+
+        Returns
+        -------
+        sample : dict of ndarray
+            batch size of samples which also includes 'weights' and 'indexes'
+        """
+        with self.lock:
+            sample, idx = self._sample(batch_size,beta)
+        sample["indexes"] = idx
+        return sample
 
     def update_priorities(self,indexes,priorities):
         """Update priorities
@@ -1303,17 +3919,32 @@ cdef class DQfDBuffer(PrioritizedReplayBuffer):
             indexes to update priorities
         priorities : array_like
             priorities to update
+        """
+        cdef size_t [:] idx = Csize(indexes)
+        cdef float [:] ps = Cfloat(priorities)
+        cdef size_t N = idx.shape[0]
+        if N > 0:
+            with self.lock:
+                self.per.update_priorities(&idx[0],&ps[0],N)
+
+    cpdef void clear(self) except *:
+        """Clear replay buffer
+
+        This method must not be called while other processes are adding.
+        """
+        with self.lock:
+            super().clear()
+            self.per.clear()
+
+    cpdef float get_max_priority(self):
+        """Get the max priority of stored priorities
 
         Returns
         -------
+        max_priority : float
+            the max priority of stored priorities
         """
-        cdef int i
-        cdef int idx
-        for i, idx in enumerate(indexes):
-            if idx < self.demo_border:
-                priorities[i] += self.demo_eps_difference
-        super().update_priorities(indexes, priorities)
-
+        return self.per.get_max_priority()
 
 def create_buffer(size,env_dict=None,*,prioritized = False,**kwargs):
     """Create specified version of replay buffer
@@ -13,10 +13,22 @@
 #include <atomic>
 #include <memory>
 #include <mutex>
+#include <condition_variable>
+#include <future>
 #include <numeric>
+#include <thread>
+#include <cstring>
+#include <cstddef>
+#include <cstdint>
+#include <variant>
+#include <stdexcept>
 
 #include "SegmentTree.hh"
 
+#ifndef _WIN32
+#include <unistd.h>
+#endif
+
 namespace ymd {
 
   template<typename Buffer> inline void clear(Buffer* b){ b->clear(); }
@@ -27,6 +39,146 @@ namespace ymd {
   template<typename Buffer>
   inline std::size_t get_stored_size(Buffer* b){ return b->get_stored_size(); }
 
+  class ThreadPool {
+    // Persistent worker threads shared by parallel_for. Workers are detached
+    // and the pool is never destroyed, so that no thread is joined at exit.
+  private:
+    std::size_t n_workers;
+    std::deque<std::function<void()>> tasks;
+    std::mutex mtx;
+    std::condition_variable cv;
+
+    void work(){
+      while(true){
+	auto task = std::function<void()>{};
+	{
+	  auto lock = std::unique_lock<std::mutex>{mtx};
+	  cv.wait(lock,[this](){ return !tasks.empty(); });
+	  task = std::move(tasks.front());
+	  tasks.pop_front();
+	}
+	task();
+      }
+    }
+
+    static long pid(){
+#ifdef _WIN32
+      return 0;
+#else
+      return static_cast<long>(::getpid());
+#endif
+    }
+
+  public:
+    ThreadPool(): n_workers{0}, tasks{}, mtx{}, cv{} {}
+
+    static ThreadPool& instance(){
+      // A forked child has no workers, so that it creates its own pool.
+      static auto owner = pid();
+      static auto pool = new ThreadPool{};
+      static auto mtx = std::mutex{};
+      auto lock = std::lock_guard<std::mutex>{mtx};
+      if(owner != pid()){
+	owner = pid();
+	pool = new ThreadPool{};
+      }
+      return *pool;
+    }
+
+    template<typename F>
+    std::future<void> submit(F&& f,std::size_t n_workers){
+      auto task = std::make_shared<std::packaged_task<void()>>(std::forward<F>(f));
+      auto future = task->get_future();
+      {
+	auto lock = std::lock_guard<std::mutex>{mtx};
+	for(; this->n_workers < n_workers; ++this->n_workers){
+	  std::thread{[this](){ this->work(); }}.detach();
+	}
+	tasks.emplace_back([task](){ (*task)(); });
+      }
+      cv.notify_one();
+      return future;
+    }
+  };
+
+  template<typename F>
+  inline void parallel_for(std::size_t N,std::size_t n_threads,F&& f){
+    // Call f(begin,end) for contiguous chunks of [0,N) over n_threads threads.
+    // The first chunk runs on the calling thread, and the others run on
+    // workers of the shared ThreadPool.
+    n_threads = std::max(std::min(n_threads,N),std::size_t(1));
+    const auto chunk = (N + n_threads - 1)/n_threads;
+
+    auto futures = std::vector<std::future<void>>{};
+    if(n_threads > 1){
+      auto& pool = ThreadPool::instance();
+      futures.reserve(n_threads - 1);
+      for(std::size_t begin = chunk; begin < N; begin += chunk){
+	const auto end = std::min(begin + chunk,N);
+	futures.push_back(pool.submit([&f,begin,end](){ f(begin,end); },
+				      n_threads - 1));
+      }
+    }
+
+    f(std::size_t(0),std::min(chunk,N));
+    for(auto& w: futures){ w.get(); }
+  }
+
+  struct SplitMix64 {
+    // Small random number generator, whose streams are cheap to seed
+    using result_type = std::uint64_t;
+    std::uint64_t state;
+
+    static constexpr result_type min(){ return result_type(0); }
+    static constexpr result_type max(){ return ~result_type(0); }
+
+    result_type operator()(){
+      auto z = (state += 0x9e3779b97f4a7c15ull);
+      z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ull;
+      z = (z ^ (z >> 27)) * 0x94d049bb133111ebull;
+      return z ^ (z >> 31);
+    }
+  };
+
+  struct GatherField {
+    // Copy src[index[i]] (or alt_src[alt_index[i]] if alt_index[i] >= 0)
+    // into i-th row of dst.
+    const char* src;
+    std::size_t src_stride;
+    char* dst;
+    std::size_t row_bytes;
+    const std::size_t* index;
+    const char* alt_src;
+    std::size_t alt_stride;
+    const std::ptrdiff_t* alt_index;
+
+    const char* row(std::size_t i) const noexcept {
+      if(alt_index && (alt_index[i] >= 0)){
+	return alt_src + alt_index[i] * alt_stride;
+      }
+      return src + index[i] * src_stride;
+    }
+  };
+
+  inline void gather(const std::vector<GatherField>& fields,
+		     std::size_t batch_size,std::size_t n_threads = 1,
+		     std::size_t min_bytes_per_thread = std::size_t(1) << 18){
+    // Gather all the fields in a single pass over batch indices.
+    auto row_bytes = std::size_t(0);
+    for(const auto& f: fields){ row_bytes += f.row_bytes; }
+    n_threads = std::min(n_threads,
+			 (row_bytes * batch_size) / min_bytes_per_thread);
+
+    parallel_for(batch_size,n_threads,
+		 [&fields](std::size_t begin,std::size_t end){
+		   for(auto i = begin; i < end; ++i){
+		     for(const auto& f: fields){
+		       std::memcpy(f.dst + i * f.row_bytes,f.row(i),f.row_bytes);
+		     }
+		   }
+		 });
+  }
+
   template<typename T>
   class DimensionalBuffer {
   private:
@@ -163,6 +315,46 @@ namespace ymd {
     }
   };
 
+  // Helpers for buffer shared between processes.
+  // `counter` and `seq` are plain memory (e.g. shared memory), which are
+  // accessed as lock-free atomics.
+  inline std::size_t fetch_add_counter(std::size_t* counter,std::size_t N){
+    return ThreadSafe<true,std::size_t>::fetch_add((std::atomic<std::size_t>*)counter,
+						   N,std::memory_order_acq_rel);
+  }
+
+  inline std::size_t load_counter(const std::size_t* counter){
+    return ThreadSafe<true,std::size_t>::load((const std::atomic<std::size_t>*)counter,
+					      std::memory_order_acquire);
+  }
+
+  inline void store_counter(std::size_t* counter,std::size_t v){
+    ThreadSafe<true,std::size_t>::store((std::atomic<std::size_t>*)counter,
+					v,std::memory_order_release);
+  }
+
+  inline void write_sequences(std::uint64_t* seq,std::size_t first,std::size_t N,
+			      std::size_t buffer_size,bool begin){
+    // Sequence lock of slots [first, first+N) in ring.
+    // Odd sequence means the slot is being written.
+    if(!begin){ std::atomic_thread_fence(std::memory_order_seq_cst); }
+    for(std::size_t i = 0; i < N; ++i){
+      auto s = (std::atomic<std::uint64_t>*)(seq + (first + i) % buffer_size);
+      s->fetch_add(1,std::memory_order_acq_rel);
+    }
+    if(begin){ std::atomic_thread_fence(std::memory_order_seq_cst); }
+  }
+
+  inline void read_sequences(const std::uint64_t* seq,const std::size_t* index,
+			     std::size_t N,std::uint64_t* out,bool before){
+    if(!before){ std::atomic_thread_fence(std::memory_order_seq_cst); }
+    for(std::size_t i = 0; i < N; ++i){
+      auto s = (const std::atomic<std::uint64_t>*)(seq + index[i]);
+      out[i] = s->load(std::memory_order_acquire);
+    }
+    if(before){ std::atomic_thread_fence(std::memory_order_seq_cst); }
+  }
+
   template<typename Observation,typename Action,typename Reward,typename Done>
   class CppSelectiveEnvironment :public Environment<Observation,Action,Reward,Done>{
   public:
@@ -302,61 +494,118 @@ namespace ymd {
   class CppPrioritizedSampler {
   private:
     using ThreadSafePriority_t = ThreadSafe<MultiThread,Priority>;
+    using SumTree_t = std::variant<SegmentTree<Priority,MultiThread,Sum<Priority>>,
+				   KarySumTree<Priority,4>,
+				   KarySumTree<Priority,8>>;
     Priority alpha;
     typename ThreadSafePriority_t::type* max_priority;
     std::shared_ptr<typename ThreadSafePriority_t::type> max_priority_view;
     const Priority default_max_priority;
-    SegmentTree<Priority,MultiThread> sum;
-    SegmentTree<Priority,MultiThread> min;
+    SumTree_t sum;
+    SegmentTree<Priority,MultiThread,Min<Priority>> min;
     std::mt19937 g;
     Priority eps;
+    std::size_t sample_threads;
+
+    // Number of strata drawn from a random stream
+    static constexpr const std::size_t sample_block = 1024;
+
+    std::size_t n_threads(std::size_t N) const {
+      // Inner nodes of thread safe trees are lazily updated by a reader.
+      if constexpr (MultiThread){ return 1; }
+      return std::min(sample_threads,(N + sample_block - 1) / sample_block);
+    }
+
+    static SumTree_t make_sum(std::size_t buffer_size,std::size_t arity,
+			      Priority* sum_ptr,
+			      bool* sum_anychanged,bool* sum_changed,
+			      bool initialize){
+      // K-ary trees own their buffers, and are not thread safe.
+      if((arity != 2) && (MultiThread || sum_ptr)){
+	throw std::invalid_argument("K-ary sum tree supports neither "
+				    "thread safety nor external buffer");
+      }
+
+      switch(arity){
+      case 2:
+	return SegmentTree<Priority,MultiThread,Sum<Priority>>{
+	  buffer_size,Sum<Priority>{},Priority{0},
+	  sum_ptr,sum_anychanged,sum_changed,initialize};
+      case 4:
+	return KarySumTree<Priority,4>{buffer_size};
+      case 8:
+	return KarySumTree<Priority,8>{buffer_size};
+      default:
+	throw std::invalid_argument("Arity of sum tree must be 2, 4, or 8");
+      }
+    }
+
+    Priority total_priority(std::size_t start,std::size_t end){
+      return std::visit([=](auto& s){ return s.reduce(start,end); },sum);
+    }
 
     void sample_proportional(std::size_t batch_size,
 			     std::vector<std::size_t>& indexes,
 			     std::size_t stored_size){
-      indexes.resize(0);
-      indexes.reserve(batch_size);
+      indexes.resize(batch_size);
 
       auto every_range_len
-	= Priority{1.0} * sum.reduce(0,stored_size) / batch_size;
-
-      std::generate_n(std::back_inserter(indexes),batch_size,
-		      [=,i=std::size_t(0),
-		       d=std::uniform_real_distribution<Priority>{}]()mutable{
-			auto mass = (d(this->g) + (i++))*every_range_len;
-			return this->sum.largest_region_index([=](auto v){
-								return v <= mass;
-							      },stored_size);
-		      });
+	= Priority{1.0} * total_priority(0,stored_size) / batch_size;
+
+      // Each block of strata has its own random stream seeded from g, so
+      // that blocks are drawn in parallel, and the results are independent of
+      // the number of threads. Sorted masses of a block are descended together.
+      const auto seed = (std::uint64_t(g()) << 32) | g();
+      auto masses = std::vector<Priority>(batch_size);
+      std::visit([&](auto& s){
+	parallel_for((batch_size + sample_block - 1) / sample_block,
+		     n_threads(batch_size),
+		     [&](auto b_begin,auto b_end){
+		       for(auto b = b_begin; b < b_end; ++b){
+			 const auto begin = b * sample_block;
+			 const auto end = std::min(begin + sample_block,batch_size);
+			 auto rng = SplitMix64{SplitMix64{seed + b}()};
+			 auto d = std::uniform_real_distribution<Priority>{};
+			 for(auto i = begin; i < end; ++i){
+			   masses[i] = (d(rng) + i) * every_range_len;
+			 }
+			 s.prefix_sum_indexes(masses.data() + begin,end - begin,
+					      indexes.data() + begin,stored_size);
+		       }
+		     });
+      },sum);
     }
 
     void set_weights(const std::vector<std::size_t>& indexes,Priority beta,
 		     std::vector<Priority>& weights,std::size_t stored_size) {
-      weights.resize(0);
-      weights.reserve(indexes.size());
+      weights.resize(indexes.size());
 
       auto b_size = stored_size;
-      auto inv_sum = Priority{1.0} / sum.reduce(0,b_size);
+      auto inv_sum = Priority{1.0} / total_priority(0,b_size);
       auto p_min = min.reduce(0,b_size) * inv_sum;
       auto inv_max_weight = Priority{1.0} / std::pow(p_min * b_size,-beta);
 
-      std::transform(indexes.begin(),indexes.end(),std::back_inserter(weights),
-		     [=](auto idx){
-		       auto p_sample = this->sum.get(idx) * inv_sum;
-		       return std::pow(p_sample*b_size,-beta)*inv_max_weight;
+      std::visit([&](auto& s){
+	parallel_for(indexes.size(),n_threads(indexes.size()),
+		     [&](auto begin,auto end){
+		       for(auto i = begin; i < end; ++i){
+			 auto p_sample = s.get(indexes[i]) * inv_sum;
+			 weights[i] = std::pow(p_sample*b_size,-beta)*inv_max_weight;
+		       }
 		     });
+      },sum);
     }
 
     template<typename F>
     void set_priorities(std::size_t next_index,F&& f,
 			std::size_t N,std::size_t buffer_size){
-      sum.set(next_index,std::forward<F>(f),N,buffer_size);
+      std::visit([&](auto& s){ s.set(next_index,f,N,buffer_size); },sum);
       min.set(next_index,std::forward<F>(f),N,buffer_size);
     }
 
     void set_priority(std::size_t next_index,Priority p){
       auto v = std::pow(p+eps,alpha);
-      sum.set(next_index,v);
+      std::visit([=](auto& s){ s.set(next_index,v); },sum);
       min.set(next_index,v);
     }
 
@@ -368,19 +617,20 @@ namespace ymd {
 			  Priority* min_ptr = nullptr,
 			  bool* min_anychanged = nullptr,bool* min_changed = nullptr,
 			  bool initialize = true,
-			  Priority eps = Priority{1e-4})
+			  Priority eps = Priority{1e-4},
+			  std::size_t arity = 2)
       : alpha{alpha},
 	max_priority{(typename ThreadSafePriority_t::type*)max_p},
 	max_priority_view{},
 	default_max_priority{1.0},
-	sum{PowerOf2(buffer_size),[](auto a,auto b){ return a+b; },
-	    Priority{0},
-	    sum_ptr,sum_anychanged,sum_changed,initialize},
-	min{PowerOf2(buffer_size),[](Priority a,Priority b){ return  std::min(a,b); },
+	sum{make_sum(PowerOf2(buffer_size),arity,
+		     sum_ptr,sum_anychanged,sum_changed,initialize)},
+	min{PowerOf2(buffer_size),Min<Priority>{},
 	    std::numeric_limits<Priority>::max(),
 	    min_ptr,min_anychanged,min_changed,initialize},
 	g{std::random_device{}()},
-	eps{eps}
+	eps{eps},
+	sample_threads{1}
     {
       if(!max_priority){
 	max_priority = new typename ThreadSafePriority_t::type{};
@@ -407,7 +657,7 @@ namespace ymd {
     virtual void clear(){
       ThreadSafePriority_t::store(max_priority,default_max_priority,
 				  std::memory_order_release);
-      sum.clear();
+      std::visit([](auto& s){ s.clear(); },sum);
       min.clear(std::numeric_limits<Priority>::max());
     }
 
@@ -455,20 +705,19 @@ namespace ymd {
 	     std::enable_if_t<std::is_convertible_v<P,Priority>,
 			      std::nullptr_t> = nullptr>
     void update_priorities(I* indexes, P* priorities,std::size_t N =1){
+      if(!N){ return; }
 
-      const auto max_p =
-	std::accumulate(indexes,indexes+N,
-			ThreadSafePriority_t::load(max_priority,
-						   std::memory_order_acquire),
-			[=,p=priorities]
-			(auto max_p, auto index) mutable {
-			  Priority v = std::pow(*p + this->eps,this->alpha);
-			  this->sum.set(index,v);
-			  this->min.set(index,v);
+      // Transformed once, and set into both trees in batch. Indexes need not
+      // be sorted; the last value is set for duplicated index.
+      auto v = std::vector<Priority>{};
+      v.reserve(N);
+      std::transform(priorities,priorities+N,std::back_inserter(v),
+		     [=](auto p){ return std::pow(p + this->eps,this->alpha); });
+      std::visit([&](auto& s){ s.set(indexes,v.data(),N); },sum);
+      min.set(indexes,v.data(),N);
 
-			  return std::max<Priority>(max_p,*(p++));
-			});
-      ThreadSafePriority_t::store_max(max_priority,max_p);
+      ThreadSafePriority_t::store_max(max_priority,
+				      *std::max_element(priorities,priorities+N));
     }
 
     template<typename I,typename P,
@@ -483,9 +732,66 @@ namespace ymd {
 			std::min(indexes.size(),priorities.size()));
     }
 
+    template<typename I,
+	     std::enable_if_t<std::is_convertible_v<I,std::size_t>,
+			      std::nullptr_t> = nullptr>
+    void get_window_priorities(const I* starts,std::size_t N,std::size_t length,
+			       std::size_t stride,std::size_t buffer_size,
+			       Priority* window){
+      // Sum of (priority + eps)^alpha over start + k * stride (k < length)
+      // in ring order
+      std::visit([&](auto& s){
+	std::transform(starts,starts+N,window,
+		       [=,&s](auto start){
+			 if(stride != 1){
+			   auto p = Priority{0};
+			   for(std::size_t k = 0; k < length; ++k){
+			     p += s.get((start + k*stride) % buffer_size);
+			   }
+			   return p;
+			 }
+
+			 const std::size_t end = start + length;
+			 if(end <= buffer_size){ return s.reduce(start,end); }
+			 return (s.reduce(start,buffer_size) +
+				 s.reduce(0,end - buffer_size));
+		       });
+      },sum);
+    }
+
     void set_eps(Priority eps){
       this->eps = eps;
     }
+
+    void set_sample_threads(std::size_t n){
+      // Blocks of strata and weights are computed over n threads.
+      // (Thread safe sampler samples with a single thread.)
+      sample_threads = std::max(n,std::size_t(1));
+    }
+
+    void seed(std::uint32_t s){
+      g.seed(s);
+    }
+
+    void set_max_priority(Priority p){
+      ThreadSafePriority_t::store(max_priority,p,std::memory_order_release);
+    }
+
+    template<typename I,
+	     std::enable_if_t<std::is_convertible_v<I,std::size_t>,
+			      std::nullptr_t> = nullptr>
+    void get_leaves(const I* indexes,std::size_t N,Priority* leaves) const {
+      // Transformed priorities, (priority + eps)^alpha
+      std::visit([&](const auto& s){
+	std::transform(indexes,indexes+N,leaves,[&](auto i){ return s.get(i); });
+      },sum);
+    }
+
+    void set_leaves(const Priority* leaves,std::size_t N){
+      // Replace transformed priorities of [0,N) and rebuild trees in O(n)
+      std::visit([&](auto& s){ s.assign(leaves,N); },sum);
+      min.assign(leaves,N);
+    }
   };
 
   template<typename Priority>
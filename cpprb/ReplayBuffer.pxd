@@ -1,5 +1,6 @@
 from libcpp.vector cimport vector
 from libcpp cimport bool
+from libc.stdint cimport uint32_t, uint64_t
 
 cdef extern from "ReplayBuffer.hh" namespace "ymd":
     void clear[B](B*)
@@ -7,6 +8,23 @@ cdef extern from "ReplayBuffer.hh" namespace "ymd":
     size_t get_stored_size[B](B*)
     size_t get_next_index[B](B*)
 
+    cdef cppclass GatherField:
+        const char* src
+        size_t src_stride
+        char* dst
+        size_t row_bytes
+        const size_t* index
+        const char* alt_src
+        size_t alt_stride
+        const Py_ssize_t* alt_index
+    void gather(vector[GatherField]&,size_t,size_t) nogil
+
+    size_t fetch_add_counter(size_t*,size_t) nogil
+    size_t load_counter(const size_t*) nogil
+    void store_counter(size_t*,size_t) nogil
+    void write_sequences(uint64_t*,size_t,size_t,size_t,bool) nogil
+    void read_sequences(const uint64_t*,const size_t*,size_t,uint64_t*,bool) nogil
+
     cdef cppclass CppSelectiveEnvironment[Obs,Act,Rew,Done]:
         CppSelectiveEnvironment(size_t,size_t,size_t,size_t,size_t) except +
         size_t store[O,A,R,NO,D](O*,A*,R*,NO*,D*,size_t)
@@ -17,11 +35,41 @@ cdef extern from "ReplayBuffer.hh" namespace "ymd":
         void get_buffer_pointers(Obs*&,Act*&,Rew*&,Obs*&,Done*&)
     cdef cppclass CppPrioritizedSampler[Prio]:
         CppPrioritizedSampler(size_t,Prio) except +
+        CppPrioritizedSampler(size_t,Prio,Prio*,
+                              Prio*,bool*,bool*,
+                              Prio*,bool*,bool*,
+                              bool,Prio) except +
+        CppPrioritizedSampler(size_t,Prio,Prio*,
+                              Prio*,bool*,bool*,
+                              Prio*,bool*,bool*,
+                              bool,Prio,size_t) except +
         void sample(size_t,Prio,vector[Prio]&,vector[size_t]&,size_t)
         void set_priorities(size_t)
         void set_priorities[P](size_t,P)
         void set_priorities(size_t,size_t,size_t)
         void set_priorities[P](size_t,P*,size_t,size_t)
         void update_priorities[I,P](I*,P*,size_t)
+        void get_window_priorities[I](I*,size_t,size_t,size_t,size_t,Prio*)
         Prio get_max_priority()
         void set_eps(Prio)
+        void set_max_priority(Prio)
+        void get_leaves[I](I*,size_t,Prio*)
+        void set_leaves(Prio*,size_t)
+        void set_sample_threads(size_t)
+        void seed(uint32_t)
+    cdef cppclass CppThreadSafePrioritizedSampler[Prio]:
+        CppThreadSafePrioritizedSampler(size_t,Prio,Prio*,
+                                        Prio*,bool*,bool*,
+                                        Prio*,bool*,bool*,
+                                        bool,Prio) except +
+        void sample(size_t,Prio,vector[Prio]&,vector[size_t]&,size_t) nogil
+        void set_priorities(size_t,size_t,size_t) nogil
+        void set_priorities[P](size_t,P*,size_t,size_t) nogil
+        void update_priorities[I,P](I*,P*,size_t) nogil
+        void get_window_priorities[I](I*,size_t,size_t,size_t,size_t,Prio*) nogil
+        void clear() nogil
+        Prio get_max_priority() nogil
+        void set_max_priority(Prio)
+        void get_leaves[I](I*,size_t,Prio*)
+        void set_leaves(Prio*,size_t)
+        void seed(uint32_t)
@@ -2,12 +2,22 @@
 #define YMD_SEGMENTTREE_HH 1
 
 #include <type_traits>
+#include <algorithm>
 #include <functional>
 #include <utility>
 #include <vector>
-#include <set>
 #include <atomic>
 #include <memory>
+#include <new>
+
+#if defined(_MSC_VER) && (defined(_M_X64) || defined(_M_IX86))
+#include <xmmintrin.h>
+#define YMD_PREFETCH(p) _mm_prefetch(reinterpret_cast<const char*>(p),_MM_HINT_T0)
+#elif defined(__GNUC__) || defined(__clang__)
+#define YMD_PREFETCH(p) __builtin_prefetch(p)
+#else
+#define YMD_PREFETCH(p) ((void)0)
+#endif
 
 namespace ymd {
   inline constexpr auto PowerOf2(const std::size_t n) noexcept {
@@ -16,10 +26,23 @@ namespace ymd {
     return m;
   }
 
-  template<typename T,bool MultiThread = false>
+  template<typename T>
+  struct Sum {
+    constexpr T operator()(T a,T b) const { return a + b; }
+  };
+
+  template<typename T>
+  struct Min {
+    constexpr T operator()(T a,T b) const { return std::min(a,b); }
+  };
+
+  template<typename T,bool MultiThread = false,
+	   typename F = std::function<T(T,T)>>
   class SegmentTree {
   private:
-    using F = std::function<T(T,T)>;
+    // Number of queries descending together at prefix_sum_indexes
+    static constexpr const std::size_t descent_chunk = 128;
+
     const std::size_t buffer_size;
     T* buffer;
     std::shared_ptr<T[]> view;
@@ -29,24 +52,46 @@ namespace ymd {
     std::atomic_bool *changed;
     std::shared_ptr<std::atomic_bool[]> changed_view;
 
-    auto _reduce(const std::size_t start,const std::size_t end,std::size_t index,
-		 const std::size_t region_s,const std::size_t region_e) const {
-      if((start <= region_s) && (region_e <= end)){
-	return buffer[index];
+    T _reduce(std::size_t start,std::size_t end) const {
+      // Bottom up reduction on [start,end). With 1-based node numbering,
+      // leaf i is (buffer_size + i) and its parent is (node / 2).
+      if(start >= end){ return T{0}; }
+
+      T left{}, right{};
+      bool has_left = false, has_right = false;
+      for(start += buffer_size, end += buffer_size; start < end;
+	  start /= 2, end /= 2){
+	if(start & 1){
+	  left = has_left ? f(left,buffer[start-1]): buffer[start-1];
+	  has_left = true;
+	  ++start;
+	}
+	if(end & 1){
+	  --end;
+	  right = has_right ? f(buffer[end-1],right): buffer[end-1];
+	  has_right = true;
+	}
       }
 
-      auto region_m = (region_s + region_e)/2;
+      if(!has_left){ return right; }
+      if(!has_right){ return left; }
+      return f(left,right);
+    }
 
-      if(end <= region_m){
-	return _reduce(start,end,2*index+1,region_s,region_m);
+    static F default_f(){
+      if constexpr (std::is_same_v<F,std::function<T(T,T)>>){
+	return [](T a,T b){ return a+b; };
+      }else{
+	return F{};
       }
+    }
 
-      if(region_m <= start){
-	return _reduce(start,end,2*index+2,region_m,region_e);
+    void update_if_changed(){
+      if constexpr (MultiThread){
+	if(any_changed->load(std::memory_order_acquire)){
+	  update_changed();
+	}
       }
-
-      return f(_reduce(start,end,2*index+1,region_s,region_m),
-	       _reduce(start,end,2*index+2,region_m,region_e));
     }
 
     constexpr std::size_t parent(std::size_t node) const {
@@ -84,25 +129,57 @@ namespace ymd {
     }
 
     void update_changed(){
-      std::set<std::size_t> will_update{};
+      // Clear the flag before scanning, so that changes during the scan are
+      // left for the next update. (Writers set `changed` before `any_changed`.)
+      any_changed->store(false,std::memory_order_release);
 
+      // Nodes of the same depth in ascending order. Since all the leaves are
+      // at the same depth, the tree is updated level by level.
+      std::vector<std::size_t> nodes{};
       for(std::size_t i = 0; i < buffer_size; ++i){
-	if(changed[i].exchange(false,std::memory_order_acq_rel)){
-	  will_update.insert(parent(access_index(i)));
+	if(changed[i].load(std::memory_order_relaxed) &&
+	   changed[i].exchange(false,std::memory_order_acq_rel)){
+	  auto leaf = access_index(i);
+	  if(leaf && (nodes.empty() || nodes.back() != parent(leaf))){
+	    nodes.push_back(parent(leaf));
+	  }
 	}
       }
 
-      while(!will_update.empty()){
-	auto i = *(will_update.rbegin());
-	auto updated = update_buffer(i);
-	will_update.erase(i);
-	if(i && updated){ will_update.insert(parent(i)); }
+      update_nodes(nodes);
+    }
+
+    void update_range(std::size_t first,std::size_t last){
+      // Update ancestors of leaves [first,last]. Since all the leaves are at
+      // the same depth, parents of a contiguous range are contiguous, too.
+      first = access_index(first);
+      last = access_index(last);
+      while(first){
+	first = parent(first);
+	last = parent(last);
+	for(auto n = first; n <= last; ++n){ update_buffer(n); }
+      }
+    }
+
+    void update_nodes(std::vector<std::size_t>& nodes){
+      // Update nodes of the same depth and their ancestors level by level.
+      // Adjacent duplicates (e.g. parents of sorted nodes) are skipped. Other
+      // duplicates are visited twice, but the second visit changes nothing
+      // and stops there, since the children are already updated.
+      while(!nodes.empty()){
+	std::size_t n_next = 0;
+	for(auto node: nodes){
+	  if(update_buffer(node) && node){
+	    auto p = parent(node);
+	    if(!n_next || nodes[n_next-1] != p){ nodes[n_next++] = p; }
+	  }
+	}
+	nodes.resize(n_next);
       }
-      any_changed->store(false,std::memory_order_release);
     }
 
   public:
-    SegmentTree(std::size_t n,F f, T v = T{0},
+    SegmentTree(std::size_t n,F f = default_f(), T v = T{0},
 		T* buffer_ptr = nullptr,
 		bool* any_changed_ptr = nullptr,
 		bool* changed_ptr = nullptr,
@@ -144,7 +221,7 @@ namespace ymd {
 	}
       }
     }
-    SegmentTree(): SegmentTree{2,[](auto a,auto b){ return a+b; }} {}
+    SegmentTree(): SegmentTree{2} {}
     SegmentTree(const SegmentTree&) = default;
     SegmentTree(SegmentTree&&) = default;
     SegmentTree& operator=(const SegmentTree&) = default;
@@ -160,8 +237,8 @@ namespace ymd {
       buffer[n] = std::move(v);
 
       if constexpr (MultiThread){
-	any_changed->store(true,std::memory_order_release);
 	changed[i].store(true,std::memory_order_release);
+	any_changed->store(true,std::memory_order_release);
       }else{
 	constexpr const std::size_t zero = 0;
 	auto updated = true;
@@ -172,18 +249,15 @@ namespace ymd {
       }
     }
 
-    template<typename F,
-	     typename std::enable_if<!(std::is_convertible_v<F,T>),
+    template<typename Generator,
+	     typename std::enable_if<!(std::is_convertible_v<Generator,T>),
 				     std::nullptr_t>::type = nullptr>
-    void set(std::size_t i,F&& f,std::size_t N,std::size_t max = std::size_t(0)){
+    void set(std::size_t i,Generator&& f,std::size_t N,
+	     std::size_t max = std::size_t(0)){
       constexpr const std::size_t zero = 0;
       if(zero == max){ max = buffer_size; }
 
-      std::set<std::size_t> will_update{};
-
-      if constexpr (MultiThread){
-	if(N){ any_changed->store(true,std::memory_order_release); }
-      }
+      [[maybe_unused]] const auto any = (N != zero);
 
       while(N){
 	auto copy_N = std::min(N,max-i);
@@ -194,25 +268,42 @@ namespace ymd {
 			changed + i + copy_N,
 			[](auto& c){ c.store(true,std::memory_order_release); });
 	}else{
-	  for(auto n = std::size_t(0); n < copy_N; ++n){
-	    auto _i = access_index(i+n);
-	    if(_i != 0){
-	      will_update.insert(parent(_i));
-	    }
-	  }
+	  update_range(i,i+copy_N-1);
 	}
 
 	N = (N > copy_N) ? N - copy_N: zero;
 	i = zero;
       }
 
-      if constexpr (!MultiThread) {
-	while(!will_update.empty()){
-	  i = *(will_update.rbegin());
-	  auto updated = update_buffer(i);
-	  will_update.erase(i);
-	  if(i && updated){ will_update.insert(parent(i)); }
+      if constexpr (MultiThread){
+	if(any){ any_changed->store(true,std::memory_order_release); }
+      }
+    }
+
+    template<typename I,
+	     typename std::enable_if<std::is_convertible_v<I,std::size_t>,
+				     std::nullptr_t>::type = nullptr>
+    void set(const I* indexes,const T* values,std::size_t N){
+      // Set values at (not necessarily sorted) indexes. When an index is
+      // duplicated, the last value is set. Leaves are written at first, then
+      // their ancestors are updated level by level.
+      if constexpr (MultiThread){
+	for(std::size_t n = 0; n < N; ++n){
+	  buffer[access_index(indexes[n])] = values[n];
+	  changed[indexes[n]].store(true,std::memory_order_release);
+	}
+	if(N){ any_changed->store(true,std::memory_order_release); }
+      }else{
+	std::vector<std::size_t> nodes{};
+	nodes.reserve(N);
+	for(std::size_t n = 0; n < N; ++n){
+	  auto _i = access_index(indexes[n]);
+	  buffer[_i] = values[n];
+	  if(_i != 0 && (nodes.empty() || nodes.back() != parent(_i))){
+	    nodes.push_back(parent(_i));
+	  }
 	}
+	update_nodes(nodes);
       }
     }
 
@@ -220,29 +311,30 @@ namespace ymd {
       set(i,[=](){ return v; },N,max);
     }
 
+    template<typename Iter>
+    void assign(Iter first,std::size_t N){
+      // Replace leaves [0,N) and rebuild all the nodes in O(n)
+      std::copy_n(first,N,buffer+access_index(0));
+      update_all();
+    }
+
     auto reduce(std::size_t start,std::size_t end) {
       // Operation on [start,end)  # buffer[end] is not included
-      if constexpr (MultiThread){
-	if(any_changed->load(std::memory_order_acquire)){
-	  update_changed();
-	}
-      }
-      return _reduce(start,end,0,0,buffer_size);
+      update_if_changed();
+      return _reduce(start,end);
     }
 
-    auto largest_region_index(std::function<bool(T)> condition,
+    template<typename Condition>
+    auto largest_region_index(Condition&& condition,
 			      std::size_t n=std::size_t(0)) {
       // max index of reduce( [0,index) ) -> true
+      // Binary search of O(log^2 n). Use `prefix_sum_index` for sum tree.
 
       constexpr const std::size_t zero = 0;
       constexpr const std::size_t one  = 1;
       constexpr const std::size_t two  = 2;
 
-      if constexpr (MultiThread){
-	if(any_changed->load(std::memory_order_acquire)){
-	  update_changed();
-	}
-      }
+      update_if_changed();
 
       std::size_t min = zero;
       auto max = (zero != n) ? n: buffer_size;
@@ -250,7 +342,7 @@ namespace ymd {
       auto index = (min + max)/two;
 
       while(max - min > one){
-	if( condition(_reduce(zero,index,zero,zero,buffer_size)) ){
+	if( condition(_reduce(zero,index)) ){
 	  min = index;
 	}else{
 	  max = index;
@@ -261,10 +353,311 @@ namespace ymd {
       return index;
     }
 
+    std::size_t prefix_sum_index(T mass,std::size_t n=std::size_t(0)) {
+      // max index of reduce( [0,index) ) <= mass for sum tree of non-negative
+      // values, which is equal to
+      //   largest_region_index([=](auto v){ return v <= mass; },n)
+      // Descend from the root subtracting the left child in O(log n).
+
+      constexpr const std::size_t zero = 0;
+      if(zero == n){ n = buffer_size; }
+
+      update_if_changed();
+
+      std::size_t node = zero;
+      const auto first_leaf = access_index(zero);
+      while(node < first_leaf){
+	auto left = child_left(node);
+	if(mass < buffer[left]){
+	  node = left;
+	}else{
+	  mass -= buffer[left];
+	  node = child_right(node);
+	}
+      }
+
+      // Rounding error might go beyond n.
+      return std::min(node - first_leaf,n - 1);
+    }
+
+    void prefix_sum_indexes(T* masses,std::size_t N,std::size_t* indexes,
+			    std::size_t n=std::size_t(0)) {
+      // Batched prefix_sum_index, whose results are written into indexes.
+      // (masses are overwritten with residuals.)
+      // Queries of a chunk descend together level by level, so that loads of
+      // the same level are independent each other, and the nodes of the next
+      // level are prefetched. When masses are sorted, nodes of each level are
+      // visited in ascending order, and upper nodes are shared.
+
+      constexpr const std::size_t zero = 0;
+      if(zero == n){ n = buffer_size; }
+
+      update_if_changed();
+
+      std::fill_n(indexes,N,zero);
+      for(std::size_t begin = 0; begin < N; begin += descent_chunk){
+	const auto end = std::min(begin + descent_chunk,N);
+	for(auto width = buffer_size; width > 1; width /= 2){
+	  for(auto i = begin; i < end; ++i){
+	    auto left = child_left(indexes[i]);
+	    auto v = buffer[left];
+	    auto right = !(masses[i] < v);
+	    masses[i] -= right ? v: T{0};
+	    indexes[i] = left + right;
+	    if(width > 2){ YMD_PREFETCH(buffer + child_left(indexes[i])); }
+	  }
+	}
+      }
+
+      const auto first_leaf = access_index(zero);
+      std::for_each(indexes,indexes+N,
+		    [=](auto& i){ i = std::min(i - first_leaf,n - 1); });
+    }
+
     void clear(T v = T{0}){
       std::fill(buffer + access_index(0), buffer + access_index(buffer_size), v);
       update_all();
     }
   };
+
+  template<typename T,std::size_t K>
+  class KarySumTree {
+    // Sum tree whose nodes have K children.
+    // Nodes are stored level by level from the leaves to the root, and each
+    // level is padded to a multiple of K. Node j of level l is the sum of
+    // nodes [j*K, j*K + K) of level (l-1), so that the children of a node are
+    // packed into a single cache line, and a descent visits log_K n levels
+    // instead of log_2 n.
+    static_assert(K >= 2 && (K & (K - 1)) == 0,"K must be power of 2");
+  private:
+    // Number of queries descending together at prefix_sum_indexes
+    static constexpr const std::size_t descent_chunk = 128;
+    static constexpr const std::size_t alignment = 64;
+
+    std::size_t buffer_size;
+    std::vector<std::size_t> offsets;
+    std::vector<std::size_t> sizes;
+    T* buffer;
+    std::shared_ptr<T[]> view;
+
+    static constexpr std::size_t round_up(std::size_t n){
+      return (n + K - 1) / K * K;
+    }
+
+    std::size_t levels() const {
+      return offsets.size();
+    }
+
+    std::size_t select_child(const T* child,T& mass) const {
+      // Branchless binary search inside the cache line of K children,
+      // which subtracts the skipped children from mass.
+      std::size_t c = 0;
+      for(std::size_t w = K/2; w; w /= 2){
+	T left{0};
+	for(std::size_t k = 0; k < w; ++k){ left += child[c+k]; }
+	auto right = !(mass < left);
+	mass -= right ? left: T{0};
+	c += right ? w: 0;
+      }
+      return c;
+    }
+
+    bool update_node(std::size_t level,std::size_t j){
+      const auto child = buffer + offsets[level-1] + j * K;
+      T v{0};
+      for(std::size_t k = 0; k < K; ++k){ v += child[k]; }
+
+      auto& node = buffer[offsets[level] + j];
+      auto changed = (node != v);
+      node = v;
+      return changed;
+    }
+
+    void update_range(std::size_t first,std::size_t last){
+      // Update ancestors of leaves [first,last]
+      for(std::size_t level = 1; level < levels(); ++level){
+	first /= K;
+	last /= K;
+	for(auto j = first; j <= last; ++j){ update_node(level,j); }
+      }
+    }
+
+    void update_nodes(std::vector<std::size_t>& nodes){
+      // Update nodes of level 1 and their ancestors level by level. As in
+      // SegmentTree, non-adjacent duplicates stop at their second visit.
+      for(std::size_t level = 1; level < levels() && !nodes.empty(); ++level){
+	std::size_t n_next = 0;
+	for(auto j: nodes){
+	  if(update_node(level,j)){
+	    auto p = j / K;
+	    if(!n_next || nodes[n_next-1] != p){ nodes[n_next++] = p; }
+	  }
+	}
+	nodes.resize(n_next);
+      }
+    }
+
+    void update_all(){
+      // Padded nodes are kept zero.
+      for(std::size_t level = 1; level < levels(); ++level){
+	for(std::size_t j = 0; j < sizes[level]; ++j){
+	  update_node(level,j);
+	}
+      }
+    }
+
+  public:
+    KarySumTree(std::size_t n,T v = T{0})
+      : buffer_size(n),
+	offsets{},
+	sizes{},
+	buffer(nullptr),
+	view{}
+    {
+      // Padded nodes, which have no children, are not counted in sizes.
+      auto total = std::size_t(0);
+      for(auto count = n; ; count = round_up(count) / K){
+	offsets.push_back(total);
+	sizes.push_back(std::max(count,std::size_t(1)));
+	if(count <= 1){
+	  total += 1;
+	  break;
+	}
+	total += round_up(count);
+      }
+
+      // Aligned operator new (C++17) is portable, unlike std::aligned_alloc
+      buffer = static_cast<T*>(::operator new(total * sizeof(T),
+					      std::align_val_t{alignment}));
+      view = std::shared_ptr<T[]>(buffer,[](T* p){
+	::operator delete(p,std::align_val_t{alignment});
+      });
+
+      clear(v);
+    }
+    KarySumTree(): KarySumTree{2} {}
+    KarySumTree(const KarySumTree&) = default;
+    KarySumTree(KarySumTree&&) = default;
+    KarySumTree& operator=(const KarySumTree&) = default;
+    KarySumTree& operator=(KarySumTree&&) = default;
+    ~KarySumTree() = default;
+
+    T get(std::size_t i) const {
+      return buffer[i];
+    }
+
+    void set(std::size_t i,T v){
+      buffer[i] = std::move(v);
+      for(std::size_t level = 1; level < levels(); ++level){
+	i /= K;
+	if(!update_node(level,i)){ break; }
+      }
+    }
+
+    template<typename Generator,
+	     typename std::enable_if<!(std::is_convertible_v<Generator,T>),
+				     std::nullptr_t>::type = nullptr>
+    void set(std::size_t i,Generator&& f,std::size_t N,
+	     std::size_t max = std::size_t(0)){
+      constexpr const std::size_t zero = 0;
+      if(zero == max){ max = buffer_size; }
+
+      while(N){
+	auto copy_N = std::min(N,max-i);
+	std::generate_n(buffer+i,copy_N,f);
+	update_range(i,i+copy_N-1);
+
+	N = (N > copy_N) ? N - copy_N: zero;
+	i = zero;
+      }
+    }
+
+    template<typename I,
+	     typename std::enable_if<std::is_convertible_v<I,std::size_t>,
+				     std::nullptr_t>::type = nullptr>
+    void set(const I* indexes,const T* values,std::size_t N){
+      // Set values at (not necessarily sorted) indexes. When an index is
+      // duplicated, the last value is set.
+      std::vector<std::size_t> nodes{};
+      nodes.reserve(N);
+      for(std::size_t n = 0; n < N; ++n){
+	buffer[indexes[n]] = values[n];
+	auto p = std::size_t(indexes[n]) / K;
+	if(nodes.empty() || nodes.back() != p){ nodes.push_back(p); }
+      }
+      update_nodes(nodes);
+    }
+
+    void set(std::size_t i,T v,std::size_t N,std::size_t max = std::size_t(0)){
+      set(i,[=](){ return v; },N,max);
+    }
+
+    template<typename Iter>
+    void assign(Iter first,std::size_t N){
+      // Replace leaves [0,N) and rebuild all the nodes in O(n)
+      std::copy_n(first,N,buffer);
+      update_all();
+    }
+
+    auto reduce(std::size_t start,std::size_t end) const {
+      // Operation on [start,end)  # buffer[end] is not included
+      T v{0};
+      for(std::size_t level = 0; start < end; ++level){
+	const auto nodes = buffer + offsets[level];
+	while(start < end && (start % K)){ v += nodes[start++]; }
+	while(start < end && (end % K)){ v += nodes[--end]; }
+	start /= K;
+	end /= K;
+      }
+      return v;
+    }
+
+    std::size_t prefix_sum_index(T mass,std::size_t n=std::size_t(0)) const {
+      // max index of reduce( [0,index) ) <= mass for non-negative values
+      constexpr const std::size_t zero = 0;
+      if(zero == n){ n = buffer_size; }
+
+      std::size_t j = zero;
+      for(auto level = levels() - 1; level > zero; --level){
+	j = j * K + select_child(buffer + offsets[level-1] + j * K,mass);
+	// Rounding error might go into padded nodes.
+	j = std::min(j,sizes[level-1] - 1);
+      }
+
+      // Rounding error might go beyond n.
+      return std::min(j,n - 1);
+    }
+
+    void prefix_sum_indexes(T* masses,std::size_t N,std::size_t* indexes,
+			    std::size_t n=std::size_t(0)) const {
+      // Batched prefix_sum_index, whose results are written into indexes.
+      // (masses are overwritten with residuals.)
+      constexpr const std::size_t zero = 0;
+      if(zero == n){ n = buffer_size; }
+
+      std::fill_n(indexes,N,zero);
+      for(std::size_t begin = 0; begin < N; begin += descent_chunk){
+	const auto end = std::min(begin + descent_chunk,N);
+	for(auto level = levels() - 1; level > zero; --level){
+	  const auto children = buffer + offsets[level-1];
+	  const auto last = sizes[level-1] - 1;
+	  for(auto i = begin; i < end; ++i){
+	    auto j = indexes[i] * K;
+	    j += select_child(children + j,masses[i]);
+	    indexes[i] = j = std::min(j,last);
+	    if(level > 1){ YMD_PREFETCH(buffer + offsets[level-2] + j * K); }
+	  }
+	}
+      }
+
+      std::for_each(indexes,indexes+N,[=](auto& i){ i = std::min(i,n - 1); });
+    }
+
+    void clear(T v = T{0}){
+      std::fill(buffer,buffer + offsets.back() + 1,T{0});
+      std::fill_n(buffer,buffer_size,v);
+      update_all();
+    }
+  };
 }
 #endif // YMD_SEGMENTTREE_HH
@@ -1,5 +1,6 @@
 from .PyReplayBuffer import (ReplayBuffer,PrioritizedReplayBuffer,
-                             SelectiveReplayBuffer, DQfDBuffer)
+                             SelectiveReplayBuffer, DQfDBuffer,
+                             MPReplayBuffer, MPPrioritizedReplayBuffer)
 from .PyReplayBuffer import create_buffer
 
 try:
@@ -0,0 +1,248 @@
+import zlib
+
+import numpy as np
+
+
+class Codec:
+    """Base class of per-field codec
+
+    A codec encodes a single row (transition) of a field into `bytes`, and
+    decodes it into a preallocated row.
+
+    Attributes
+    ----------
+    releases_gil : bool
+        Whether `decode` releases GIL during most of its work. Only such
+        codecs are decoded over multiple threads.
+    """
+    releases_gil = False
+
+    def check(self,dtype):
+        """Check whether the codec supports dtype
+
+        Parameters
+        ----------
+        dtype : numpy.dtype
+            dtype of field
+
+        Raises
+        ------
+        ValueError
+            If dtype is not supported.
+        """
+        pass
+
+    def encode(self,row):
+        """Encode a row
+
+        Parameters
+        ----------
+        row : numpy.ndarray
+            C-contiguous row to be encoded
+
+        Returns
+        -------
+        data : bytes
+            encoded row
+        """
+        raise NotImplementedError
+
+    def decode(self,data,out):
+        """Decode a row
+
+        Parameters
+        ----------
+        data : bytes
+            encoded row
+        out : numpy.ndarray
+            C-contiguous row where decoded values are written
+        """
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+    """Codec with `zlib` (standard library)
+
+    Decompression releases GIL, so that rows are decoded in parallel.
+    """
+    releases_gil = True
+
+    def __init__(self,level = 1):
+        """Initialize ZlibCodec
+
+        Parameters
+        ----------
+        level : int, optional
+            compression level from 0 to 9. default is 1 (fastest)
+        """
+        self.level = level
+
+    def encode(self,row):
+        return zlib.compress(row,self.level)
+
+    def decode(self,data,out):
+        memoryview(out).cast("B")[:] = zlib.decompress(data,bufsize=out.nbytes)
+
+
+class DeltaRLECodec(Codec):
+    """Codec with run length encoding of differences implemented by NumPy
+
+    Differences between adjacent elements are run length encoded, so that
+    both flat regions and gradations (e.g. background of image frames) are
+    compressed. Only integer dtypes are supported.
+    """
+    def check(self,dtype):
+        if np.dtype(dtype).kind not in "iub":
+            raise ValueError(f"DeltaRLECodec does not support dtype {dtype}")
+
+    def encode(self,row):
+        flat = row.reshape(-1)
+        if flat.dtype == np.bool_:
+            flat = flat.view(np.uint8)
+
+        # Differences wrap around, which are exactly restored by cumsum.
+        diff = np.empty_like(flat)
+        diff[0] = flat[0]
+        np.subtract(flat[1:],flat[:-1],out=diff[1:])
+
+        starts = np.flatnonzero(diff[1:] != diff[:-1]) + 1
+        starts = np.concatenate(([0],starts))
+        lengths = np.diff(np.append(starts,flat.shape[0]))
+        return (lengths.astype(self._length_dtype(flat.shape[0])).tobytes() +
+                diff[starts].tobytes())
+
+    def decode(self,data,out):
+        flat = out.reshape(-1)
+        if flat.dtype == np.bool_:
+            flat = flat.view(np.uint8)
+
+        length_dtype = self._length_dtype(flat.shape[0])
+        n_runs = len(data) // (length_dtype.itemsize + flat.itemsize)
+        lengths = np.frombuffer(data,dtype=length_dtype,count=n_runs)
+        values = np.frombuffer(data,dtype=flat.dtype,
+                               offset=n_runs * length_dtype.itemsize)
+        np.cumsum(np.repeat(values,lengths),dtype=flat.dtype,out=flat)
+
+    @staticmethod
+    def _length_dtype(size):
+        return np.dtype(np.uint16 if size <= np.iinfo(np.uint16).max else np.uint32)
+
+
+codecs = {"zlib": ZlibCodec,"rle": DeltaRLECodec}
+
+def get_codec(codec):
+    """Get codec
+
+    Parameters
+    ----------
+    codec : str or Codec
+        codec instance or its name ("zlib" or "rle")
+
+    Returns
+    -------
+    codec : Codec
+        codec instance
+    """
+    if isinstance(codec,Codec):
+        return codec
+    if codec not in codecs:
+        raise ValueError(f"Unknown codec: {codec}")
+    return codecs[codec]()
+
+
+class EncodedBuffer:
+    """Slot indexed storage of encoded rows
+    """
+    def __init__(self,size,shape,dtype,codec):
+        """Initialize EncodedBuffer
+
+        Parameters
+        ----------
+        size : int
+            buffer size
+        shape : tuple of int
+            row shape
+        dtype : numpy.dtype
+            row dtype
+        codec : str or Codec
+            codec of rows
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.codec = get_codec(codec)
+        self.codec.check(self.dtype)
+        self.rows = [None] * size
+
+    def store(self,slots,values):
+        """Encode and store rows
+
+        Parameters
+        ----------
+        slots : array like of int
+            slot of each row
+        values : numpy.ndarray
+            rows with shape of (len(slots), *shape)
+        """
+        values = np.ascontiguousarray(values,dtype=self.dtype)
+        for slot, row in zip(slots,values):
+            self.rows[slot] = self.codec.encode(row)
+
+    def resize(self,order,size):
+        """Move rows into resized slots
+
+        Parameters
+        ----------
+        order : array like of int
+            old slots moved into new slots 0, 1, ..., len(order)-1
+        size : int
+            new buffer size
+        """
+        rows = [self.rows[i] for i in np.asarray(order).tolist()]
+        self.rows = rows + [None] * (size - len(rows))
+
+    def decode(self,idx,out,pool = None,n_chunks = 1):
+        """Decode rows
+
+        Parameters
+        ----------
+        idx : array like of int
+            slots to be decoded
+        out : numpy.ndarray
+            C-contiguous array with shape of (len(idx), *shape), where decoded
+            rows are written
+        pool : concurrent.futures.Executor, optional
+            If specified, rows are decoded by its workers. Rows of codec which
+            holds GIL (`releases_gil` is `False`) are decoded serially.
+        n_chunks : int, optional
+            number of chunks submitted to `pool`. default is 1
+        """
+        if not out.flags.c_contiguous:
+            tmp = np.empty(out.shape,dtype=self.dtype)
+            self.decode(idx,tmp,pool,n_chunks)
+            out[:] = tmp
+            return
+
+        idx = np.asarray(idx).tolist()
+        if (pool is None or n_chunks <= 1 or len(idx) < n_chunks or
+            not self.codec.releases_gil):
+            self._decode(idx,out,0,len(idx))
+            return
+
+        bounds = np.linspace(0,len(idx),n_chunks + 1).astype(int)
+        futures = [pool.submit(self._decode,idx,out,begin,end)
+                   for begin, end in zip(bounds[:-1],bounds[1:])]
+        for f in futures:
+            f.result()
+
+    def _decode(self,idx,out,begin,end):
+        for i in range(begin,end):
+            data = self.rows[idx[i]]
+            if data is None:
+                out[i] = 0
+            else:
+                self.codec.decode(data,out[i])
+
+    @property
+    def nbytes(self):
+        """Total bytes of encoded rows"""
+        return sum(len(r) for r in self.rows if r is not None)
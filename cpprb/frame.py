@@ -0,0 +1,220 @@
+import numpy as np
+
+
+class FrameStore:
+    """Deduplicated storage of stacked frames
+
+    Each unique frame is stored once in a ring of frames, and each transition
+    stores only references (sequence numbers) of its stacked frames. Frames of
+    a stack are shared with the previous transition of the same stream, so
+    that usually a single frame is stored per transition. Stacks are assembled
+    at sampling. Frames filled with zeros (e.g. padding before episode start)
+    are not stored but referenced as -1.
+    """
+    def __init__(self,size,shape,dtype,*,axis = -1,num_envs = 1,next = False):
+        """Initialize FrameStore
+
+        Parameters
+        ----------
+        size : int
+            buffer size
+        shape : tuple of int
+            shape of stacked frames
+        dtype : numpy.dtype
+            frame dtype
+        axis : int, optional
+            stack axis of `shape`. default is -1
+        num_envs : int, optional
+            number of interleaved streams. default is 1
+        next : bool, optional
+            If `True`, the next stacks are also stored. default is `False`
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.axis = axis % len(self.shape)
+        self.n_stack = self.shape[self.axis]
+        self.frame_shape = self.shape[:self.axis] + self.shape[self.axis+1:]
+        self.num_envs = num_envs
+        self.next = next
+
+        self.refs = np.full((size,self.n_stack),-1,dtype=np.int64)
+        self.next_ref = np.full(size,-1,dtype=np.int64) if next else None
+
+        # The oldest referenced frame of each transition
+        self.frame_min = np.full(size,np.iinfo(np.int64).max,dtype=np.int64)
+
+        self.frames = np.zeros((size + 2 * self.n_stack * num_envs + 1,
+                                *self.frame_shape),dtype=self.dtype)
+        self.clear()
+
+    def clear(self):
+        """Clear stored frames and streams"""
+        self.frame_seq = 0
+        self.live = 0
+        self.next_slot = 0
+        self.frame_min[:] = np.iinfo(np.int64).max
+        self.last = np.full((self.num_envs,self.n_stack),-1,dtype=np.int64)
+        self.fresh = np.ones(self.num_envs,dtype=np.bool_)
+
+    def episode_end(self,envs = (0,)):
+        """Start new episodes of streams at the next store
+
+        Parameters
+        ----------
+        envs : array like of int, optional
+            streams whose episodes end. default is (0,)
+        """
+        self.fresh[np.asarray(envs)] = True
+
+    def store(self,slots,values,next_values = None,done = None):
+        """Store stacked frames
+
+        Parameters
+        ----------
+        slots : array like of int
+            slot of each transition. Stream is `slot % num_envs`
+        values : numpy.ndarray
+            stacked frames with shape of (len(slots), *shape)
+        next_values : numpy.ndarray, optional
+            next stacked frames. Required when `next=True`
+        done : numpy.ndarray, optional
+            If specified, episodes of streams end at non zero values.
+        """
+        values = np.asarray(values,dtype=self.dtype)
+        if self.next:
+            next_values = np.asarray(next_values,dtype=self.dtype)
+        if done is not None:
+            done = np.ravel(done)
+
+        for i, slot in enumerate(slots):
+            env = slot % self.num_envs
+            if self.fresh[env]:
+                refs = self._store_stack(values[i])
+                self.fresh[env] = False
+            elif self.next:
+                refs = self.last[env].copy()
+            else:
+                refs = np.append(self.last[env][1:],
+                                 self._store_frame(self._frame(values[i],-1)))
+
+            self.refs[slot] = refs
+            if self.next:
+                n = self._store_frame(self._frame(next_values[i],-1))
+                self.next_ref[slot] = n
+                self.last[env] = np.append(refs[1:],n)
+            else:
+                self.last[env] = refs
+
+            # The next frame is newer than refs.
+            self.frame_min[slot] = refs[refs >= 0].min(initial=self.frame_seq)
+            self.next_slot = (slot + 1) % self.frame_min.shape[0]
+
+            if done is not None and done[i]:
+                self.fresh[env] = True
+
+    def gather(self,idx,out,next_out = None):
+        """Assemble stacks of transitions
+
+        Parameters
+        ----------
+        idx : array like of int
+            slots to be assembled
+        out : numpy.ndarray
+            array with shape of (len(idx), *shape)
+        next_out : numpy.ndarray, optional
+            array where the next stacks are assembled
+        """
+        refs = self.refs[idx]
+        self._assemble(refs,out)
+        if next_out is not None:
+            self._assemble(np.concatenate((refs[:,1:],self.next_ref[idx,np.newaxis]),
+                                          axis=1),
+                           next_out)
+
+    def resize(self,order,size):
+        """Move references of transitions into resized slots
+
+        Parameters
+        ----------
+        order : array like of int
+            old slots moved into new slots 0, 1, ..., len(order)-1
+        size : int
+            new buffer size
+        """
+        n = len(order)
+        refs = np.full((size,self.n_stack),-1,dtype=np.int64)
+        refs[:n] = self.refs[order]
+        self.refs = refs
+
+        if self.next:
+            next_ref = np.full(size,-1,dtype=np.int64)
+            next_ref[:n] = self.next_ref[order]
+            self.next_ref = next_ref
+
+        frame_min = np.full(size,np.iinfo(np.int64).max,dtype=np.int64)
+        frame_min[:n] = self.frame_min[order]
+        self.frame_min = frame_min
+        self.next_slot = n % size
+
+    @property
+    def nbytes(self):
+        """Total bytes of frames and references"""
+        return (self.frames.nbytes + self.refs.nbytes + self.frame_min.nbytes +
+                (self.next_ref.nbytes if self.next else 0))
+
+    def _assemble(self,refs,out):
+        # The last frame is kept zero for references of -1.
+        capacity = self.frames.shape[0] - 1
+        pos = np.where(refs < 0,capacity,refs % capacity)
+        stacks = np.moveaxis(out,self.axis+1,1)
+        for k in range(self.n_stack):
+            stacks[:,k] = self.frames[pos[:,k]]
+
+    def _frame(self,stack,k):
+        return stack[(slice(None),) * self.axis + (k,)]
+
+    def _store_stack(self,stack):
+        refs = np.full(self.n_stack,-1,dtype=np.int64)
+        for k in range(self.n_stack):
+            frame = self._frame(stack,k)
+            if k > 0 and refs[k-1] >= 0 and np.array_equal(frame,self._frame(stack,k-1)):
+                refs[k] = refs[k-1]
+            else:
+                refs[k] = self._store_frame(frame)
+        return refs
+
+    def _store_frame(self,frame):
+        if not frame.any():
+            return -1
+
+        self._reserve()
+        seq = self.frame_seq
+        self.frames[seq % (self.frames.shape[0] - 1)] = frame
+        self.frame_seq += 1
+        return seq
+
+    def _reserve(self):
+        capacity = self.frames.shape[0] - 1
+        if self.frame_seq + 1 - self.live <= capacity:
+            # The oldest referenced frame never gets older.
+            return
+
+        # Transitions are written in order, and references of each stream are
+        # monotonic, so that the oldest transitions of streams are at the
+        # first or the next slots.
+        E = self.num_envs
+        last = self.last[~self.fresh]
+        live = min(self.frame_min[:E].min(),
+                   self.frame_min[self.next_slot:self.next_slot+E].min(),
+                   last[last >= 0].min(initial=self.frame_seq))
+        self.live = live = min(live,self.frame_seq)
+
+        needed = self.frame_seq + 1 - live
+        if needed <= capacity:
+            return
+
+        new_capacity = max(needed,capacity + capacity // 4)
+        frames = np.zeros((new_capacity + 1,*self.frame_shape),dtype=self.dtype)
+        seq = np.arange(live,self.frame_seq)
+        frames[seq % new_capacity] = self.frames[seq % capacity]
+        self.frames = frames
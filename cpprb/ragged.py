@@ -0,0 +1,181 @@
+import numpy as np
+
+
+class RaggedBuffer:
+    """Slot indexed storage of variable length values
+
+    Elements of all the values are stored contiguously in a ring of elements
+    (arena), and each slot stores the sequence number of its first element
+    (offset) and its length. Slots are overwritten in ring order, so that the
+    oldest live element belongs to the oldest slot. The arena grows when the
+    live elements exceed its capacity.
+    """
+    def __init__(self,size,shape,dtype,*,format = "padded"):
+        """Initialize RaggedBuffer
+
+        Parameters
+        ----------
+        size : int
+            buffer size
+        shape : tuple of int
+            shape of each element
+        dtype : numpy.dtype
+            element dtype
+        format : {"padded", "flat"}, optional
+            format of gathered values. default is "padded"
+        """
+        if format not in ("padded", "flat"):
+            raise ValueError(f"Unknown ragged format: {format}")
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.format = format
+
+        self.offsets = np.full(size,np.iinfo(np.int64).max,dtype=np.int64)
+        self.lengths = np.zeros(size,dtype=np.int64)
+        self.arena = np.zeros((size,*self.shape),dtype=self.dtype)
+        self.clear()
+
+    def clear(self):
+        """Clear stored values"""
+        self.head = 0
+        self.offsets[:] = np.iinfo(np.int64).max
+        self.lengths[:] = 0
+
+    def rows(self,value,N):
+        """Split added value into rows
+
+        Parameters
+        ----------
+        value : array like or sequence of array like
+            `N` values, each of which has shape of (length, *shape). When
+            `N == 1`, a single value is also accepted.
+        N : int
+            number of rows
+
+        Returns
+        -------
+        rows : list of numpy.ndarray
+            values with shape of (length, *shape)
+        """
+        if N == 1 and not (isinstance(value,np.ndarray) and value.dtype == object):
+            try:
+                v = np.asarray(value,dtype=self.dtype)
+            except ValueError:
+                # Sequence of a single value
+                v = None
+            if v is not None and v.ndim <= len(self.shape) + 1:
+                return [v.reshape(-1,*self.shape)]
+
+        return [np.asarray(v,dtype=self.dtype).reshape(-1,*self.shape)
+                for v in value]
+
+    def store(self,slots,values):
+        """Store values
+
+        Parameters
+        ----------
+        slots : array like of int
+            slot of each value, which must be consecutive in ring order
+        values : list of numpy.ndarray
+            values with shape of (length, *shape)
+        """
+        size = self.offsets.shape[0]
+        slots = np.asarray(slots)[-size:]
+        values = values[-size:]
+
+        lengths = np.fromiter((v.shape[0] for v in values),dtype=np.int64,
+                              count=len(values))
+        total = int(lengths.sum())
+
+        # Overwritten slots release their elements.
+        self.offsets[slots] = np.iinfo(np.int64).max
+        self.lengths[slots] = 0
+        self._reserve(total,(slots[-1] + 1) % size)
+
+        if total:
+            self._write(self.head,np.concatenate(values))
+        self.offsets[slots] = self.head + np.cumsum(lengths) - lengths
+        self.lengths[slots] = lengths
+        self.head += total
+
+    def gather(self,idx):
+        """Gather values
+
+        Parameters
+        ----------
+        idx : array like of int
+            slots to be gathered
+
+        Returns
+        -------
+        values : numpy.ndarray
+            "padded" format: zero padded values with shape of
+            (len(idx), max length, *shape).
+            "flat" format: concatenated values with shape of
+            (total length, *shape).
+        lengths_or_offsets : numpy.ndarray
+            "padded" format: lengths of values.
+            "flat" format: offsets of values, whose size is len(idx) + 1.
+        """
+        offsets = self.offsets[idx]
+        lengths = self.lengths[idx]
+        total = int(lengths.sum())
+
+        starts = np.cumsum(lengths) - lengths
+        within = np.arange(total) - np.repeat(starts,lengths)
+        pos = (np.repeat(offsets,lengths) + within) % self.arena.shape[0]
+
+        if self.format == "flat":
+            return self.arena[pos], np.append(starts,total)
+
+        values = np.zeros((lengths.shape[0],lengths.max(initial=0),*self.shape),
+                          dtype=self.dtype)
+        values[np.repeat(np.arange(lengths.shape[0]),lengths),within] = self.arena[pos]
+        return values, lengths
+
+    def resize(self,order,size):
+        """Move values into resized slots
+
+        Parameters
+        ----------
+        order : array like of int
+            old slots moved into new slots 0, 1, ..., len(order)-1
+        size : int
+            new buffer size
+        """
+        n = len(order)
+        offsets = np.full(size,np.iinfo(np.int64).max,dtype=np.int64)
+        offsets[:n] = self.offsets[order]
+        self.offsets = offsets
+
+        lengths = np.zeros(size,dtype=np.int64)
+        lengths[:n] = self.lengths[order]
+        self.lengths = lengths
+
+    @property
+    def nbytes(self):
+        """Total bytes of arena, offsets and lengths"""
+        return self.arena.nbytes + self.offsets.nbytes + self.lengths.nbytes
+
+    def _write(self,seq,values):
+        capacity = self.arena.shape[0]
+        pos = seq % capacity
+        first = min(values.shape[0],capacity - pos)
+        self.arena[pos:pos+first] = values[:first]
+        self.arena[:values.shape[0]-first] = values[first:]
+
+    def _reserve(self,total,next_slot):
+        capacity = self.arena.shape[0]
+        # The oldest live slot is either the next slot (after wrap around)
+        # or the first slot.
+        live = min(self.offsets[0],self.offsets[next_slot],self.head)
+        needed = self.head + total - live
+        if needed <= capacity:
+            return
+
+        new_capacity = max(needed,capacity + capacity // 4)
+        arena = np.zeros((new_capacity,*self.shape),dtype=self.dtype)
+        seq = np.arange(live,self.head)
+        arena[seq % new_capacity] = self.arena[seq % capacity]
+        self.arena = arena
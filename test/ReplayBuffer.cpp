@@ -92,6 +92,44 @@ void test_PrioritizedSampler(){
   ALMOST_EQUAL(ps.get_max_priority(),LARGE_P);
 }
 
+void test_ParallelPrioritizedSampler(){
+  constexpr const auto N_buffer_size = 1ul << 16;
+  constexpr const auto N_batch_size = 5000ul;
+  constexpr const auto alpha = 0.7;
+  constexpr const auto beta = 0.4;
+
+  std::cout << std::endl;
+  std::cout << "ParallelPrioritizedSampler" << std::endl;
+  auto p = std::vector<Priority>(N_buffer_size);
+  std::generate(p.begin(),p.end(),[i=0ul]() mutable { return (i++ % 7) * 0.1; });
+
+  auto expected_w = std::vector<Priority>{};
+  auto expected_i = std::vector<std::size_t>{};
+  for(auto n_threads: {cores_t(1),cores_t(2),std::max(cores,cores_t(3))}){
+    auto ps = ymd::CppPrioritizedSampler<Priority>(N_buffer_size,alpha);
+    ps.set_priorities(0,p.data(),N_buffer_size,N_buffer_size);
+    ps.set_sample_threads(n_threads);
+    ps.seed(42);
+
+    auto ps_w = std::vector<Priority>{};
+    auto ps_i = std::vector<std::size_t>{};
+    ps.sample(N_batch_size,beta,ps_w,ps_i,N_buffer_size);
+
+    // Strata are sorted.
+    assert(std::is_sorted(ps_i.begin(),ps_i.end()));
+
+    // Independent of the number of threads
+    if(expected_i.empty()){
+      expected_w = ps_w;
+      expected_i = ps_i;
+    }
+    for(auto i = 0ul; i < N_batch_size; ++i){
+      EQUAL(ps_i[i],expected_i[i]);
+      EQUAL(ps_w[i],expected_w[i]);
+    }
+  }
+}
+
 void test_SelectiveEnvironment(){
   constexpr const auto obs_dim = 3ul;
   constexpr const auto act_dim = 1ul;
@@ -221,6 +259,7 @@ int main(){
 
   test_DimensionalBuffer();
   test_PrioritizedSampler();
+  test_ParallelPrioritizedSampler();
   test_SelectiveEnvironment();
 
   return 0;
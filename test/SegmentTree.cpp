@@ -3,6 +3,9 @@
 #include <type_traits>
 #include <future>
 #include <thread>
+#include <random>
+#include <chrono>
+#include <numeric>
 
 #include <SegmentTree.hh>
 
@@ -33,6 +36,343 @@ void multi_thread_test(){
   std::cout << std::endl;
 }
 
+void prefix_sum_test(){
+  constexpr auto buffer_size = 1ul << 10;
+  auto st = ymd::SegmentTree<double,false,ymd::Sum<double>>(buffer_size);
+
+  auto g = std::mt19937{0};
+  auto d = std::uniform_real_distribution<double>{};
+  for(auto i = 0ul; i < buffer_size - 100; ++i){
+    // Zero priorities are never drawn.
+    st.set(i,(i % 7 == 0) ? 0.0: d(g));
+  }
+
+  const auto n = buffer_size - 100;
+  const auto total = st.reduce(0,n);
+  for(auto i = 0ul; i < 1000ul; ++i){
+    auto mass = d(g) * total;
+    auto index = st.prefix_sum_index(mass,n);
+    ymd::Equal(index,st.largest_region_index([=](auto v){ return v <= mass; },n));
+    assert(st.get(index) > 0.0);
+  }
+  ymd::Equal(st.prefix_sum_index(total * 2,n),n - 1);
+
+  auto masses = std::vector<double>(256);
+  std::generate(masses.begin(),masses.end(),[&](){ return d(g) * total; });
+  std::sort(masses.begin(),masses.end());
+  auto expected = std::vector<std::size_t>{};
+  for(auto mass: masses){ expected.push_back(st.prefix_sum_index(mass,n)); }
+  auto indexes = std::vector<std::size_t>(masses.size());
+  st.prefix_sum_indexes(masses.data(),masses.size(),indexes.data(),n);
+  for(auto i = 0ul; i < masses.size(); ++i){ ymd::Equal(indexes[i],expected[i]); }
+
+  for(auto i = 0ul; i < 100ul; ++i){
+    auto start = std::min(std::size_t(d(g) * buffer_size),buffer_size - 1);
+    auto end = start + std::size_t(d(g) * (buffer_size - start)) + 1;
+    auto expected = 0.0;
+    for(auto j = start; j < end; ++j){ expected += st.get(j); }
+    ymd::AlmostEqual(st.reduce(start,end),expected);
+  }
+}
+
+void batch_set_test(){
+  constexpr auto buffer_size = 64ul;
+  auto st = ymd::SegmentTree<double,false,ymd::Sum<double>>(buffer_size);
+  auto mt = ymd::SegmentTree<double,true,ymd::Min<double>>(buffer_size,
+							    ymd::Min<double>{},
+							    1e+10);
+
+  auto indexes = std::vector<std::size_t>{5,63,0,17,5,32,33};
+  auto values = std::vector<double>{1.0,2.0,3.0,4.0,5.0,6.0,0.5};
+  st.set(indexes.data(),values.data(),indexes.size());
+  mt.set(indexes.data(),values.data(),indexes.size());
+
+  // The last value is set for duplicated index.
+  ymd::AlmostEqual(st.get(5),5.0);
+  ymd::AlmostEqual(st.reduce(0,buffer_size),20.5);
+  ymd::AlmostEqual(st.reduce(6,33),10.0);
+  ymd::AlmostEqual(mt.reduce(0,buffer_size),0.5);
+  ymd::AlmostEqual(mt.reduce(0,32),3.0);
+
+  // Contiguous set wrapping around
+  st.set(60,1.0,8);
+  ymd::AlmostEqual(st.reduce(0,buffer_size),8.0 + 5.0 + 4.0 + 6.0 + 0.5);
+  ymd::AlmostEqual(st.reduce(0,4),4.0);
+  ymd::AlmostEqual(st.reduce(56,64),4.0);
+}
+
+template<std::size_t K>
+void kary_test(){
+  auto g = std::mt19937{0};
+  auto d = std::uniform_real_distribution<double>{};
+
+  for(auto buffer_size: {1ul,2ul,3ul,5ul,8ul,64ul,100ul,1000ul}){
+    auto st = ymd::SegmentTree<double,false,ymd::Sum<double>>(ymd::PowerOf2(buffer_size));
+    auto kt = ymd::KarySumTree<double,K>(buffer_size);
+
+    for(auto i = 0ul; i < buffer_size; ++i){
+      // Zero priorities are never drawn.
+      auto v = (i % 7 == 3) ? 0.0: d(g);
+      st.set(i,v);
+      kt.set(i,v);
+    }
+
+    // Contiguous set wrapping around, and scattered set
+    auto start = std::size_t(d(g) * buffer_size);
+    st.set(start,0.25,buffer_size / 2 + 1,buffer_size);
+    kt.set(start,0.25,buffer_size / 2 + 1,buffer_size);
+    auto indexes = std::vector<std::size_t>{};
+    auto values = std::vector<double>{};
+    for(auto i = 0ul; i < 10ul; ++i){
+      indexes.push_back(std::min(std::size_t(d(g) * buffer_size),buffer_size - 1));
+      values.push_back(d(g));
+    }
+    st.set(indexes.data(),values.data(),indexes.size());
+    kt.set(indexes.data(),values.data(),indexes.size());
+
+    for(auto i = 0ul; i < buffer_size; ++i){ ymd::AlmostEqual(kt.get(i),st.get(i)); }
+    for(auto i = 0ul; i < 100ul; ++i){
+      auto b = std::min(std::size_t(d(g) * buffer_size),buffer_size - 1);
+      auto e = b + std::size_t(d(g) * (buffer_size - b)) + 1;
+      ymd::AlmostEqual(kt.reduce(b,e),st.reduce(b,e));
+    }
+    ymd::AlmostEqual(kt.reduce(0,0),0.0);
+
+    const auto total = kt.reduce(0,buffer_size);
+    auto masses = std::vector<double>(256);
+    for(auto i = 0ul; i < masses.size(); ++i){
+      masses[i] = (d(g) + i) * total / masses.size();
+    }
+    auto residuals = masses;
+    auto kary_indexes = std::vector<std::size_t>(masses.size());
+    kt.prefix_sum_indexes(residuals.data(),masses.size(),kary_indexes.data());
+    for(auto i = 0ul; i < masses.size(); ++i){
+      auto index = kt.prefix_sum_index(masses[i]);
+      ymd::Equal(index,st.prefix_sum_index(masses[i],buffer_size));
+      ymd::Equal(kary_indexes[i],index);
+      assert(kt.get(index) > 0.0);
+    }
+    ymd::Equal(kt.prefix_sum_index(total * 2),buffer_size - 1);
+
+    auto leaves = std::vector<double>(buffer_size);
+    std::generate(leaves.begin(),leaves.end(),[&](){ return d(g); });
+    kt.assign(leaves.begin(),buffer_size);
+    ymd::AlmostEqual(kt.reduce(0,buffer_size),
+		     std::accumulate(leaves.begin(),leaves.end(),0.0));
+
+    kt.clear();
+    ymd::AlmostEqual(kt.reduce(0,buffer_size),0.0);
+  }
+}
+
+void batch_set_benchmark(){
+  // Priority update: per index set of sum and min vs batched set
+  constexpr auto buffer_size = 1ul << 20;
+  constexpr auto n_batch = 100ul;
+
+  auto sum = ymd::SegmentTree<float,false,ymd::Sum<float>>(buffer_size);
+  auto min = ymd::SegmentTree<float,false,ymd::Min<float>>(buffer_size,
+							  ymd::Min<float>{},
+							  1e+10);
+
+  auto g = std::mt19937{0};
+  auto d = std::uniform_real_distribution<float>{};
+  for(auto sorted: {true,false}){
+    for(auto batch_size = 32ul; batch_size <= 8192ul; batch_size *= 4){
+      // Sorted indexes are like sampled ones.
+      auto indexes = std::vector<std::size_t>(batch_size * n_batch);
+      auto values = std::vector<float>(batch_size * n_batch);
+      for(auto i = 0ul; i < indexes.size(); ++i){
+	auto u = sorted ? d(g) + (i % batch_size): d(g) * batch_size;
+	indexes[i] = std::min(std::size_t(u * buffer_size / batch_size),
+			      buffer_size - 1);
+	values[i] = d(g);
+      }
+
+      std::cout << (sorted ? "sorted ": "random ")
+		<< "set x " << batch_size << ": ";
+      ymd::timer([&,b=0ul]() mutable {
+	for(auto i = b; i < b + batch_size; ++i){
+	  sum.set(indexes[i],values[i]);
+	  min.set(indexes[i],values[i]);
+	}
+	b += batch_size;
+      },n_batch);
+
+      std::cout << (sorted ? "sorted ": "random ")
+		<< "batched set (" << batch_size << "): ";
+      ymd::timer([&,b=0ul]() mutable {
+	sum.set(indexes.data() + b,values.data() + b,batch_size);
+	min.set(indexes.data() + b,values.data() + b,batch_size);
+	b += batch_size;
+      },n_batch);
+    }
+  }
+
+  for(auto batch_size = 32ul; batch_size <= 8192ul; batch_size *= 4){
+    // Contiguous (wrapped around) range like add_batch.
+    const auto start = buffer_size - batch_size / 2;
+    auto values = std::vector<float>(batch_size * n_batch);
+    std::generate(values.begin(),values.end(),[&](){ return d(g); });
+
+    std::cout << "contiguous set x " << batch_size << ": ";
+    ymd::timer([&,b=0ul]() mutable {
+      for(auto i = 0ul; i < batch_size; ++i){
+	sum.set((start + i) % buffer_size,values[b + i]);
+	min.set((start + i) % buffer_size,values[b + i]);
+      }
+      b += batch_size;
+    },n_batch);
+
+    std::cout << "contiguous batched set (" << batch_size << "): ";
+    ymd::timer([&,b=0ul]() mutable {
+      sum.set(start,[v=values.begin()+b]() mutable { return *v++; },
+	      batch_size,buffer_size);
+      min.set(start,[v=values.begin()+b]() mutable { return *v++; },
+	      batch_size,buffer_size);
+      b += batch_size;
+    },n_batch);
+  }
+}
+
+void prefix_sum_benchmark(){
+  // Draw of PER: binary search (O(log^2 n)) vs descent (O(log n))
+  constexpr auto buffer_size = 1ul << 22;
+  constexpr auto batch_size = 512ul;
+  constexpr auto n_batch = 100ul;
+
+  auto function_tree = ymd::SegmentTree<float>(buffer_size,
+					       [](auto a,auto b){ return a+b; });
+  auto functor_tree = ymd::SegmentTree<float,false,ymd::Sum<float>>(buffer_size);
+
+  auto g = std::mt19937{0};
+  auto d = std::uniform_real_distribution<float>{};
+  auto v = std::vector<float>(buffer_size);
+  std::generate(v.begin(),v.end(),[&](){ return d(g); });
+  function_tree.assign(v.begin(),buffer_size);
+  functor_tree.assign(v.begin(),buffer_size);
+
+  const auto total = functor_tree.reduce(0,buffer_size);
+  auto masses = std::vector<float>(batch_size);
+  std::generate(masses.begin(),masses.end(),[&](){ return d(g) * total; });
+
+  auto sink = 0ul;
+  std::cout << "largest_region_index (std::function): ";
+  ymd::timer([&](){
+    for(auto mass: masses){
+      sink += function_tree.largest_region_index([=](auto v){ return v <= mass; });
+    }
+  },n_batch);
+
+  std::cout << "largest_region_index (functor): ";
+  ymd::timer([&](){
+    for(auto mass: masses){
+      sink += functor_tree.largest_region_index([=](auto v){ return v <= mass; });
+    }
+  },n_batch);
+
+  std::cout << "prefix_sum_index (functor): ";
+  ymd::timer([&](){
+    for(auto mass: masses){ sink += functor_tree.prefix_sum_index(mass); }
+  },n_batch);
+
+  std::cout << "(" << sink << ")" << std::endl;
+}
+
+void batched_prefix_sum_benchmark(){
+  // Stratified draws of PER: independent descents vs a batched descent
+  constexpr auto buffer_size = 1ul << 24;
+  constexpr auto batch_size = 4096ul;
+  constexpr auto n_batch = 20ul;
+
+  auto st = ymd::SegmentTree<float,false,ymd::Sum<float>>(buffer_size);
+
+  auto g = std::mt19937{0};
+  auto d = std::uniform_real_distribution<float>{};
+  auto v = std::vector<float>(buffer_size);
+  std::generate(v.begin(),v.end(),[&](){ return d(g); });
+  st.assign(v.begin(),buffer_size);
+
+  const auto every_range_len = st.reduce(0,buffer_size) / batch_size;
+  auto masses = std::vector<float>(batch_size);
+  for(auto i = 0ul; i < batch_size; ++i){
+    masses[i] = (d(g) + i) * every_range_len;
+  }
+
+  auto indexes = std::vector<std::size_t>(batch_size);
+  auto sink = 0ul;
+  std::cout << "prefix_sum_index x " << batch_size << ": ";
+  ymd::timer([&](){
+    for(auto i = 0ul; i < batch_size; ++i){
+      indexes[i] = st.prefix_sum_index(masses[i]);
+    }
+    sink += indexes.back();
+  },n_batch);
+
+  auto residuals = std::vector<float>(batch_size);
+  std::cout << "prefix_sum_indexes (" << batch_size << "): ";
+  ymd::timer([&](){
+    std::copy(masses.begin(),masses.end(),residuals.begin());
+    st.prefix_sum_indexes(residuals.data(),batch_size,indexes.data());
+    sink += indexes.back();
+  },n_batch);
+
+  std::cout << "(" << sink << ")" << std::endl;
+}
+
+void kary_benchmark(){
+  // Stratified draws and priority updates of PER: binary vs K-ary sum trees
+  constexpr auto batch_size = 256ul;
+  constexpr auto n_batch = 100ul;
+
+  auto g = std::mt19937{0};
+  auto d = std::uniform_real_distribution<float>{};
+
+  for(auto buffer_size = 1ul << 16; buffer_size <= (1ul << 24); buffer_size <<= 2){
+    auto binary = ymd::SegmentTree<float,false,ymd::Sum<float>>(buffer_size);
+    auto kary4 = ymd::KarySumTree<float,4>(buffer_size);
+    auto kary8 = ymd::KarySumTree<float,8>(buffer_size);
+
+    auto v = std::vector<float>(buffer_size);
+    std::generate(v.begin(),v.end(),[&](){ return d(g); });
+    binary.assign(v.begin(),buffer_size);
+    kary4.assign(v.begin(),buffer_size);
+    kary8.assign(v.begin(),buffer_size);
+
+    const auto every_range_len = binary.reduce(0,buffer_size) / batch_size;
+    auto masses = std::vector<float>(batch_size * n_batch);
+    for(auto i = 0ul; i < masses.size(); ++i){
+      masses[i] = (d(g) + (i % batch_size)) * every_range_len;
+    }
+    auto residuals = std::vector<float>(batch_size);
+    auto indexes = std::vector<std::size_t>(batch_size);
+    auto values = std::vector<float>(batch_size);
+
+    auto bench = [&](auto& tree,auto name){
+      std::cout << "2^" << __builtin_ctzl(buffer_size) << " " << name
+		<< " prefix_sum_indexes (" << batch_size << "): ";
+      ymd::timer([&,b=0ul]() mutable {
+	std::copy_n(masses.begin() + b,batch_size,residuals.begin());
+	tree.prefix_sum_indexes(residuals.data(),batch_size,indexes.data());
+	b += batch_size;
+      },n_batch);
+
+      std::cout << "2^" << __builtin_ctzl(buffer_size) << " " << name
+		<< " sample and set (" << batch_size << "): ";
+      ymd::timer([&,b=0ul]() mutable {
+	std::copy_n(masses.begin() + b,batch_size,residuals.begin());
+	tree.prefix_sum_indexes(residuals.data(),batch_size,indexes.data());
+	std::generate(values.begin(),values.end(),[&](){ return d(g); });
+	tree.set(indexes.data(),values.data(),batch_size);
+	b += batch_size;
+      },n_batch);
+    };
+    bench(binary,"binary");
+    bench(kary4,"4-ary");
+    bench(kary8,"8-ary");
+  }
+}
+
 int main(){
   constexpr auto buffer_size = 16;
 
@@ -76,5 +416,14 @@ int main(){
 
   multi_thread_test();
 
+  prefix_sum_test();
+  batch_set_test();
+  kary_test<4>();
+  kary_test<8>();
+  prefix_sum_benchmark();
+  batched_prefix_sum_benchmark();
+  batch_set_benchmark();
+  kary_benchmark();
+
   return 0;
 }
@@ -1,7 +1,15 @@
+import multiprocessing
 import numpy as np
+import pickle
+import tempfile
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
-from cpprb import create_buffer
+from cpprb import create_buffer, ReplayBuffer, PrioritizedReplayBuffer
+from cpprb import MPReplayBuffer, MPPrioritizedReplayBuffer
+from cpprb.PyReplayBuffer import dict2buffer
+from cpprb.codec import EncodedBuffer
 
 class TestFeatureHighDimensionalObs(unittest.TestCase):
     def test_RGB_screen_obs(self):
@@ -58,5 +66,1156 @@ class TestFeatureHighDimensionalObs(unittest.TestCase):
 
         rb.sample(batch_size)
 
+class TestFeatureSampleOut(unittest.TestCase):
+    def test_create_batch(self):
+        rb = ReplayBuffer(32,{"obs": {"shape": 3},"rew": {},"done": {}},
+                          next_of = "obs")
+        batch = rb.create_batch(8)
+
+        self.assertEqual(batch["obs"].shape,(8,3))
+        self.assertEqual(batch["rew"].shape,(8,))
+        self.assertEqual(batch["next_obs"].shape,(8,3))
+        self.assertEqual(batch["obs"].dtype,np.single)
+
+    def test_sample_into_batch(self):
+        rb = ReplayBuffer(32,{"obs": {"shape": 3},"rew": {},"done": {}},
+                          next_of = "obs")
+        for i in range(40):
+            rb.add(obs=np.full(3,i),next_obs=np.full(3,i+1),rew=i,done=0)
+
+        idx = np.array((0,3,7,31))
+        batch = rb.create_batch(idx.shape[0])
+        s = rb._encode_sample(idx,out=batch)
+        expected = rb._encode_sample(idx)
+
+        self.assertIs(s,batch)
+        for key in expected:
+            with self.subTest(key=key):
+                np.testing.assert_allclose(s[key],expected[key])
+
+    def test_owned_batch(self):
+        rb = ReplayBuffer(32,{"obs": {"shape": 3}})
+        rb.add(obs=np.ones(3))
+
+        s1 = rb.sample(4,out=True)
+        s2 = rb.sample(4,out=True)
+        self.assertIs(s1,s2)
+
+    def test_prioritized(self):
+        rb = PrioritizedReplayBuffer(32,{"obs": {"shape": 3}})
+        for i in range(40):
+            rb.add(obs=np.full(3,i))
+
+        batch = rb.create_batch(4)
+        s = rb.sample(4,out=batch)
+        np.testing.assert_allclose(s["obs"][:,0] % 32,s["indexes"])
+
+    def test_prioritized_no_alias(self):
+        rb = PrioritizedReplayBuffer(32,{"obs": {"shape": 3}})
+        for i in range(40):
+            rb.add(obs=np.full(3,i),priorities=i+1)
+
+        s1 = rb.sample(16)
+        w = s1["weights"].copy()
+        idx = s1["indexes"].copy()
+        rb.update_priorities(idx,np.full(idx.shape,1e+4))
+        rb.sample(16)
+
+        np.testing.assert_allclose(s1["weights"],w)
+        np.testing.assert_allclose(s1["indexes"],idx)
+
+class TestFeatureNativeGather(unittest.TestCase):
+    def test_gather(self):
+        rb = ReplayBuffer(64,{"obs": {"shape": (4,4),"dtype": np.ubyte},
+                              "act": {"dtype": np.int32},
+                              "rew": {}},
+                          next_of = "obs")
+        obs = np.arange(70*16,dtype=np.ubyte).reshape(70,4,4)
+        rb.add(obs=obs[:60],next_obs=obs[1:61],act=np.arange(60),rew=np.arange(60))
+
+        idx = np.array((0,1,30,58,59))
+        s = rb._encode_sample(idx)
+        np.testing.assert_allclose(s["obs"],obs[idx])
+        np.testing.assert_allclose(s["next_obs"],obs[idx+1])
+        np.testing.assert_allclose(s["act"],idx)
+        np.testing.assert_allclose(s["rew"],idx)
+
+    def test_multi_thread(self):
+        rb = ReplayBuffer(64,{"obs": {"shape": (128,128),"dtype": np.ubyte}},
+                          gather_threads = 4)
+        obs = np.random.randint(0,255,size=(64,128,128),dtype=np.ubyte)
+        rb.add(obs=obs)
+
+        idx = np.random.randint(0,64,size=256)
+        np.testing.assert_allclose(rb._encode_sample(idx)["obs"],obs[idx])
+
+    def test_stack_compress(self):
+        rb = ReplayBuffer(32,{"obs": {"shape": (3,4)}},
+                          stack_compress = "obs", next_of = "obs")
+        for i in range(40):
+            rb.add(obs=np.full((3,4),i),next_obs=np.full((3,4),i+1))
+
+        s = rb._encode_sample((0,5))
+        np.testing.assert_allclose(s["obs"][:,0,0],(32,37))
+        np.testing.assert_allclose(s["next_obs"][:,0,0],(33,38))
+
+class TestFeatureEpisodeCache(unittest.TestCase):
+    def test_next_of_batch_position(self):
+        rb = ReplayBuffer(32,{"obs": {}},next_of = "obs")
+        for i in range(3):
+            rb.add(obs=i,next_obs=i+1)
+        rb.on_episode_end()
+        for i in range(3):
+            rb.add(obs=10+i,next_obs=10+i+1)
+
+        # Cached slot (2) is sampled at the different batch position.
+        s = rb._encode_sample((5,4,3,2,1,0))
+        np.testing.assert_allclose(s["next_obs"].ravel(),(13,12,11,3,2,1))
+
+    def test_release_overwritten_cache(self):
+        rb = ReplayBuffer(4,{"obs": {}},next_of = "obs")
+        rb.add(obs=0,next_obs=1)
+        rb.on_episode_end()
+        for i in range(4):
+            rb.add(obs=10+i,next_obs=10+i+1)
+
+        s = rb._encode_sample((0,1,2,3))
+        np.testing.assert_allclose(s["next_obs"].ravel(),(14,11,12,13))
+
+    def test_stack_compress(self):
+        rb = ReplayBuffer(32,{"obs": {"shape": 3}},
+                          stack_compress = "obs",next_of = "obs")
+        obs = np.arange(8)
+        for i in range(4):
+            rb.add(obs=obs[i:i+3],next_obs=obs[i+1:i+4])
+        rb.on_episode_end()
+        for i in range(4):
+            rb.add(obs=obs[i:i+3]+100,next_obs=obs[i+1:i+4]+100)
+
+        s = rb.get_all_transitions()
+        for i in range(4):
+            with self.subTest(i=i):
+                np.testing.assert_allclose(s["obs"][i],obs[i:i+3])
+                np.testing.assert_allclose(s["next_obs"][i],obs[i+1:i+4])
+
+class TestFeatureSequence(unittest.TestCase):
+    def test_sequence(self):
+        rb = ReplayBuffer(8,{"obs": {"shape": 2},"done": {}},next_of = "obs")
+        for i in range(11):
+            rb.add(obs=(i,i),next_obs=(i+1,i+1),done=(i % 4 == 3))
+
+        s = rb.sample_sequences(16,3,episode_mask=True)
+        self.assertEqual(s["obs"].shape,(16,3,2))
+        self.assertEqual(s["done"].shape,(16,3,1))
+        self.assertEqual(s["mask"].shape,(16,3))
+
+        # Sequences are contiguous and never cross the write position
+        obs = s["obs"][:,:,0]
+        np.testing.assert_allclose(np.diff(obs,axis=1),np.ones((16,2)))
+        self.assertTrue((obs >= 3).all() and (obs <= 10).all())
+        np.testing.assert_allclose(s["next_obs"][:,:,0],obs + 1)
+
+        done = np.isin(obs,(3,7))
+        mask = np.ones_like(done)
+        mask[:,1:] = ~np.logical_or.accumulate(done[:,:-1],axis=1)
+        np.testing.assert_array_equal(s["mask"],mask)
+
+    def test_too_long(self):
+        rb = ReplayBuffer(8,{"obs": {}})
+        rb.add(obs=np.arange(3))
+        with self.assertRaises(ValueError):
+            rb.sample_sequences(4,4)
+
+    def test_prioritized(self):
+        rb = PrioritizedReplayBuffer(32,{"obs": {}})
+        rb.add(obs=np.arange(20),priorities=np.full(20,1e-8))
+        rb.update_priorities([10],[1e+8])
+
+        s = rb.sample_sequences(8,4)
+        self.assertEqual(s["indexes"].shape,(8,4))
+        self.assertEqual(s["weights"].shape,(8,))
+        self.assertTrue((s["indexes"] == 10).any(axis=1).all())
+        np.testing.assert_allclose(s["obs"][:,:,0],s["indexes"])
+
+class TestFeaturePrefetch(unittest.TestCase):
+    def test_prefetch(self):
+        rb = ReplayBuffer(64,{"obs": {}})
+        rb.start_prefetch(16,n_batches=2)
+        rb.add(obs=np.arange(64))
+
+        for _ in range(10):
+            s = rb.sample(16)
+            self.assertEqual(s["obs"].shape,(16,))
+            rb.add(obs=np.arange(4))
+
+        stats = rb.get_prefetch_stats()
+        self.assertEqual(stats["batches"],10)
+        self.assertLessEqual(stats["waits"],10)
+
+        rb.stop_prefetch()
+        self.assertIsNone(rb.get_prefetch_stats())
+
+    def test_overwritten(self):
+        rb = ReplayBuffer(32,{"obs": {}})
+        rb.start_prefetch(8)
+        rb.add(obs=np.zeros(32))
+        rb.sample(8)
+
+        rb.add(obs=np.ones(32))
+        np.testing.assert_allclose(rb.sample(8)["obs"],np.ones(8))
+        rb.stop_prefetch()
+
+    def test_prioritized(self):
+        rb = PrioritizedReplayBuffer(32,{"obs": {}})
+        rb.start_prefetch(8,beta=0.5)
+        rb.add(obs=np.arange(32))
+
+        for _ in range(10):
+            s = rb.sample(8,beta=0.5)
+            rb.update_priorities(s["indexes"],np.random.rand(8))
+            np.testing.assert_allclose(s["obs"],s["indexes"])
+
+        # Different arguments are sampled synchronously
+        self.assertEqual(rb.sample(4)["weights"].shape,(4,))
+        self.assertEqual(rb.get_prefetch_stats()["batches"],10)
+        rb.stop_prefetch()
+
+class TestFeatureIterBatches(unittest.TestCase):
+    def test_shuffle(self):
+        rb = ReplayBuffer(10,{"obs": {}},next_of = "obs")
+        for i in range(13):
+            rb.add(obs=i,next_obs=i+1)
+
+        obs = np.concatenate([b["obs"] for b in rb.iter_batches(4)])
+        next_obs = np.concatenate([b["next_obs"] for b in rb.iter_batches(4)])
+        np.testing.assert_allclose(np.sort(obs),np.arange(3,13))
+        np.testing.assert_allclose(np.sort(next_obs.ravel()),np.arange(4,14))
+
+    def test_drop_last(self):
+        rb = ReplayBuffer(10,{"obs": {}})
+        rb.add(obs=np.arange(10))
+        self.assertEqual([b["obs"].shape[0] for b in rb.iter_batches(4,drop_last=True)],
+                         [4,4])
+        self.assertEqual([b["obs"].shape[0] for b in rb.iter_batches(4)],
+                         [4,4,2])
+
+    def test_no_shuffle(self):
+        rb = ReplayBuffer(10,{"obs": {}},next_of = "obs")
+        for i in range(13):
+            rb.add(obs=i,next_obs=i+1)
+
+        batches = list(rb.iter_batches(4,shuffle=False))
+        np.testing.assert_allclose(np.concatenate([b["obs"] for b in batches]),
+                                   np.arange(3,13))
+        np.testing.assert_allclose(np.concatenate([b["next_obs"] for b in batches]).ravel(),
+                                   np.arange(4,14))
+
+        # Contiguous batch is a view of the buffer
+        rb.add(obs=np.full(10,-1),next_obs=np.full(10,-1))
+        np.testing.assert_allclose(batches[0]["obs"],np.full(4,-1))
+
+class TestFeatureSampleMany(unittest.TestCase):
+    def test_sample_many(self):
+        rb = ReplayBuffer(32,{"obs": {"shape": 3},"rew": {}},next_of = "obs")
+        for i in range(20):
+            rb.add(obs=np.full(3,i),rew=i,next_obs=np.full(3,i+1))
+
+        s = rb.sample_many(4,8)
+        self.assertEqual(s["obs"].shape,(4,8,3))
+        self.assertEqual(s["rew"].shape,(4,8))
+        self.assertEqual(s["next_obs"].shape,(4,8,3))
+        np.testing.assert_allclose(s["obs"][:,:,0],s["rew"])
+        np.testing.assert_allclose(s["next_obs"],s["obs"] + 1)
+
+    def test_prioritized(self):
+        rb = PrioritizedReplayBuffer(64,{"obs": {}})
+        rb.add(obs=np.arange(64))
+
+        s = rb.sample_many(4,8)
+        self.assertEqual(s["weights"].shape,(4,8))
+        self.assertEqual(s["indexes"].shape,(4,8))
+        np.testing.assert_allclose(s["obs"],s["indexes"])
+
+        # Each batch spans all the priority range
+        for k in range(4):
+            with self.subTest(k=k):
+                np.testing.assert_array_equal(s["indexes"][k] // 8,np.arange(8))
+
+class TestFeatureAddFastPath(unittest.TestCase):
+    def test_wrap(self):
+        rb = ReplayBuffer(8,{"obs": {"shape": (2,2)},"rew": {}},next_of = "obs")
+        for i in range(3):
+            rb.add(obs=np.full((5,2,2),i,dtype=np.single),
+                   rew=np.arange(5) + 5*i,
+                   next_obs=np.full((5,2,2),i+1,dtype=np.single))
+
+        s = rb.get_all_transitions()
+        np.testing.assert_allclose(s["rew"],np.roll(np.arange(7,15),-1))
+        np.testing.assert_allclose(s["obs"][:,0,0],(1,1,2,2,2,2,2,1))
+        np.testing.assert_allclose(s["next_obs"][6],np.full((2,2),3))
+
+    def test_conversion(self):
+        rb = ReplayBuffer(8,{"obs": {"shape": 3},"act": {"dtype": np.int32}})
+        rb.add(obs=np.arange(3,dtype=np.double),act=1)
+        rb.add(obs=[3,4,5],act=np.int64(2))
+        rb.add(obs=np.arange(6,12,dtype=np.single).reshape(3,2).T,act=np.arange(2))
+
+        s = rb.get_all_transitions()
+        np.testing.assert_allclose(s["obs"],((0,1,2),(3,4,5),(6,8,10),(7,9,11)))
+        np.testing.assert_array_equal(s["act"],(1,2,0,1))
+        self.assertEqual(s["act"].dtype,np.int32)
+
+class TestFeatureAddBatch(unittest.TestCase):
+    def test_dict(self):
+        rb = ReplayBuffer(10,{"obs": {"shape": 3},"rew": {}},next_of = "obs")
+        obs = np.repeat(np.arange(7,dtype=np.single)[:,np.newaxis],3,axis=1)
+        for _ in range(2):
+            rb.add_batch({"obs": obs,
+                          "rew": obs[:,:1].copy(),
+                          "next_obs": obs + 1})
+
+        s = rb.get_all_transitions()
+        np.testing.assert_allclose(s["rew"],(3,4,5,6,4,5,6,0,1,2))
+        np.testing.assert_allclose(s["obs"][:,0],s["rew"])
+        np.testing.assert_allclose(s["next_obs"][3],np.full(3,7))
+
+    def test_structured(self):
+        rb = ReplayBuffer(10,{"obs": {"shape": 3},"rew": {}},next_of = "obs")
+        a = np.zeros(4,dtype=[("obs",np.single,(3,)),
+                              ("rew",np.single),
+                              ("next_obs",np.single,(3,))])
+        a["obs"] = np.arange(4)[:,np.newaxis]
+        a["rew"] = np.arange(4)
+        a["next_obs"] = a["obs"] + 1
+        rb.add_batch(a)
+
+        s = rb.get_all_transitions()
+        np.testing.assert_allclose(s["obs"],a["obs"])
+        np.testing.assert_allclose(s["rew"],a["rew"])
+        np.testing.assert_allclose(s["next_obs"],a["next_obs"])
+
+    def test_checked(self):
+        rb = ReplayBuffer(10,{"obs": {"shape": 3}})
+        with self.assertRaises(ValueError):
+            rb.add_batch({"obs": np.zeros((2,3))},unchecked=False)
+        with self.assertRaises(ValueError):
+            rb.add_batch({"obs": np.zeros((2,4),dtype=np.single)},unchecked=False)
+        self.assertEqual(rb.get_stored_size(),0)
+
+    def test_prioritized(self):
+        rb = PrioritizedReplayBuffer(10,{"obs": {}})
+        rb.add_batch({"obs": np.zeros((4,1),dtype=np.single)},
+                     priorities=(1,2,3,4))
+        self.assertEqual(rb.get_stored_size(),4)
+        self.assertEqual(rb.get_max_priority(),4)
+
+class TestFeatureMultiStream(unittest.TestCase):
+    def test_compress(self):
+        E = 3
+        kwargs = {"next_of": "obs","stack_compress": "obs"}
+        env_dict = {"obs": {"shape": 3},"done": {}}
+        rb = ReplayBuffer(8*E,env_dict,num_envs = E,**kwargs)
+        rbs = [ReplayBuffer(8,env_dict,**kwargs) for _ in range(E)]
+
+        rng = np.random.default_rng(42)
+        frames = [list(rng.random(3)) for _ in range(E)]
+        for _ in range(30):
+            obs = np.array([f[-3:] for f in frames],dtype=np.single)
+            for f in frames:
+                f.append(rng.random())
+            next_obs = np.array([f[-3:] for f in frames],dtype=np.single)
+            done = (rng.random(E) < 0.2).astype(np.single)
+
+            rb.add(obs=obs,next_obs=next_obs,done=done)
+            for i in range(E):
+                rbs[i].add(obs=obs[i],next_obs=next_obs[i],done=done[i])
+                if done[i]:
+                    rbs[i].on_episode_end()
+                    frames[i] = list(rng.random(3))
+
+        s = rb.get_all_transitions()
+        for i in range(E):
+            with self.subTest(stream=i):
+                _s = rbs[i].get_all_transitions()
+                for name in ("obs","next_obs","done"):
+                    np.testing.assert_allclose(s[name][i::E],_s[name])
+
+    def test_nstep(self):
+        E = 2
+        env_dict = lambda: {"obs": {},"rew": {},"done": {}}
+        Nstep = {"size": 3,"rew": "rew","gamma": 0.9}
+        rb = PrioritizedReplayBuffer(4*E,env_dict(),num_envs = E,Nstep = Nstep)
+        rbs = [ReplayBuffer(4,env_dict(),Nstep = Nstep) for _ in range(E)]
+
+        rng = np.random.default_rng(42)
+        for _ in range(10):
+            obs = rng.random(E)
+            rew = rng.random(E)
+            done = (rng.random(E) < 0.3).astype(np.single)
+            rb.add(obs=obs,rew=rew,done=done)
+            for i in range(E):
+                rbs[i].add(obs=obs[i],rew=rew[i],done=done[i])
+
+        s = rb.get_all_transitions()
+        for i in range(E):
+            with self.subTest(stream=i):
+                _s = rbs[i].get_all_transitions()
+                for name in ("obs","rew","done","discounts"):
+                    np.testing.assert_allclose(s[name][i::E],_s[name])
+
+    def test_truncation(self):
+        E = 3
+        env_dict = {"obs": {"shape": 3},"done": {}}
+        for kwargs in [{"next_of": "obs"},
+                       {"next_of": "obs","stack_compress": "obs"},
+                       {"next_of": "obs","frame_store": "obs"}]:
+            with self.subTest(kwargs=kwargs):
+                rb = ReplayBuffer(8*E,env_dict,num_envs = E,**kwargs)
+                rbs = [ReplayBuffer(8,env_dict,**kwargs) for _ in range(E)]
+
+                rng = np.random.default_rng(42)
+                frames = [list(rng.random(3)) for _ in range(E)]
+                for _ in range(30):
+                    obs = np.array([f[-3:] for f in frames],dtype=np.single)
+                    for f in frames:
+                        f.append(rng.random())
+                    next_obs = np.array([f[-3:] for f in frames],dtype=np.single)
+                    done = (rng.random(E) < 0.1).astype(np.single)
+                    truncated = (rng.random(E) < 0.2) & (done == 0)
+
+                    rb.add(obs=obs,next_obs=next_obs,done=done)
+                    rb.on_episode_end(np.flatnonzero(truncated))
+                    for i in range(E):
+                        rbs[i].add(obs=obs[i],next_obs=next_obs[i],done=done[i])
+                        if done[i] or truncated[i]:
+                            rbs[i].on_episode_end()
+                            frames[i] = list(rng.random(3))
+
+                s = rb.get_all_transitions()
+                for i in range(E):
+                    _s = rbs[i].get_all_transitions()
+                    for name in ("obs","next_obs","done"):
+                        np.testing.assert_allclose(s[name][i::E],_s[name])
+
+    def test_nstep_truncation(self):
+        E = 2
+        env_dict = lambda: {"obs": {},"rew": {},"done": {}}
+        Nstep = {"size": 3,"rew": "rew","gamma": 0.9}
+        for cls in [ReplayBuffer,PrioritizedReplayBuffer]:
+            with self.subTest(cls=cls):
+                rb = cls(16*E,env_dict(),num_envs = E,Nstep = Nstep)
+                rbs = [cls(16,env_dict(),Nstep = Nstep) for _ in range(E)]
+
+                rng = np.random.default_rng(42)
+                for _ in range(12):
+                    obs = rng.random(E)
+                    rew = rng.random(E)
+                    done = (rng.random(E) < 0.1).astype(np.single)
+                    truncated = (rng.random(E) < 0.3) & (done == 0)
+
+                    rb.add(obs=obs,rew=rew,done=done)
+                    rb.on_episode_end(np.flatnonzero(truncated))
+                    for i in range(E):
+                        rbs[i].add(obs=obs[i],rew=rew[i],done=done[i])
+                        if truncated[i]:
+                            rbs[i].on_episode_end()
+
+                # Values flushed at truncation are stored in lockstep later.
+                s = rb.get_all_transitions()
+                self.assertEqual(s["obs"].shape[0],(12 - 2) * E)
+                for i in range(E):
+                    _s = rbs[i].get_all_transitions()
+                    for name in ("obs","rew","done","discounts"):
+                        np.testing.assert_allclose(s[name][i::E],
+                                                   _s[name][:12 - 2])
+
+    def test_sequence(self):
+        E = 4
+        rb = ReplayBuffer(16*E,{"obs": {}},num_envs = E)
+        for i in range(10):
+            rb.add(obs=np.arange(E) + 100*i)
+
+        s = rb.sample_sequences(8,5)
+        np.testing.assert_allclose(np.diff(s["obs"][:,:,0],axis=1),
+                                   np.full((8,4),100))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            ReplayBuffer(10,{"obs": {}},num_envs = 4)
+        with self.assertRaises(ValueError):
+            ReplayBuffer(8,{"obs": {}},num_envs = 4,next_of = "obs")
+
+        rb = ReplayBuffer(8,{"obs": {},"done": {}},num_envs = 4,next_of = "obs")
+        with self.assertRaises(ValueError):
+            rb.add(obs=np.ones(3),next_obs=np.ones(3),done=np.zeros(3))
+        with self.assertRaises(ValueError):
+            rb.on_episode_end([4])
+
+class TestFeatureLayout(unittest.TestCase):
+    def test_record(self):
+        env_dict = lambda: {"obs": {"shape": (4,4)},
+                            "act": {"dtype": np.int64},
+                            "rew": {},
+                            "done": {}}
+        kwargs = {"next_of": "obs","stack_compress": "obs"}
+        rb = ReplayBuffer(32,env_dict(),layout="column",**kwargs)
+        rrb = ReplayBuffer(32,env_dict(),layout="record",**kwargs)
+
+        obs = np.arange(4*4*50,dtype=np.single).reshape(-1,4,4)
+        for i in range(40):
+            for b in (rb,rrb):
+                b.add(obs=obs[i],next_obs=obs[i+1],act=i,rew=0.5*i,
+                      done=(i%7 == 6))
+                if i%7 == 6:
+                    b.on_episode_end()
+
+        idx = np.arange(32)
+        s = rb._encode_sample(idx)
+        rs = rrb._encode_sample(idx)
+        for name in ("obs","next_obs","act","rew","done"):
+            with self.subTest(name=name):
+                np.testing.assert_allclose(rs[name],s[name])
+
+    def test_dict2buffer(self):
+        buffer = dict2buffer(8,{"obs": {"shape": 3},"act": {"dtype": np.int64},
+                                "rew": {}},
+                             stack_compress="obs",layout="record")
+        self.assertIs(buffer["act"].base,buffer["rew"].base)
+        self.assertFalse(np.may_share_memory(buffer["obs"],buffer["rew"]))
+        self.assertEqual(buffer["act"].shape,(8,1))
+        self.assertEqual(buffer["act"].dtype,np.int64)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            ReplayBuffer(32,{"obs": {}},layout="unknown")
+
+class TestFeatureMmap(unittest.TestCase):
+    def _fill(self,rb):
+        for i in range(23):
+            rb.add(obs=[i,i+1,i+2],next_obs=[i+1,i+2,i+3],act=i,done=(i%5 == 4))
+            if i%5 == 4:
+                rb.on_episode_end()
+
+    def test_reopen(self):
+        env_dict = lambda: {"obs": {"shape": 3},"act": {},"done": {}}
+        kwargs = {"next_of": "obs","stack_compress": "obs"}
+        for cls in (ReplayBuffer,PrioritizedReplayBuffer):
+            for layout in ("column","record"):
+                with self.subTest(cls=cls,layout=layout), \
+                     tempfile.TemporaryDirectory() as path:
+                    rb = cls(16,env_dict(),storage="mmap",path=path,
+                             layout=layout,**kwargs)
+                    ref = cls(16,env_dict(),**kwargs)
+                    for b in (rb,ref):
+                        self._fill(b)
+                    rb.flush()
+                    del rb
+
+                    rb = cls(16,env_dict(),storage="mmap",path=path,
+                             layout=layout,**kwargs)
+                    self.assertEqual(rb.get_stored_size(),ref.get_stored_size())
+                    self.assertEqual(rb.get_next_index(),ref.get_next_index())
+
+                    idx = np.arange(16)
+                    s = rb._encode_sample(idx)
+                    ref_s = ref._encode_sample(idx)
+                    for name in ("obs","next_obs","act","done"):
+                        np.testing.assert_allclose(s[name],ref_s[name])
+
+    def test_priorities(self):
+        with tempfile.TemporaryDirectory() as path:
+            rb = PrioritizedReplayBuffer(8,{"done": {}},storage="mmap",path=path)
+            rb.add(done=np.zeros(8),priorities=np.ones(8))
+            rb.update_priorities([3],[100.0])
+            rb.flush()
+            del rb
+
+            rb = PrioritizedReplayBuffer(8,{"done": {}},storage="mmap",path=path)
+            self.assertEqual(rb.get_max_priority(),100.0)
+            s = rb.sample(1000)
+            self.assertGreater(np.mean(s["indexes"] == 3),0.5)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            ReplayBuffer(8,{"done": {}},storage="mmap")
+        with self.assertRaises(ValueError):
+            ReplayBuffer(8,{"done": {}},storage="unknown")
+
+        with tempfile.TemporaryDirectory() as path:
+            ReplayBuffer(8,{"done": {}},storage="mmap",path=path)
+            with self.assertRaises(ValueError):
+                ReplayBuffer(16,{"done": {}},storage="mmap",path=path)
+
+def mp_explorer(rb,k,n):
+    for i in range(n):
+        rb.add(obs=np.full(3,1000*k+i),done=0)
+
+class TestFeatureMP(unittest.TestCase):
+    def test_processes(self):
+        for cls in (MPReplayBuffer,MPPrioritizedReplayBuffer):
+            with self.subTest(cls=cls):
+                rb = cls(1024,{"obs": {"shape": 3},"done": {}})
+                ps = [multiprocessing.Process(target=mp_explorer,args=(rb,k,100))
+                      for k in range(4)]
+                for p in ps:
+                    p.start()
+                for p in ps:
+                    p.join()
+
+                self.assertEqual(rb.get_stored_size(),400)
+                obs = rb.get_all_transitions()["obs"]
+                np.testing.assert_allclose(np.unique(obs[:,0]),
+                                           np.sort([1000*k+i
+                                                    for k in range(4)
+                                                    for i in range(100)]))
+
+                s = rb.sample(32)
+                self.assertEqual(s["obs"].shape,(32,3))
+                np.testing.assert_allclose(s["obs"],s["obs"][:,:1] * np.ones(3))
+
+    def test_pickle(self):
+        rb = MPPrioritizedReplayBuffer(8,{"done": {}})
+        attached = pickle.loads(pickle.dumps(rb))
+        attached.add(done=np.ones(3),priorities=[1.0,2.0,3.0])
+
+        self.assertEqual(rb.get_stored_size(),3)
+        self.assertEqual(rb.get_max_priority(),3.0)
+        np.testing.assert_allclose(rb.get_all_transitions()["done"],
+                                   np.ones((3,1)))
+
+    def test_priorities(self):
+        rb = MPPrioritizedReplayBuffer(8,{"done": {}})
+        rb.add(done=np.zeros(8),priorities=np.ones(8))
+        rb.update_priorities([3],[100.0])
+
+        s = rb.sample(1000)
+        self.assertGreater(np.mean(s["indexes"] == 3),0.5)
+        self.assertEqual(s["weights"].shape,(1000,))
+
+    def test_wrap(self):
+        rb = MPReplayBuffer(4,{"done": {}})
+        rb.add(done=np.arange(3))
+        rb.add(done=np.arange(3,9))
+
+        self.assertEqual(rb.get_stored_size(),4)
+        self.assertEqual(rb.get_next_index(),1)
+        np.testing.assert_allclose(rb.get_all_transitions()["done"].ravel(),
+                                   [8,5,6,7])
+
+class TestFeatureThreadSafePER(unittest.TestCase):
+    def test_weights(self):
+        rb = PrioritizedReplayBuffer(32,{"done": {}})
+        ts = PrioritizedReplayBuffer(32,{"done": {}},thread_safe=True)
+        priorities = np.arange(1,33,dtype=np.single)
+        for b in (rb,ts):
+            b.add(done=np.zeros(32),priorities=priorities)
+            b.update_priorities([0,1],[50.0,0.5])
+            self.assertEqual(b.get_max_priority(),50.0)
+
+        weights = {}
+        for b in (rb,ts):
+            s = b.sample(1000)
+            weights[b is ts] = dict(zip(s["indexes"].tolist(),s["weights"].tolist()))
+
+        common = weights[False].keys() & weights[True].keys()
+        self.assertGreater(len(common),0)
+        for i in common:
+            self.assertAlmostEqual(weights[False][i],weights[True][i],places=5)
+
+    def test_threads(self):
+        rb = PrioritizedReplayBuffer(256,{"obs": {"shape": 2},"done": {}},
+                                     thread_safe=True)
+        rb.add(obs=np.zeros((16,2)),done=np.zeros(16))
+
+        def actor():
+            for i in range(200):
+                rb.add(obs=np.full((4,2),i),done=np.zeros(4),
+                       priorities=np.random.rand(4))
+
+        actors = [threading.Thread(target=actor) for _ in range(4)]
+        for a in actors:
+            a.start()
+        while any(a.is_alive() for a in actors):
+            s = rb.sample(32)
+            rb.update_priorities(s["indexes"],np.random.rand(32))
+        for a in actors:
+            a.join()
+
+        self.assertEqual(rb.get_stored_size(),256)
+        s = rb.sample(64)
+        self.assertTrue((s["indexes"] < 256).all())
+        self.assertTrue((s["weights"] > 0).all())
+
+        rb.clear()
+        self.assertEqual(rb.get_stored_size(),0)
+
+class TestFeatureCodec(unittest.TestCase):
+    @staticmethod
+    def env(codec):
+        return {"obs": {"shape": (8,8),"dtype": np.ubyte,"codec": codec},
+                "done": {}}
+
+    def test_roundtrip(self):
+        obs = np.random.randint(0,256,size=(20,8,8)).astype(np.ubyte)
+        obs[:,:4] = 7
+        for codec in ["zlib","rle"]:
+            with self.subTest(codec=codec):
+                rb = ReplayBuffer(16,self.env(codec))
+                rb.add(obs=obs,done=np.zeros(20))
+                np.testing.assert_array_equal(rb.get_all_transitions()["obs"],
+                                              np.roll(obs[4:],4,axis=0))
+
+    def test_sample(self):
+        obs = np.random.randint(0,4,size=(64,8,8)).astype(np.ubyte)
+        raw = ReplayBuffer(64,{"obs": {"shape": (8,8),"dtype": np.ubyte},
+                               "done": {}})
+        raw.add(obs=obs,done=np.zeros(64))
+        for gather_threads in [1,4]:
+            with self.subTest(gather_threads=gather_threads):
+                rb = ReplayBuffer(64,self.env("zlib"),
+                                  gather_threads=gather_threads)
+                rb.add(obs=obs,done=np.zeros(64))
+
+                np.random.seed(42)
+                s = rb.sample(128)
+                np.random.seed(42)
+                r = raw.sample(128)
+                self.assertEqual(s["obs"].dtype,np.ubyte)
+                np.testing.assert_array_equal(s["obs"],r["obs"])
+
+    def test_pool(self):
+        class Pool:
+            def __init__(self):
+                self.n = 0
+            def submit(self,f,*args):
+                self.n += 1
+                return ThreadPoolExecutor(1).submit(f,*args)
+
+        rows = np.random.randint(0,4,size=(16,8,8)).astype(np.ubyte)
+        for codec, releases_gil in [("zlib",True),("rle",False)]:
+            with self.subTest(codec=codec):
+                e = EncodedBuffer(16,(8,8),np.ubyte,codec)
+                e.store(np.arange(16),rows)
+                out = np.empty_like(rows)
+                pool = Pool()
+                e.decode(np.arange(16),out,pool,4)
+                np.testing.assert_array_equal(out,rows)
+                self.assertEqual(pool.n > 0,releases_gil)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            ReplayBuffer(16,{"obs": {"codec": "rle"}})
+        with self.assertRaises(ValueError):
+            ReplayBuffer(16,{"obs": {"dtype": np.ubyte,"codec": "rle"}},
+                         next_of="obs")
+        with self.assertRaises(ValueError):
+            ReplayBuffer(16,{"obs": {"codec": "unknown"}})
+
+
+class TestFeatureFrameStore(unittest.TestCase):
+    @staticmethod
+    def env(shape):
+        return {"obs": {"shape": shape,"dtype": np.ubyte},"done": {}}
+
+    def _check(self,num_envs,axis,next_of,p_done,n_step = 200):
+        shape = (3,2,4) if axis == -1 else (4,3,2)
+        raw = ReplayBuffer(24,self.env(shape),next_of=next_of,num_envs=num_envs)
+        rb = ReplayBuffer(24,self.env(shape),next_of=next_of,num_envs=num_envs,
+                          frame_store="obs",frame_axis=axis)
+
+        def reset():
+            f = np.random.randint(1,256,size=(3,2)).astype(np.ubyte)
+            return [np.zeros_like(f)] * 3 + [f]
+
+        stacks = [reset() for _ in range(num_envs)]
+        for _ in range(n_step):
+            obs = np.stack([np.stack(s,axis=axis) for s in stacks])
+            for s in stacks:
+                s.append(np.random.randint(0,4,size=(3,2)).astype(np.ubyte))
+                del s[0]
+            next_obs = np.stack([np.stack(s,axis=axis) for s in stacks])
+            done = (np.random.rand(num_envs) < p_done).astype(np.single)
+
+            kwargs = {"obs": obs,"done": done}
+            if next_of:
+                kwargs["next_obs"] = next_obs
+            if num_envs == 1:
+                kwargs = {k: v[0] for k, v in kwargs.items()}
+            for b in (raw,rb):
+                b.add(**kwargs)
+
+            for i in np.flatnonzero(done):
+                stacks[i] = reset()
+                if num_envs == 1:
+                    raw.on_episode_end()
+                    rb.on_episode_end()
+
+        expected = raw.get_all_transitions()
+        actual = rb.get_all_transitions()
+        self.assertEqual(expected.keys(),actual.keys())
+        for name in expected:
+            np.testing.assert_array_equal(actual[name],expected[name])
+
+    def test_next_of(self):
+        self._check(1,-1,"obs",0.1)
+
+    def test_without_next(self):
+        self._check(1,-1,None,0.1)
+
+    def test_streams(self):
+        self._check(2,0,"obs",0.2)
+
+    def test_short_episodes(self):
+        self._check(3,-1,"obs",1.0)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            ReplayBuffer(16,self.env((2,4)),frame_store="obs",
+                         stack_compress="obs")
+        with self.assertRaises(NotImplementedError):
+            ReplayBuffer(16,self.env((2,4)),frame_store="obs",
+                         Nstep={"size": 2,"rew": "done"})
+
+
+class TestFeatureStorageDtype(unittest.TestCase):
+    @staticmethod
+    def env():
+        return {"obs": {"shape": 3,"storage": np.half},
+                "act": {"quantize": (0.1,128)},
+                "done": {}}
+
+    def test_sample(self):
+        obs = np.random.randn(16,3).astype(np.single)
+        act = np.random.uniform(-10,10,size=(16,1)).astype(np.single)
+        for layout in ["column","record"]:
+            with self.subTest(layout=layout):
+                rb = ReplayBuffer(16,self.env(),next_of="obs",layout=layout)
+                rb.add(obs=obs,act=act,next_obs=obs+1,done=np.zeros(16))
+
+                s = rb.get_all_transitions()
+                for name in ["obs","act","next_obs"]:
+                    self.assertEqual(s[name].dtype,np.single)
+                np.testing.assert_allclose(s["obs"],obs,rtol=1e-3)
+                np.testing.assert_allclose(s["next_obs"][-1],obs[-1]+1,rtol=1e-3)
+                np.testing.assert_allclose(s["act"],act.ravel(),atol=0.05+1e-6)
+
+                batch = rb.create_batch(4)
+                rb.sample(4,out=batch)
+                self.assertEqual(batch["act"].dtype,np.single)
+
+    def test_clip(self):
+        rb = ReplayBuffer(4,{"rew": {"quantize": (1.0,0)}})
+        rb.add(rew=[-3.0,300.0,3.4])
+        np.testing.assert_array_equal(rb.get_all_transitions()["rew"],
+                                      [0.0,255.0,3.0])
+
+    def test_dict2buffer(self):
+        buffer = dict2buffer(8,{"obs": {"storage": np.half},
+                                "act": {"quantize": (1.0,0)}})
+        self.assertEqual(buffer["obs"].dtype,np.half)
+        self.assertEqual(buffer["act"].dtype,np.uint8)
+
+        with self.assertRaises(ValueError):
+            dict2buffer(8,{"obs": {"storage": np.half,"quantize": (1.0,0)}})
+
+
+class TestFeatureNstepNextOf(unittest.TestCase):
+    @staticmethod
+    def env(next_obs):
+        env_dict = {"obs": {"shape": 3},"rew": {},"done": {}}
+        if next_obs:
+            env_dict["next_obs"] = {"shape": 3}
+        return env_dict
+
+    def _check(self,cls,Nstep_size,batch_size,p_done):
+        Nstep = {"size": Nstep_size,"rew": "rew","gamma": 0.9,"next": "next_obs"}
+        ref = cls(32,self.env(True),Nstep=dict(Nstep))
+        rb = cls(32,self.env(False),Nstep=dict(Nstep),next_of="obs")
+
+        obs = np.random.rand(3)
+        for _ in range(100):
+            o = np.random.rand(batch_size + 1,3)
+            o[0] = obs
+            obs = o[-1]
+            done = np.zeros(batch_size)
+            done[-1] = (np.random.rand() < p_done)
+            rew = np.random.rand(batch_size)
+            for b in (ref,rb):
+                b.add(obs=o[:-1],next_obs=o[1:],rew=rew,done=done)
+            if done[-1]:
+                for b in (ref,rb):
+                    b.on_episode_end()
+                obs = np.random.rand(3)
+
+        expected = ref.get_all_transitions()
+        actual = rb.get_all_transitions()
+        self.assertEqual(expected.keys(),actual.keys())
+
+        # Next values after episode end are masked by done.
+        not_done = (expected["done"].ravel() == 0)
+        for name in expected:
+            mask = not_done if name == "next_obs" else slice(None)
+            np.testing.assert_allclose(actual[name][mask],expected[name][mask])
+
+    def test_next_of(self):
+        for cls in [ReplayBuffer,PrioritizedReplayBuffer]:
+            for Nstep_size in [2,4]:
+                with self.subTest(cls=cls,Nstep_size=Nstep_size):
+                    self._check(cls,Nstep_size,1,0.1)
+
+    def test_multi_step_add(self):
+        self._check(ReplayBuffer,3,4,0.3)
+
+    def test_short_episodes(self):
+        self._check(ReplayBuffer,4,1,0.8)
+
+
+class TestFeatureResize(unittest.TestCase):
+    @staticmethod
+    def env():
+        return {"obs": {"shape": (3,4)},"act": {"dtype": np.int32},
+                "rew": {},"done": {}}
+
+    @staticmethod
+    def add(rbs,begin,end):
+        for t in range(begin,end):
+            # Consistent stacks of frames
+            obs = np.tile(t + np.arange(4),(3,1))
+            done = (t % 7 == 6)
+            for rb in rbs:
+                rb.add(obs=obs,next_obs=obs+1,act=t,rew=0.5*t,done=done)
+                if done:
+                    rb.on_episode_end()
+
+    @staticmethod
+    def ordered(rb):
+        return {name: np.roll(v,-rb.get_next_index(),axis=0)
+                for name, v in rb.get_all_transitions().items()}
+
+    def _check(self,expected,actual):
+        self.assertEqual(expected.keys(),actual.keys())
+        for name in expected:
+            np.testing.assert_allclose(actual[name],expected[name])
+
+    def test_lazy_growth(self):
+        for kwargs in [{"next_of": "obs"},
+                       {"next_of": "obs","stack_compress": "obs"},
+                       {"next_of": "obs","Nstep": {"size": 3,"rew": "rew"}},
+                       {"next_of": "obs","frame_store": "obs"}]:
+            for cls in [ReplayBuffer,PrioritizedReplayBuffer]:
+                with self.subTest(cls=cls,kwargs=kwargs):
+                    ref = cls(32,self.env(),**kwargs)
+                    rb = cls(32,self.env(),initial_size=4,**kwargs)
+                    self.assertEqual(rb.get_buffer_size(),4)
+
+                    self.add((ref,rb),0,20)
+                    self.assertEqual(rb.get_buffer_size(),32)
+                    self._check(ref.get_all_transitions(),rb.get_all_transitions())
+
+                    self.add((ref,rb),20,50)
+                    self._check(ref.get_all_transitions(),rb.get_all_transitions())
+
+    def test_shrink(self):
+        ref = ReplayBuffer(8,self.env(),next_of="obs")
+        rb = ReplayBuffer(32,self.env(),next_of="obs")
+
+        self.add((ref,rb),0,20)
+        rb.resize(8)
+        self.assertEqual(rb.get_buffer_size(),8)
+        self.assertEqual(rb.get_stored_size(),8)
+        self._check(self.ordered(ref),self.ordered(rb))
+
+        self.add((ref,rb),20,25)
+        self._check(self.ordered(ref),self.ordered(rb))
+
+    def test_priorities(self):
+        rb = PrioritizedReplayBuffer(16,{"act": {}},check_for_update=True)
+        rb.add(act=np.arange(12),priorities=np.where(np.arange(12) == 9,2.0,0.0))
+
+        rb.resize(8)
+        self.assertEqual(rb.get_max_priority(),2.0)
+        s = rb.sample(1024)
+        self.assertGreater(np.mean(s["act"] == 9),0.9)
+        np.testing.assert_allclose(s["indexes"][s["act"] == 9],5)
+
+        rb.update_priorities([5],[0.0])
+        rb.resize(4)
+        self.assertEqual(rb.get_stored_size(),4)
+        s = rb.sample(64)
+        np.testing.assert_allclose(np.unique(s["act"]),[8,9,10,11])
+
+    def test_num_envs(self):
+        rb = ReplayBuffer(8,{"done": {}},num_envs=2)
+        with self.assertRaises(ValueError):
+            rb.resize(5)
+
+    def test_thread_safe(self):
+        with self.assertRaises(NotImplementedError):
+            PrioritizedReplayBuffer(8,{"obs": {}},thread_safe=True,initial_size=2)
+
+        rb = PrioritizedReplayBuffer(8,{"obs": {}},thread_safe=True,initial_size=8)
+        self.assertEqual(rb.get_buffer_size(),8)
+
+
+class TestFeatureRagged(unittest.TestCase):
+    @staticmethod
+    def values(n,begin = 0):
+        return [np.arange(L,dtype=np.int32) + 100 * (begin + i)
+                for i, L in enumerate(np.random.randint(0,8,size=n))]
+
+    def _check(self,rb,values):
+        all = rb.get_all_transitions()
+        self.assertEqual(all["tok"].shape[1],all["tok_lengths"].max(initial=0))
+        for tok, L, i in zip(all["tok"],all["tok_lengths"],
+                                 np.ravel(all["rew"]).astype(int)):
+            self.assertEqual(L,values[i].shape[0])
+            np.testing.assert_equal(tok[:L],values[i])
+            np.testing.assert_equal(tok[L:],0)
+
+    def test_padded(self):
+        rb = ReplayBuffer(16,{"tok": {"ragged": True,"dtype": np.int32},"rew": {}})
+        values = self.values(50)
+        for i, v in enumerate(values):
+            rb.add(tok=v,rew=i)
+            self._check(rb,values)
+
+        s = rb.sample(32)
+        self.assertEqual(s["tok"].dtype,np.int32)
+        self.assertEqual(s["tok_lengths"].shape,(32,))
+
+    def test_multistep_add(self):
+        rb = ReplayBuffer(16,{"tok": {"ragged": True,"dtype": np.int32},"rew": {}})
+        values = self.values(60)
+        for i in range(0,60,6):
+            rb.add(tok=values[i:i+6],rew=np.arange(i,i+6))
+            self._check(rb,values)
+
+        with self.assertRaises(ValueError):
+            rb.add_batch({"tok": values[:3],"rew": np.zeros((2,1),dtype=np.single)},
+                         unchecked=False)
+
+    def test_flat(self):
+        rb = ReplayBuffer(8,{"pts": {"ragged": "flat","shape": 3},"rew": {}})
+        values = [np.random.rand(L,3) for L in np.random.randint(1,5,size=20)]
+        for i, v in enumerate(values):
+            rb.add(pts=v,rew=i)
+
+        s = rb.sample(16)
+        offsets = s["pts_offsets"]
+        self.assertEqual(offsets.shape,(17,))
+        self.assertEqual(s["pts"].shape,(offsets[-1],3))
+        for k, i in enumerate(s["rew"].astype(int)):
+            np.testing.assert_allclose(s["pts"][offsets[k]:offsets[k+1]],values[i])
+
+    def test_sequence(self):
+        for cls in [ReplayBuffer,PrioritizedReplayBuffer]:
+            with self.subTest(cls=cls):
+                rb = cls(16,{"tok": {"ragged": True,"dtype": np.int32},"rew": {}})
+                values = self.values(20)
+                for i, v in enumerate(values):
+                    rb.add(tok=v,rew=i)
+
+                s = rb.sample_sequences(8,4)
+                self.assertEqual(s["tok_lengths"].shape,(8,4))
+                rew = s["rew"][:,:,0].astype(int)
+                np.testing.assert_equal(np.diff(rew,axis=1),np.ones((8,3)))
+                for tok, L, i in zip(s["tok"].reshape(32,-1),
+                                     s["tok_lengths"].ravel(),rew.ravel()):
+                    np.testing.assert_equal(tok[:L],values[i])
+                    np.testing.assert_equal(tok[L:],0)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            ReplayBuffer(8,{"tok": {"ragged": True},"rew": {}},next_of="tok")
+        with self.assertRaises(ValueError):
+            ReplayBuffer(8,{"tok": {"ragged": True}})
+
+
+class TestFeatureTreeArity(unittest.TestCase):
+    def test_sample(self):
+        size = 1000
+        p = (np.arange(size) % 5 + 0.5).astype(np.single)
+        for arity in [2, 4, 8]:
+            with self.subTest(arity=arity):
+                rb = PrioritizedReplayBuffer(size,{"a": {}},tree_arity=arity,
+                                             alpha=1.0,eps=0.0)
+                rb.add(a=np.arange(700),priorities=np.ones(700))
+
+                # Priorities set at wrapped around range and scattered indexes
+                rb.add(a=np.arange(600),priorities=np.roll(p,-700)[:600])
+                rb.update_priorities(np.random.permutation(np.arange(300,700)),
+                                     np.ones(400))
+                rb.update_priorities(np.arange(300,700),p[300:700])
+
+                s = rb.sample(1024,beta=0.5)
+                idx = s["indexes"].astype(int)
+                self.assertAlmostEqual(np.mean(idx % 5 == 4),4.5 / 12.5,delta=0.05)
+
+                prob = p[idx] / p.sum()
+                np.testing.assert_allclose(s["weights"],
+                                           (prob * size) ** -0.5 /
+                                           (p.min() / p.sum() * size) ** -0.5,
+                                           rtol=1e-4)
+
+    def test_unsorted_duplicates(self):
+        for arity in [2, 4, 8]:
+            with self.subTest(arity=arity):
+                rb = PrioritizedReplayBuffer(8,{"a": {}},tree_arity=arity,
+                                             alpha=1.0,eps=0.0)
+                rb.add(a=np.arange(8),priorities=np.zeros(8))
+
+                # The last value is set for duplicated index
+                rb.update_priorities([5,2,5,2],[0.0,3.0,1.0,0.0])
+                np.testing.assert_equal(rb.sample(64)["a"],5)
+
+    def test_resize(self):
+        rb = PrioritizedReplayBuffer(8,{"a": {}},tree_arity=4,alpha=1.0,eps=0.0)
+        rb.add(a=np.arange(8),priorities=[0,0,0,0,0,0,0,1])
+        rb.resize(64)
+        rb.add(a=8,priorities=0)
+        np.testing.assert_equal(rb.sample(32)["a"],7)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            PrioritizedReplayBuffer(8,{"a": {}},tree_arity=3)
+        with self.assertRaises(NotImplementedError):
+            PrioritizedReplayBuffer(8,{"a": {}},tree_arity=4,thread_safe=True)
+
+
+class TestFeatureSampleThreads(unittest.TestCase):
+    @staticmethod
+    def create(**kwargs):
+        rb = PrioritizedReplayBuffer(4096,{"a": {}},**kwargs)
+        rb.add(a=np.arange(4096),priorities=np.arange(4096) % 7)
+        return rb
+
+    def test_deterministic(self):
+        s = [self.create(sample_threads=n,seed=42).sample(3000) for n in [1,2,5]]
+        for si in s[1:]:
+            np.testing.assert_equal(si["indexes"],s[0]["indexes"])
+            np.testing.assert_equal(si["weights"],s[0]["weights"])
+            np.testing.assert_equal(si["a"],s[0]["a"])
+
+        self.assertFalse(np.array_equal(self.create(seed=1).sample(64)["indexes"],
+                                        self.create(seed=2).sample(64)["indexes"]))
+
+    def test_sample_many(self):
+        s1 = self.create(sample_threads=1,seed=0).sample_many(4,1024)
+        s4 = self.create(sample_threads=4,seed=0).sample_many(4,1024)
+        np.testing.assert_equal(s1["indexes"],s4["indexes"])
+
+    def test_resize(self):
+        rb = self.create(sample_threads=4,seed=0)
+        rb.resize(8192)
+        self.assertEqual(rb.sample(2048)["indexes"].shape,(2048,))
+
+    def test_thread_safe(self):
+        with self.assertRaises(NotImplementedError):
+            PrioritizedReplayBuffer(8,{"a": {}},sample_threads=2,thread_safe=True)
+
+        s = [self.create(thread_safe=True,seed=3).sample(16) for _ in range(2)]
+        np.testing.assert_equal(s[0]["indexes"],s[1]["indexes"])
+
+
 if __name__ == '__main__':
     unittest.main()